@@ -11,9 +11,34 @@ expressly prohibited.
 """
 import psycopg2 as pg
 import psycopg2.extensions as pg_ext
-from typing import Optional, List, Any
+from typing import Optional, List, Any, Callable, Iterable, Iterator, Tuple
 from datetime import datetime
+import functools
+import hashlib
+import heapq
+import io
+import itertools
+import os
 import re
+import threading
+
+from backend import Backend
+from connection_pool import ConnectionPool
+from driver_cache import DriverCache
+from instrumentation import Stats
+from matching import greedy_match, optimal_match
+from statements import StatementRegistry
+
+# The views and other database objects that the methods below rely on.
+SUPPORT_DDL = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "support.ddl")
+
+# How many rows at a time are fetched by server-side cursors, unless told
+# otherwise.
+DEFAULT_ITERSIZE = 2000
+
+# Numbers that make the names of server-side cursors unique.
+_cursor_ids = itertools.count()
 
 
 class GeoLoc:
@@ -35,6 +60,9 @@ class GeoLoc:
     >>> where.latitude
     50.0
     """
+    # GeoLocs are made for every geo_loc read from the database, so they are
+    # kept small: no per-instance __dict__.
+    __slots__ = ('longitude', 'latitude')
     longitude: float
     latitude: float
 
@@ -51,29 +79,161 @@ class GeoLoc:
             f"Invalid value for latitude: {latitude}"
 
 
-class Assignment2:
+_new_geo_loc = object.__new__
+
+
+def _cast_geo_loc(value: Optional[str], *args: Any) -> Optional[GeoLoc]:
+    """Convert the given value <value>, a geo_loc as PostgreSQL writes it
+    (e.g., "(-79.233,43.712)"), to a GeoLoc object.
+
+    Throw an InterfaceError if the given value can't be converted to a GeoLoc
+    object.
+
+    This runs for every geo_loc read from the database, so the value is split
+    by hand rather than with a regular expression, and the GeoLoc is made
+    without the checks in GeoLoc.__init__ (the geo_loc domain has made them
+    already).
+
+    >>> where = _cast_geo_loc("(-25,50.5)")
+    >>> where.longitude, where.latitude
+    (-25.0, 50.5)
+    """
+    if value is None:
+        return None
+    try:
+        longitude, latitude = value[1:-1].split(",")
+        loc = _new_geo_loc(GeoLoc)
+        loc.longitude = float(longitude)
+        loc.latitude = float(latitude)
+        return loc
+    except ValueError:
+        raise pg.InterfaceError(f"bad geo_loc representation: {value}")
+
+
+def _operation(method: Callable) -> Callable:
+    """Return a version of the Assignment2 method <method> that, when the
+    instance is in pooled mode, runs on a connection checked out of the pool
+    for this call alone.
+
+    While the call runs, the checked-out connection is the instance's
+    connection in the calling thread, so helper methods called along the way
+    use the same connection (and transaction). Calls made while a connection
+    is already checked out by the thread use that connection.
+
+    When the instance is instrumented, calls to public methods are recorded
+    as operations in its stats.
+    """
+    @functools.wraps(method)
+    def wrapper(self: 'Assignment2', *args: Any, **kwargs: Any) -> Any:
+        if self.stats is not None and not method.__name__.startswith("_"):
+            with self.stats.operation(method.__name__):
+                return run(self, *args, **kwargs)
+        return run(self, *args, **kwargs)
+
+    def run(self: 'Assignment2', *args: Any, **kwargs: Any) -> Any:
+        if self.pool is None or \
+                getattr(self._local, "connection", None) is not None:
+            return method(self, *args, **kwargs)
+        with self.pool.connection() as conn:
+            self._local.connection = conn
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._local.connection = None
+    return wrapper
+
+
+class Assignment2(Backend):
     """A class that can work with data conforming to the schema in schema.ddl.
 
+    An instance either has a single connection (see connect), or is in
+    pooled mode (see connect_pool). Only pooled mode is safe to use from
+    several threads at once. It is the PostgreSQL implementation of Backend
+    (see backend.py).
+
     === Instance Attributes ===
     connection: connection to a PostgreSQL database of ride-sharing information.
+        In pooled mode, this is the connection checked out by the current
+        thread for the operation it is running, or None outside of one.
+    pool: the pool connections are checked out of in pooled mode, or None.
+    driver_cache: the in-memory state of ongoing shifts used by dispatch, or
+        None if dispatch looks it up in the database (see connect).
+    itersize: if not None, dispatch streams the requests in its area from
+        the database this many at a time (see iter_clients_within_bounds)
+        instead of reading them all at once.
+    server_dispatch: if True, dispatch chooses and records the dispatches
+        in the database, in a single roundtrip (see dispatch_area in
+        support.ddl), unless it is asked for optimal matching or
+        concurrent_dispatch is also True.
+    concurrent_dispatch: if True, dispatch claims the drivers and requests
+        it considers with row locks, so that several dispatchers can run
+        over overlapping areas at once without waiting for each other or
+        dispatching the same driver or request (see _dispatch_claimed).
+    stats: the latency and roundtrips of each operation, or None if the
+        instance is not instrumented (see connect).
+
+    === Private Attributes ===
+    _connection: the single connection, when not in pooled mode.
+    _local: the connection checked out by each thread, in pooled mode.
+    _statements: the statements run on every clock-in, pick-up and
+        dispatch, prepared once on each connection (see statements.py).
 
     Representation invariants:
     - The database to which connection is established conforms to the schema
       in schema.ddl.
+    - pool is None or _connection is None.
     """
-    connection: Optional[pg_ext.connection]
+    pool: Optional[ConnectionPool]
+    driver_cache: Optional[DriverCache]
+    itersize: Optional[int]
+    server_dispatch: bool
+    concurrent_dispatch: bool
+    stats: Optional[Stats]
+    _connection: Optional[pg_ext.connection]
+    _local: threading.local
+    _statements: StatementRegistry
 
     def __init__(self) -> None:
         """Initialize this Assignment2 instance, with no database connection
         yet.
         """
-        self.connection = pg.connect(dbname = "csc343h-tungcarm", user = "tungcarm", password = "", options = "-c search_path=uber,public")
-
-    def connect(self, dbname: str, username: str, password: str) -> bool:
+        self._connection = None
+        self.pool = None
+        self.driver_cache = None
+        self.itersize = None
+        self.server_dispatch = False
+        self.concurrent_dispatch = False
+        self.stats = None
+        self._local = threading.local()
+        self._statements = self._hot_statements()
+
+    @property
+    def connection(self) -> Optional[pg_ext.connection]:
+        """Return the connection this thread should use."""
+        conn = getattr(self._local, "connection", None)
+        return self._connection if conn is None else conn
+
+    @connection.setter
+    def connection(self, conn: Optional[pg_ext.connection]) -> None:
+        """Set the single connection to <conn>."""
+        self._connection = conn
+
+    def connect(self, dbname: str, username: str, password: str,
+                driver_cache: bool = False, instrument: bool = False) -> bool:
         """Establish a connection to the database <dbname> using the
         username <username> and password <password>, and assign it to the
         instance attribute <connection>. In addition, set the search path to
-        uber, public.
+        uber, public, and install the database objects in support.ddl if they
+        are not installed already.
+
+        If <driver_cache> is True, dispatch picks drivers using an in-memory
+        cache of the state of ongoing shifts (see driver_cache.py), and only
+        confirms its choices in the database.
+
+        If <instrument> is True, the latency of each call to a public method
+        below, and the number, duration and rows of the roundtrips it makes
+        to the database, are recorded in the instance attribute <stats> (see
+        instrumentation.py).
 
         Return True if the connection was made successfully, False otherwise.
         I.e., do NOT throw an error if making the connection fails.
@@ -87,17 +247,121 @@ class Assignment2:
         >>> a2.connect("nonsense", "silly", "junk")
         False
         """
+        params = {"dbname": dbname, "user": username, "password": password,
+                  "options": "-c search_path=uber,public"}
         try:
-            self.connection = pg.connect(
-                dbname=dbname, user=username, password=password,
-                options="-c search_path=uber,public"
-            )
-            # This allows psycopg2 to learn about our custom type geo_loc.
-            self._register_geo_loc()
+            self.connection = pg.connect(**params,
+                                         **self._instrument(instrument))
+            self._prepare()
+            if driver_cache:
+                self.driver_cache = DriverCache(**params)
             return True
-        except pg.Error:
+        except (pg.Error, OSError):
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
             return False
 
+    def connect_pool(self, dbname: str, username: str, password: str,
+                     minconn: int = 1, maxconn: int = 20,
+                     timeout: Optional[float] = 30.0,
+                     health_check: bool = True,
+                     driver_cache: bool = False,
+                     instrument: bool = False) -> bool:
+        """Like connect, but put this instance in pooled mode: keep a pool of
+        connections to the database <dbname>, and run each call to a method
+        below on a connection checked out of the pool for that call.
+
+        The pool opens <minconn> connections right away, and allows at most
+        <maxconn> to be checked out at once. A call that finds them all
+        checked out waits up to <timeout> seconds (or forever, if <timeout>
+        is None) for one to be returned, and then raises a
+        connection_pool.PoolTimeout. If <health_check> is True, connections
+        are checked to still work before every use. <driver_cache> and
+        <instrument> are as for connect; the cache and the stats are shared
+        by all the threads.
+
+        Return True if the pool was made successfully, False otherwise.
+
+        >>> a2 = Assignment2()
+        >>> a2.connect_pool("csc343h-dianeh", "dianeh", "", maxconn=50)
+        True
+        """
+        params = {"dbname": dbname, "user": username, "password": password,
+                  "options": "-c search_path=uber,public"}
+        try:
+            self.pool = ConnectionPool(minconn, maxconn, timeout,
+                                       health_check, **params,
+                                       **self._instrument(instrument))
+            self._prepare()
+            if driver_cache:
+                self.driver_cache = DriverCache(**params)
+            return True
+        except (pg.Error, OSError):
+            if self.pool is not None:
+                self.pool.closeall()
+                self.pool = None
+            return False
+
+    def _instrument(self, instrument: bool) -> dict:
+        """Return the extra arguments to psycopg2.connect for the connections
+        of this instance, after making its stats if <instrument> is True.
+        """
+        self.stats = Stats() if instrument else None
+        if self.stats is None:
+            return {}
+        return {"connection_factory": self.stats.connection_factory}
+
+    @_operation
+    def _prepare(self) -> None:
+        """Get the database and psycopg2 ready for the methods below."""
+        # This allows psycopg2 to learn about our custom type geo_loc.
+        self._register_geo_loc()
+        self._register_geo_loc_cast()
+        self.install_support()
+
+    @_operation
+    def install_support(self) -> None:
+        """Install the views (and other database objects) in support.ddl into
+        the database, unless this version of support.ddl is installed already.
+
+        This is called by connect, so the methods below never need to create
+        or drop views themselves. It can also be called on its own to migrate
+        a database after support.ddl changes. Concurrent callers are
+        serialized, so only one of them runs the DDL.
+
+        Raise a pg.Error if installing fails, and an OSError if support.ddl
+        can't be read.
+        """
+        with open(SUPPORT_DDL) as ddl_file:
+            ddl = ddl_file.read()
+        digest = hashlib.sha1(ddl.encode()).hexdigest()
+
+        with self.connection, self.connection.cursor() as cursor:
+            if self._support_digest(cursor) == digest:
+                return
+            # Serialize installers, then check again in case another one
+            # finished while we waited.
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));",
+                           [SUPPORT_DDL])
+            if self._support_digest(cursor) == digest:
+                return
+            cursor.execute(ddl)
+            cursor.execute("DELETE FROM SupportVersion;")
+            cursor.execute("INSERT INTO SupportVersion VALUES (%s);", [digest])
+
+    @staticmethod
+    def _support_digest(cursor: pg_ext.cursor) -> Optional[str]:
+        """Return the digest of the installed version of support.ddl, or None
+        if it has never been installed.
+        """
+        cursor.execute("SELECT to_regclass('SupportVersion') IS NOT NULL;")
+        if not cursor.fetchone()[0]:
+            return None
+        cursor.execute("SELECT digest FROM SupportVersion;")
+        row = cursor.fetchone()
+        return row[0] if row else None
+
     def disconnect(self) -> bool:
         """Close the database connection.
 
@@ -115,155 +379,316 @@ class Assignment2:
         False
         """
         try:
-            if not self.connection.closed:
+            if self.driver_cache is not None:
+                self.driver_cache.close()
+                self.driver_cache = None
+            if self.pool is not None:
+                self.pool.closeall()
+                self.pool = None
+            elif self.connection is None:
+                return False
+            elif not self.connection.closed:
                 self.connection.close()
             return True
         except pg.Error:
             return False
     
     # ======================= Helper methods ======================= #
+
+    # Keyed lookups used to validate clock-ins and pick-ups. Each is an SQL
+    # expression with the named parameters %(driver_id)s and/or
+    # %(client_id)s, so that several of them can be checked in one SELECT.
+    # The indexes they rely on are in support.ddl.
+
+    # Whether the driver has ever clocked in.
+    _DRIVER_EXISTS = """
+        EXISTS (SELECT 1 FROM ClockedIn WHERE driver_id = %(driver_id)s)"""
+    # Whether the client has ever requested a ride.
+    _CLIENT_EXISTS = """
+        EXISTS (SELECT 1 FROM Request WHERE client_id = %(client_id)s)"""
+    # Whether the driver is on a shift that has not ended.
+    _DRIVER_ON_SHIFT = """
+        EXISTS (SELECT 1
+                FROM ClockedIn LEFT JOIN ClockedOut USING(shift_id)
+                WHERE driver_id = %(driver_id)s AND
+                    ClockedOut.datetime IS NULL)"""
+    # The requests for which the driver has been dispatched to the client
+    # and has not picked them up yet, oldest first. (This is a query; the
+    # two expressions below are made from it.)
+    _OUTSTANDING_DISPATCHES = """
+        SELECT request_id
+        FROM Dispatch JOIN Request USING(request_id)
+            JOIN ClockedIn USING(shift_id)
+        WHERE driver_id = %(driver_id)s AND client_id = %(client_id)s AND
+            NOT EXISTS (SELECT 1 FROM Pickup
+                        WHERE Pickup.request_id = Dispatch.request_id)
+        ORDER BY request_id"""
+    # The first of those requests, or NULL if there is none.
+    _DISPATCHED_REQUEST = f"({_OUTSTANDING_DISPATCHES} LIMIT 1)"
+    # All of those requests, as an array.
+    _DISPATCHED_REQUESTS = f"ARRAY({_OUTSTANDING_DISPATCHES})"
+    # Whether the driver has picked up the client.
+    _PICKED_UP = """
+        EXISTS (SELECT 1
+                FROM Pickup JOIN Dispatch USING(request_id)
+                    JOIN Request USING(request_id)
+                    JOIN ClockedIn USING(shift_id)
+                WHERE driver_id = %(driver_id)s AND
+                    client_id = %(client_id)s)"""
+
+    @classmethod
+    def _hot_statements(cls) -> StatementRegistry:
+        """Return a registry of the statements run on every clock-in, pick-up
+        and dispatch: the keyed lookups above, alone and as the checks made
+        by clock_in and pick_up, and the inserts they and dispatch make.
+        """
+        statements = StatementRegistry()
+        driver = {"driver_id": "integer"}
+        client = {"client_id": "integer"}
+        both = {**driver, **client}
+        for name, expression, types in [
+                ("a2_driver_exists", cls._DRIVER_EXISTS, driver),
+                ("a2_client_exists", cls._CLIENT_EXISTS, client),
+                ("a2_driver_on_shift", cls._DRIVER_ON_SHIFT, driver),
+                ("a2_dispatched_request", cls._DISPATCHED_REQUEST, both),
+                ("a2_picked_up", cls._PICKED_UP, both)]:
+            statements.register(name, f"SELECT {expression};", **types)
+        statements.register(
+            "a2_validate_clock_in",
+            f"SELECT {cls._DRIVER_EXISTS}, {cls._DRIVER_ON_SHIFT};", **driver)
+        statements.register(
+            "a2_validate_pick_up",
+            f"""SELECT {cls._DRIVER_EXISTS}, {cls._CLIENT_EXISTS},
+                {cls._DRIVER_ON_SHIFT}, {cls._DISPATCHED_REQUEST};""", **both)
+        # The new shift (see insert_shift in support.ddl) and its first
+        # location, in one statement.
+        statements.register(
+            "a2_insert_shift",
+            """INSERT INTO Location
+            SELECT insert_shift(%(driver_id)s, %(when)s), %(when)s,
+                %(location)s
+            RETURNING shift_id, txid_current();""",
+            **driver, when="timestamp", location="geo_loc")
+        statements.register(
+            "a2_insert_pickup",
+            "INSERT INTO Pickup VALUES (%(request_id)s, %(when)s);",
+            request_id="integer", when="timestamp")
+        # Any number of dispatches, given column by column, so the statement
+        # is the same however many there are.
+        statements.register(
+            "a2_insert_dispatches",
+            """INSERT INTO Dispatch
+            SELECT *
+            FROM unnest(%(request_ids)s, %(shift_ids)s, %(locations)s,
+                        %(times)s);""",
+            request_ids="integer[]", shift_ids="integer[]",
+            locations="geo_loc[]", times="timestamp[]")
+        return statements
+
+    def _lookup(self, name: str, **params: int) -> Any:
+        """Return the value of the prepared lookup <name> (see
+        _hot_statements) with the parameters <params>.
+        """
+        with self.connection.cursor() as cursor:
+            self._statements.execute(cursor, name, params)
+            return cursor.fetchone()[0]
+
+    @_operation
     def ongoing_drivers(self, driver_id: int) -> bool:
-        """Return whether a given driver is on a shift. 
+        """Return whether a given driver is on a shift.
         """
-        cursor = self.connection.cursor()
-        cursor.execute("""SET SEARCH_PATH TO uber, public;""")
-        get_ongoing_drivers = """SELECT driver_id FROM ClockedIn LEFT JOIN ClockedOut USING(shift_id) WHERE ClockedOut.datetime IS NULL;"""
-        cursor.execute(get_ongoing_drivers)
-        for driver in cursor:
-                if int(driver[0]) == driver_id:
-                    cursor.close()
-                    return True
-        cursor.close()
-        return False
-    
+        return self._lookup("a2_driver_on_shift", driver_id=driver_id)
+
+    @_operation
     def real_drivers(self, driver_id: int) -> bool:
-        """Return whether a given driver exists 
+        """Return whether a given driver exists
         """
-        cursor = self.connection.cursor()
-        cursor.execute("""SET SEARCH_PATH TO uber, public;""")
-        get_real_drivers = """SELECT driver_id FROM ClockedIn;"""
-        cursor.execute(get_real_drivers)
-        for driver in cursor:
-                if int(driver[0]) == driver_id:
-                    cursor.close()
-                    return True
-        cursor.close()
-        return False
-    
+        return self._lookup("a2_driver_exists", driver_id=driver_id)
+
+    @_operation
     def real_client(self, client_id: int) -> bool:
-        """Return whether a given client exists 
+        """Return whether a given client exists
         """
-        cursor = self.connection.cursor()
-        cursor.execute("""SET SEARCH_PATH TO uber, public;""")
-        get_real_client = """SELECT client_id FROM Request;"""
-        cursor.execute(get_real_client)
-        for client in cursor:
-                if int(client[0]) == client_id:
-                    cursor.close()
-                    return True
-        cursor.close()
-        return False
-    
+        return self._lookup("a2_client_exists", client_id=client_id)
+
+    @_operation
     def dispatched_drivers(self, driver_id: int, client_id: int) -> tuple:
         """Return whether the given driver has been dispatched to
         pick up the client.
         """
-        cursor = self.connection.cursor()
-        cursor.execute("""SET SEARCH_PATH TO uber, public;""")
-        cursor.execute("""DROP VIEW IF EXISTS valid_requests CASCADE;""")
-        get_valid_requests = """CREATE VIEW valid_requests AS
-        (SELECT request_id FROM Dispatch) EXCEPT ALL (SELECT request_id FROM Pickup);
+        request_id = self._lookup("a2_dispatched_request",
+                                  driver_id=driver_id, client_id=client_id)
+        if request_id is None:
+            return -1, False
+        return request_id, True
+
+    @_operation
+    def picked_up_driver(self, driver_id: int, client_id: int) -> bool:
+        """Return whether the driver has picked up the client.
         """
-        cursor.execute(get_valid_requests)
-
-        get_dispatched_drivers = """
-        SELECT driver_id, client_id, request_id
-        FROM Dispatch NATURAL JOIN valid_requests JOIN Request USING(request_id) JOIN ClockedIn USING(shift_id) JOIN Driver USING(driver_id) JOIN Client USING(client_id);
+        return self._lookup("a2_picked_up",
+                            driver_id=driver_id, client_id=client_id)
+
+    @_operation
+    def validate_pick_up(self, driver_id: int, client_id: int) -> tuple:
+        """Return the preconditions of a pick up of the client by the driver,
+        checked in a single query, as a tuple of:
+            - whether the driver exists (see real_drivers)
+            - whether the client exists (see real_client)
+            - whether the driver is on a shift (see ongoing_drivers)
+            - the id of the request the driver has been dispatched to and
+              not picked up yet, or -1 if there is none
+              (see dispatched_drivers)
+        """
+        with self.connection.cursor() as cursor:
+            self._statements.execute(
+                cursor, "a2_validate_pick_up",
+                {"driver_id": driver_id, "client_id": client_id})
+            d_exists, c_exists, ongoing, request_id = cursor.fetchone()
+        if request_id is None:
+            request_id = -1
+        return d_exists, c_exists, ongoing, request_id
+
+    # The queries behind clients_within_bounds, client_billed_totals and
+    # valid_drivers. The first and last take the parameters returned by _box.
+
+    # The requests in the area that have not been dispatched. The bounds are
+    # checked by the database, using the GiST index on Request.source, so
+    # only the requests in the area are sent back.
+    _OPEN_REQUESTS_IN_BOX = """
+        SELECT *
+        FROM Request
+        WHERE source <@ box(point(%s, %s), point(%s, %s)) AND
+            NOT EXISTS (SELECT 1 FROM Dispatch
+                        WHERE Dispatch.request_id = Request.request_id)
+        ORDER BY request_id;
+        """
+    # The total billings of the clients with ids in an array who have been
+    # billed. The totals are kept up to date in ClientBilled (see
+    # support.ddl), so only the rows of these clients are read.
+    _CLIENT_BILLS = """
+        SELECT client_id, total
+        FROM ClientBilled
+        WHERE client_id = ANY(%s);
+        """
+    # The drivers in the area who can be dispatched. Only the current
+    # locations of ongoing shifts are searched (using the GiST index on
+    # CurrentLocation.location), and whether each driver in the area is
+    # dispatched or on a ride is checked by keyed lookups, so the cost does
+    # not grow with the history of Location or Dispatch.
+    _SHIFT_FREE = """
+        NOT EXISTS (SELECT 1
+                    FROM Dispatch
+                    WHERE Dispatch.shift_id = CurrentLocation.shift_id AND
+                        NOT EXISTS (SELECT 1
+                                    FROM Pickup JOIN Dropoff
+                                        USING(request_id)
+                                    WHERE request_id = Dispatch.request_id))"""
+    _AVAILABLE_DRIVERS_IN_BOX = f"""
+        SELECT driver_id, shift_id, location
+        FROM CurrentLocation JOIN ClockedIn USING(shift_id)
+        WHERE location <@ box(point(%s, %s), point(%s, %s)) AND
+            {_SHIFT_FREE}
+        ORDER BY shift_id;
         """
-        cursor.execute(get_dispatched_drivers)
-        for pair in cursor:
-            if int(pair[0]) == driver_id and int(pair[1]) == client_id:
-                cursor.close()
-                return int(pair[2]), True
-        cursor.close()
-        return -1, False
 
-    def picked_up_driver(self, driver_id: int, client_id: int):
-        """Return whether the driver has picked up the client.
+    # The queries behind concurrent dispatches (see _dispatch_claimed). The
+    # claims take the parameters returned by _box, and the checks of the
+    # claimed rows take the ids of the rows claimed, as an array.
+
+    # Claim the shifts of the drivers in the area who can be dispatched and
+    # are not claimed already.
+    _CLAIM_DRIVERS_IN_BOX = f"""
+        SELECT shift_id
+        FROM CurrentLocation JOIN ClockedIn USING(shift_id)
+        WHERE location <@ box(point(%s, %s), point(%s, %s)) AND
+            {_SHIFT_FREE}
+        FOR NO KEY UPDATE OF ClockedIn SKIP LOCKED;
         """
-        cursor = self.connection.cursor()
-        cursor.execute("""SET SEARCH_PATH TO uber, public;""")
-        get_pickedup = """
+    # The drivers of the claimed shifts who can still be dispatched from the
+    # area.
+    _CLAIMED_DRIVERS = f"""
+        SELECT driver_id, shift_id, location
+        FROM CurrentLocation JOIN ClockedIn USING(shift_id)
+        WHERE location <@ box(point(%s, %s), point(%s, %s)) AND
+            shift_id = ANY(%s) AND {_SHIFT_FREE}
+        ORDER BY shift_id;
+        """
+    # Claim up to a given number of the requests in the area that have not
+    # been dispatched and are not claimed already: those that dispatch
+    # would serve first, i.e. with the highest billings, and of those billed
+    # the same, the latest.
+    _CLAIM_REQUESTS_IN_BOX = """
         SELECT request_id
-        FROM Pickup JOIN Dispatch USING(request_id);
+        FROM Request LEFT JOIN ClientBilled
+            ON ClientBilled.client_id = Request.client_id
+        WHERE source <@ box(point(%s, %s), point(%s, %s)) AND
+            NOT EXISTS (SELECT 1 FROM Dispatch
+                        WHERE Dispatch.request_id = Request.request_id)
+        ORDER BY coalesce(total, 0) DESC, request_id DESC
+        LIMIT %s
+        FOR NO KEY UPDATE OF Request SKIP LOCKED;
+        """
+    # The claimed requests that have still not been dispatched, with the
+    # total billings of their clients (or NULL), by request_id.
+    _CLAIMED_REQUESTS = """
+        SELECT Request.*, total
+        FROM Request LEFT JOIN ClientBilled
+            ON ClientBilled.client_id = Request.client_id
+        WHERE request_id = ANY(%s) AND
+            NOT EXISTS (SELECT 1 FROM Dispatch
+                        WHERE Dispatch.request_id = Request.request_id)
+        ORDER BY request_id;
         """
-        cursor.execute(get_pickedup)
-        dispatch_info = self.dispatched_drivers(driver_id, client_id)
-        for request_id in cursor:
-            if request_id == dispatch_info[0]:
-                cursor.close()
-                return True
-        cursor.close()
-        return False
 
+    @_operation
     def clients_within_bounds(self, nw: GeoLoc, se: GeoLoc) -> list:
         """Return clients that are within the given bounds and 
         have not had a ride dispatched for them. Test with data2
         """
         cursor = self.connection.cursor()
-        cursor.execute("""SET SEARCH_PATH TO uber, public;""")
-        cursor.execute("""DROP VIEW IF EXISTS open_requests CASCADE;""")
-        print('hi')
-        get_open_requests="""
-        CREATE VIEW open_requests AS
-        (SELECT request_id
-        FROM Request) EXCEPT ALL
-        (SELECT request_id
-        FROM Dispatch);
-        """
-        cursor.execute(get_open_requests)
-        sorted_requests="""
-        SELECT *
-        FROM Request NATURAL JOIN open_requests; 
-        """
-        cursor.execute(sorted_requests)
-        print(cursor)
-        client_list = []
-        for client in cursor:
-            # print(float(client[3].longitude))
-            # print(float(client[3].latitude))
-            # print(float(nw.longitude))
-            # print(float(nw.latitude))
-            # print(float(se.longitude))
-            # print(float(se.latitude))
-            if float(client[3].longitude) <= se.longitude and \
-            float(client[3].longitude) >= nw.longitude and \
-            float(client[3].latitude) <= nw.latitude and \
-            float(client[3].latitude) >= se.latitude:
-                client_list.append(client)
+        box = self._box(nw, se)
+        if box is None:
+            cursor.close()
+            return []
+        cursor.execute(self._OPEN_REQUESTS_IN_BOX, box)
+        client_list = cursor.fetchall()
         cursor.close()
-        print(client_list)
 
         return client_list
     
+    @staticmethod
+    def _box(nw: GeoLoc, se: GeoLoc) -> Optional[list]:
+        """Return the coordinates of the corners of the area bounded by <nw>
+        and <se>, as parameters for the SQL expression
+            box(point(%s, %s), point(%s, %s))
+        or None if no point is within the bounds.
+
+        This lets the database check the bounds with the <@ operator, which
+        can use a GiST index. The area boundaries are inclusive.
+        """
+        if nw.longitude > se.longitude or se.latitude > nw.latitude:
+            return None
+        return [nw.longitude, se.latitude, se.longitude, nw.latitude]
+
+    @_operation
     def client_billed_totals(self, client_list: list) -> list:
         """Sort the clients based on their previous billed totals
         """
         cursor = self.connection.cursor()
-        cursor.execute("""SET SEARCH_PATH TO uber, public;""")
-        # cursor.execute("""DROP VIEW IF EXISTS client_bills CASCADE;""")
-        client_bills="""
-        SELECT client_id, sum(amount)
-        FROM Request NATURAL JOIN Billed
-        GROUP BY client_id
-        ORDER BY sum(amount) DESC;
-        """
-
-        client_sorted = {}
-        cursor.execute(client_bills)
-        for client in cursor:
-            client_sorted[client[0]] = client[1]
-        
+        cursor.execute(self._CLIENT_BILLS,
+                       [list({client[1] for client in client_list})])
+        client_sorted = dict(cursor.fetchall())
+        cursor.close()
+        return self._order_by_billed(client_list, client_sorted)
+
+    @staticmethod
+    def _order_by_billed(client_list: list, client_sorted: dict) -> list:
+        """Return (request, billed total) pairs for the requests in
+        <client_list>, sorted by billed total, given the billed totals of
+        clients in <client_sorted>. Clients missing from <client_sorted> have
+        a billed total of 0.
+        """
         client_sorted_total = []
         for client in client_list:
             if client[1] in client_sorted:
@@ -273,67 +698,120 @@ class Assignment2:
         
         client_sorted_total = sorted(client_sorted_total, key=lambda x: x[1])
         # client_sorted_total = ([request_id, client_id, datetime, source, destination], amount)
-        cursor.close()
-        print(client_sorted_total)
         return client_sorted_total
 
 
+    @_operation
     def valid_drivers(self, nw: GeoLoc, se: GeoLoc) -> list:
+        """Return the drivers who can be dispatched, i.e. who are on an
+        ongoing shift, are not dispatched or on a ride, and whose most recent
+        recorded location is within the given bounds.
+        """
         cursor = self.connection.cursor()
-        cursor.execute("""SET SEARCH_PATH TO uber, public;""")
-        cursor.execute("""DROP VIEW IF EXISTS ongoing_drivers CASCADE;""")
-        ongoing_drivers_view = """
-        CREATE VIEW ongoing_drivers AS
-        SELECT driver_id, shift_id
-        FROM ClockedIn LEFT JOIN ClockedOut USING(shift_id)
-        WHERE ClockedOut.datetime IS NULL;
-        """
-        cursor.execute(ongoing_drivers_view)
-        cursor.execute("""DROP VIEW IF EXISTS non_driving_drivers CASCADE;""")
-        get_driving_drivers = """
-        CREATE VIEW non_driving_drivers AS
-        (SELECT shift_id
-        FROM ClockedIn) EXCEPT ALL 
-        (SELECT shift_id
-        FROM Dispatch NATURAL JOIN
-        ((SELECT request_id
-        FROM Dispatch) EXCEPT ALL
-        (SELECT request_id
-        FROM Dispatch JOIN Pickup USING(request_id) JOIN Dropoff USING(request_id))) Temp);
-        """
-        cursor.execute(get_driving_drivers)
-        cursor.execute("""DROP VIEW IF EXISTS recent_drivers CASCADE;""")
-        get_recent_drivers="""
-        CREATE VIEW recent_drivers AS
-        SELECT Location.shift_id, location
-        FROM LOCATION JOIN 
-        (SELECT shift_id, max(datetime)
-        FROM Location
-        GROUP BY shift_id) Temp
-        ON Temp.max = Location.datetime AND Location.shift_id = Temp.shift_id;
-        """
-        cursor.execute(get_recent_drivers)
-        valid_drivers="""
-        SELECT driver_id, shift_id, location
-        FROM recent_drivers NATURAL JOIN ongoing_drivers NATURAL JOIN non_driving_drivers;
-        """
-        cursor.execute(valid_drivers)
-        driver_list = []
-        for driver in cursor:
-            if float(driver[2].longitude) <= se.longitude and \
-            float(driver[2].longitude) >= nw.longitude and \
-            float(driver[2].latitude) <= nw.latitude and \
-            float(driver[2].latitude) >= se.latitude:
-                driver_list.append(driver)
-        print(driver_list)
+        box = self._box(nw, se)
+        if box is None:
+            cursor.close()
+            return []
+        cursor.execute(self._AVAILABLE_DRIVERS_IN_BOX, box)
+        driver_list = cursor.fetchall()
         cursor.close()
         return driver_list
 
+    def iter_clients_within_bounds(self, nw: GeoLoc, se: GeoLoc,
+                                   itersize: int = DEFAULT_ITERSIZE) \
+            -> Iterator[tuple]:
+        """Yield the clients that clients_within_bounds returns, one at a
+        time, without holding more than <itersize> of them in memory.
+
+        See _stream for how the rows are read.
+        """
+        box = self._box(nw, se)
+        if box is not None:
+            yield from self._stream(self._OPEN_REQUESTS_IN_BOX, box, itersize)
+
+    def iter_valid_drivers(self, nw: GeoLoc, se: GeoLoc,
+                           itersize: int = DEFAULT_ITERSIZE) \
+            -> Iterator[tuple]:
+        """Yield the drivers that valid_drivers returns, one at a time,
+        without holding more than <itersize> of them in memory.
+
+        See _stream for how the rows are read.
+        """
+        box = self._box(nw, se)
+        if box is not None:
+            yield from self._stream(self._AVAILABLE_DRIVERS_IN_BOX, box,
+                                    itersize)
+
+    def _stream(self, query: str, params: list,
+                itersize: int) -> Iterator[tuple]:
+        """Yield the rows of the query <query> with the parameters <params>,
+        fetched <itersize> rows at a time with a server-side (named) cursor.
+
+        The rows are read in the current transaction, which must stay open
+        until the generator is exhausted or closed. In pooled mode, a
+        connection is checked out for that long, unless the thread has one
+        already.
+        """
+        if self.pool is not None and \
+                getattr(self._local, "connection", None) is None:
+            with self.pool.connection() as conn:
+                yield from self._stream_on(conn, query, params, itersize)
+        else:
+            yield from self._stream_on(self.connection, query, params,
+                                       itersize)
+
+    @staticmethod
+    def _stream_on(conn: pg_ext.connection, query: str, params: list,
+                   itersize: int) -> Iterator[tuple]:
+        """Yield the rows of the query <query> with the parameters <params>,
+        fetched <itersize> rows at a time with a server-side cursor on the
+        connection <conn>.
+        """
+        with conn.cursor(f"a2_stream_{next(_cursor_ids)}") as cursor:
+            cursor.itersize = itersize
+            cursor.execute(query, params)
+            yield from cursor
+
+    def _top_billed_clients(self, clients: Iterable[tuple],
+                            count: int) -> list:
+        """Return the last <count> of the (request, billed total) pairs that
+        client_billed_totals would return for the requests in <clients>,
+        which are the only ones dispatch can serve with <count> drivers.
+
+        The requests are read, and their billed totals looked up, a batch at
+        a time, and only the best <count> are kept, so <clients> can be a
+        stream of any length.
+        """
+        batch_size = self.itersize or DEFAULT_ITERSIZE
+        rows = iter(clients)
+        # The best requests so far, as (billed total, position, request)
+        # triples with the worst first. The position in <clients> breaks ties
+        # the way client_billed_totals' stable sort does.
+        best = []
+        position = 0
+        with self.connection.cursor() as cursor:
+            while count:
+                batch = list(itertools.islice(rows, batch_size))
+                if not batch:
+                    break
+                cursor.execute(self._CLIENT_BILLS,
+                               [list({client[1] for client in batch})])
+                bills = dict(cursor.fetchall())
+                for client in batch:
+                    entry = (float(bills.get(client[1], 0)), position, client)
+                    position += 1
+                    if len(best) < count:
+                        heapq.heappush(best, entry)
+                    elif entry > best[0]:
+                        heapq.heapreplace(best, entry)
+        return [(client, billed) for billed, _, client in sorted(best)]
+
 
 
 
     # ======================= Driver-related methods ======================= #
 
+    @_operation
     def clock_in(self, driver_id: int, when: datetime, geo_loc: GeoLoc) -> bool:
         """Record the fact that the driver with id <driver_id> has declared that
         they are available to start their shift at date time <when> and with
@@ -341,7 +819,10 @@ class Assignment2:
         ClockedIn and the Location tables.
 
         If there are no rows are in the ClockedIn table, the id of the shift
-        is 1. Otherwise, it is the maximum current shift id + 1.
+        is 1. Otherwise, it is the maximum current shift id + 1. (Ids are
+        taken from a sequence, so clock-ins can run concurrently. An id taken
+        by a clock-in that rolls back, or by a shift that was deleted, is not
+        reused, unless ClockedIn was emptied by synthetic.clear.)
 
         A driver can NOT start a new shift if they have an ongoing shift.
 
@@ -353,23 +834,27 @@ class Assignment2:
         """
         try:
             cursor = self.connection.cursor()
-
-            cursor.execute("""SET SEARCH_PATH TO uber, public;""")
-            ongoing = self.ongoing_drivers(driver_id)
-            exists = self.real_drivers(driver_id)
+            self._statements.execute(cursor, "a2_validate_clock_in",
+                                     {"driver_id": driver_id})
+            exists, ongoing = cursor.fetchone()
 
             if ongoing or not exists:
                 cursor.close()
                 return False
             else:
-                get_max = """SELECT max(shift_id) FROM ClockedIn;"""
-                cursor.execute(get_max)
-                shift_id = int(cursor.fetchone()[0]) + 1
                 when = when.replace(second = 0, microsecond = 0)
-                cursor.execute("INSERT INTO ClockedIn VALUES (%s, %s, %s);", [shift_id, driver_id, when])
-                cursor.execute("INSERT INTO Location VALUES (%s, %s, %s);", [shift_id, when, geo_loc])
+                # The shift id comes from a sequence (see insert_shift in
+                # support.ddl), so concurrent clock-ins never get the same id.
+                self._statements.execute(
+                    cursor, "a2_insert_shift",
+                    {"driver_id": driver_id, "when": when,
+                     "location": geo_loc})
+                shift_id, xid = cursor.fetchone()
                 self.connection.commit()
                 cursor.close()
+                if self.driver_cache is not None:
+                    self.driver_cache.clocked_in(
+                        xid, shift_id, driver_id, geo_loc)
                 return True
 
             pass
@@ -379,6 +864,7 @@ class Assignment2:
             raise ex
             return False
 
+    @_operation
     def pick_up(self, driver_id: int, client_id: int, when: datetime) -> bool:
         """Record the fact that the driver with driver id <driver_id> has
         picked up the client with client id <client_id> at date time <when>.
@@ -401,16 +887,13 @@ class Assignment2:
         """
         try:
             cursor = self.connection.cursor()
-            cursor.execute("""SET SEARCH_PATH TO uber, public;""")
-            d_exists = self.real_drivers(driver_id)
-            c_exists = self.real_client(client_id)
-            ongoing = self.ongoing_drivers(driver_id)
-            dispatched = self.dispatched_drivers(driver_id, client_id)
-            pickedup = self.picked_up_driver(driver_id, client_id)
-            print(ongoing)
-            if ongoing and d_exists and c_exists and dispatched[1]:
+            d_exists, c_exists, ongoing, request_id = \
+                self.validate_pick_up(driver_id, client_id)
+            if ongoing and d_exists and c_exists and request_id != -1:
                 when = when.replace(second = 0, microsecond = 0)
-                cursor.execute("INSERT INTO Pickup VALUES (%s, %s)", [dispatched[0], when])
+                self._statements.execute(
+                    cursor, "a2_insert_pickup",
+                    {"request_id": request_id, "when": when})
                 self.connection.commit()
                 cursor.close()
                 return True
@@ -424,9 +907,229 @@ class Assignment2:
             raise ex
             return False
 
+    @_operation
+    def clock_in_many(self, events: Iterable[Tuple[int, datetime, GeoLoc]]) \
+            -> List[bool]:
+        """Record a batch of clock-ins, given as (driver_id, when, geo_loc)
+        triples, with the same effect as calling clock_in on each of them in
+        order. Return, for each event, whether clocking in was successful.
+
+        All the events are validated together in one query, the new rows are
+        written with COPY, and the batch is committed once. If anything goes
+        wrong while writing, the whole batch is rolled back and every event
+        is reported as failed.
+
+        Precondition:
+            - the events are in chronological order, and the first one is
+              after all dates currently recorded in the database.
+        """
+        events = list(events)
+        results = [False] * len(events)
+        if not events:
+            return results
+        try:
+            with self.connection.cursor() as cursor:
+                exists, ongoing = self._driver_states(
+                    cursor, {driver_id for driver_id, _, _ in events})
+                accepted = []
+                for k, (driver_id, when, geo_loc) in enumerate(events):
+                    if exists[driver_id] and not ongoing[driver_id]:
+                        ongoing[driver_id] = True
+                        results[k] = True
+                        accepted.append((driver_id,
+                                         when.replace(second=0, microsecond=0),
+                                         geo_loc))
+                if accepted:
+                    cursor.execute("SELECT sync_shift_id_seq();")
+                    cursor.execute(
+                        "SELECT nextval('shift_id_seq') "
+                        "FROM generate_series(1, %s);", [len(accepted)])
+                    shift_ids = [row[0] for row in cursor]
+                    self._copy(cursor, "ClockedIn",
+                               [(shift_id, driver_id, when)
+                                for shift_id, (driver_id, when, _)
+                                in zip(shift_ids, accepted)])
+                    self._copy(cursor, "Location",
+                               [(shift_id, when, geo_loc)
+                                for shift_id, (_, when, geo_loc)
+                                in zip(shift_ids, accepted)])
+                    xid = self._transaction_id(cursor)
+            self.connection.commit()
+            if self.driver_cache is not None and accepted:
+                for shift_id, (driver_id, _, geo_loc) in zip(shift_ids,
+                                                              accepted):
+                    self.driver_cache.clocked_in(
+                        xid, shift_id, driver_id, geo_loc)
+            return results
+        except pg.Error:
+            self.connection.rollback()
+            return [False] * len(events)
+
+    @_operation
+    def pick_up_many(self, events: Iterable[Tuple[int, int, datetime]]) \
+            -> List[bool]:
+        """Record a batch of pick-ups, given as (driver_id, client_id, when)
+        triples, with the same effect as calling pick_up on each of them in
+        order. Return, for each event, whether the pick up was successful.
+
+        All the events are validated together in one query, the new rows are
+        written with COPY, and the batch is committed once. If anything goes
+        wrong while writing, the whole batch is rolled back and every event
+        is reported as failed.
+
+        Precondition:
+            - the events are in chronological order, and the first one is
+              after all dates currently recorded in the database.
+        """
+        events = list(events)
+        results = [False] * len(events)
+        if not events:
+            return results
+        try:
+            with self.connection.cursor() as cursor:
+                pairs = list({(driver_id, client_id)
+                              for driver_id, client_id, _ in events})
+                expressions = ", ".join(
+                    expression % {"driver_id": "pair.driver_id",
+                                  "client_id": "pair.client_id"}
+                    for expression in (self._DRIVER_EXISTS,
+                                       self._CLIENT_EXISTS,
+                                       self._DRIVER_ON_SHIFT,
+                                       self._DISPATCHED_REQUESTS))
+                cursor.execute(
+                    f"""SELECT pair.driver_id, pair.client_id, {expressions}
+                    FROM unnest(%s::integer[], %s::integer[])
+                        AS pair(driver_id, client_id);""",
+                    [[driver_id for driver_id, _ in pairs],
+                     [client_id for _, client_id in pairs]])
+                outstanding = {}
+                for driver_id, client_id, d_exists, c_exists, ongoing, \
+                        request_ids in cursor:
+                    if d_exists and c_exists and ongoing:
+                        outstanding[(driver_id, client_id)] = request_ids
+
+                pickups = []
+                for k, (driver_id, client_id, when) in enumerate(events):
+                    request_ids = outstanding.get((driver_id, client_id))
+                    if request_ids:
+                        pickups.append((request_ids.pop(0),
+                                        when.replace(second=0, microsecond=0)))
+                        results[k] = True
+                self._copy(cursor, "Pickup", pickups)
+            self.connection.commit()
+            return results
+        except pg.Error:
+            self.connection.rollback()
+            return [False] * len(events)
+
+    @_operation
+    def record_locations(self, pings: Iterable[Tuple[int, datetime, GeoLoc]]) \
+            -> List[bool]:
+        """Record a batch of location reports from drivers, given as
+        (shift_id, when, geo_loc) triples meaning that the driver on the shift
+        with id <shift_id> was at <geo_loc> at date time <when>, by adding a
+        row to the Location table for each. Return, for each report, whether
+        it was recorded.
+
+        A report is recorded only if its shift is ongoing, and no location is
+        recorded for that shift at that date time yet (so of several reports
+        for the same shift and time, only the first is recorded). Since
+        drivers report their location every few seconds, <when> is recorded
+        as is, rather than to the minute.
+
+        The batch is written with one INSERT and committed once. If anything
+        goes wrong, the whole batch is rolled back and every report is
+        reported as not recorded.
+        """
+        pings = list(pings)
+        results = [False] * len(pings)
+        if not pings:
+            return results
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(
+                    """INSERT INTO Location
+                    SELECT DISTINCT ON (shift_id, datetime)
+                        shift_id, datetime, point(x, y)
+                    FROM unnest(%s::integer[], %s::timestamp[],
+                                %s::float8[], %s::float8[])
+                        WITH ORDINALITY AS ping(shift_id, datetime, x, y, k)
+                    WHERE EXISTS (SELECT 1 FROM ClockedIn
+                                  WHERE ClockedIn.shift_id = ping.shift_id)
+                        AND NOT EXISTS (SELECT 1 FROM ClockedOut
+                                        WHERE ClockedOut.shift_id =
+                                            ping.shift_id)
+                    ORDER BY shift_id, datetime, k
+                    ON CONFLICT DO NOTHING
+                    RETURNING shift_id, datetime;""",
+                    [[shift_id for shift_id, _, _ in pings],
+                     [when for _, when, _ in pings],
+                     [geo_loc.longitude for _, _, geo_loc in pings],
+                     [geo_loc.latitude for _, _, geo_loc in pings]])
+                recorded = set(cursor.fetchall())
+                xid = self._transaction_id(cursor)
+            self.connection.commit()
+            for k, (shift_id, when, _) in enumerate(pings):
+                if (shift_id, when) in recorded:
+                    recorded.remove((shift_id, when))
+                    results[k] = True
+            if self.driver_cache is not None:
+                self.driver_cache.relocated(
+                    xid,
+                    {shift_id for (shift_id, _, _), recorded_ping
+                     in zip(pings, results) if recorded_ping})
+            return results
+        except pg.Error:
+            self.connection.rollback()
+            return [False] * len(pings)
+
+    def _driver_states(self, cursor: pg_ext.cursor, driver_ids: set) \
+            -> Tuple[dict, dict]:
+        """Return two dicts mapping each driver id in <driver_ids> to whether
+        the driver exists (see real_drivers) and to whether they are on a
+        shift (see ongoing_drivers), looked up in one query.
+        """
+        expressions = ", ".join(
+            expression % {"driver_id": "driver.driver_id"}
+            for expression in (self._DRIVER_EXISTS, self._DRIVER_ON_SHIFT))
+        cursor.execute(
+            f"""SELECT driver.driver_id, {expressions}
+            FROM unnest(%s::integer[]) AS driver(driver_id);""",
+            [list(driver_ids)])
+        exists, ongoing = {}, {}
+        for driver_id, d_exists, d_ongoing in cursor:
+            exists[driver_id] = d_exists
+            ongoing[driver_id] = d_ongoing
+        return exists, ongoing
+
+    @staticmethod
+    def _copy(cursor: pg_ext.cursor, table: str, rows: list) -> None:
+        """Append <rows> to the table <table> with COPY.
+
+        Each row is a tuple of ints, datetimes and GeoLocs, in the order of
+        the columns of <table>.
+        """
+        if not rows:
+            return
+        lines = []
+        for row in rows:
+            fields = []
+            for value in row:
+                if isinstance(value, GeoLoc):
+                    fields.append(f"({value.longitude!r},{value.latitude!r})")
+                elif isinstance(value, datetime):
+                    fields.append(value.isoformat(sep=" "))
+                else:
+                    fields.append(str(value))
+            lines.append("\t".join(fields))
+        data = io.StringIO("\n".join(lines) + "\n")
+        cursor.copy_expert(f"COPY {table} FROM STDIN;", data)
+
     # ===================== Dispatcher-related methods ===================== #
 
-    def dispatch(self, nw: GeoLoc, se: GeoLoc, when: datetime) -> None:
+    @_operation
+    def dispatch(self, nw: GeoLoc, se: GeoLoc, when: datetime,
+                 optimal: bool = False, billing_weight: float = 0.0) -> None:
         """Dispatch drivers to the clients who have requested rides in the area
         bounded by <nw> and <se>, such that:
             - <nw> is the longitude and latitude in the northwest corner of this
@@ -462,6 +1165,18 @@ class Assignment2:
         location. In the case of a tie, any one of the tied drivers may be
         dispatched.
 
+        If <optimal> is True, the same clients get a driver, but instead of
+        each client in turn getting the closest driver left, the drivers are
+        assigned so that the total distance from the drivers to their
+        clients is as small as possible. A positive <billing_weight> makes
+        the distance to clients with higher billings count for more (see
+        matching.optimal_match). This needs numpy. Otherwise, if the
+        instance attribute <server_dispatch> is True, the whole dispatch runs
+        in the database, in a single roundtrip, with the same result. If the
+        instance attribute <concurrent_dispatch> is True, the drivers and
+        requests are claimed with row locks first, and those claimed by
+        other dispatches running at the same time are skipped.
+
         Dispatching a driver is accomplished by adding a row to the Dispatch
         table. The dispatch car location is the driver's most recent recorded
         location. All dispatching that results from a call to this method is
@@ -473,41 +1188,210 @@ class Assignment2:
         Precondition:
             - <when> is after all dates currently recorded in the database.
         """
+        self._dispatch(nw, se, when, optimal, billing_weight)
+
+    @_operation
+    def _dispatch(self, nw: GeoLoc, se: GeoLoc, when: datetime,
+                  optimal: bool = False, billing_weight: float = 0.0,
+                  owns: Optional[Callable[[GeoLoc], bool]] = None) -> int:
+        """Dispatch drivers as described in dispatch, and return how many
+        were dispatched.
+
+        If <owns> is given, only the drivers and clients (by request source)
+        whose locations it returns True for are considered, as if the others
+        were outside the area. See parallel_dispatch.py.
+        """
+        if self.concurrent_dispatch and owns is None:
+            return self._dispatch_claimed(nw, se, when, optimal,
+                                          billing_weight)
+        if self.server_dispatch and not optimal and owns is None:
+            return self._dispatch_in_database(nw, se, when)
         try:
             cursor = self.connection.cursor()
-            cursor.execute("""SET SEARCH_PATH TO uber, public;""")
-            clients = self.clients_within_bounds(nw, se)
-            client_list = self.client_billed_totals(clients)
-            driver_list = self.valid_drivers(nw, se)
-            while client_list != [] and driver_list != []:
-                client = client_list.pop()
-                c_lat = client[0][3].latitude
-                c_long = client[0][3].longitude
-                min_d = float('inf')
-                d = {}
-                for driver in driver_list:
-                    d_lat = driver[2].latitude
-                    d_long = driver[2].longitude
-                    distance = ((d_lat - c_lat)**2 + (d_long - c_long)**2)**(1/2)
-                    if distance <= min_d:
-                        min_d = distance
-                        d[distance] = driver
-                selected_driver = d[min_d]
-                driver_list.remove(selected_driver)
-                request_id = client[0][0]
-                shift_id = selected_driver[1]
-                car_location = selected_driver[2]
-                datetime = when.replace(second = 0, microsecond = 0)
-                cursor.execute("""INSERT INTO Dispatch VALUES (%s, %s, %s, %s)""", [request_id, shift_id, car_location, datetime])
+            if self.driver_cache is None:
+                driver_list = self.valid_drivers(nw, se)
+            else:
+                driver_list = self.driver_cache.available(
+                    self.connection, self._box(nw, se))
+            dispatches = self._choose_dispatches(
+                nw, se, when, driver_list, optimal, billing_weight, owns)
+            if self.driver_cache is not None and not \
+                    self.driver_cache.confirm(
+                        self.connection,
+                        [(shift_id, location)
+                         for _, shift_id, location, _ in dispatches]):
+                # The cache was out of date (e.g., a notification had not
+                # arrived yet), so choose again from the database.
+                driver_list = self.valid_drivers(nw, se)
+                dispatches = self._choose_dispatches(
+                    nw, se, when, driver_list, optimal, billing_weight, owns)
+            self._insert_dispatches(cursor, dispatches)
+            xid = self._transaction_id(cursor)
             cursor.close()
             self.connection.commit()
-            pass
+            if self.driver_cache is not None:
+                self.driver_cache.dispatched(
+                    xid, [row[1] for row in dispatches])
+            return len(dispatches)
         except pg.Error as ex:
             # You may find it helpful to uncomment this line while debugging,
             # as it will show you all the details of the error that occurred:
             self.connection.rollback()
             raise ex
-            return
+
+    def _transaction_id(self, cursor: pg_ext.cursor) -> Optional[int]:
+        """Return the id of the transaction open on the connection of
+        <cursor>, which the driver cache is told along with the changes the
+        transaction made (see driver_cache.py), or None if there is no
+        driver cache.
+        """
+        if self.driver_cache is None:
+            return None
+        cursor.execute("SELECT txid_current();")
+        return cursor.fetchone()[0]
+
+    def _insert_dispatches(self, cursor: pg_ext.cursor,
+                           dispatches: list) -> None:
+        """Insert the Dispatch rows <dispatches> using <cursor>."""
+        if dispatches:
+            # All the dispatches go out as a single INSERT.
+            request_ids, shift_ids, locations, times = zip(*dispatches)
+            self._statements.execute(
+                cursor, "a2_insert_dispatches",
+                {"request_ids": list(request_ids),
+                 "shift_ids": list(shift_ids),
+                 "locations": list(locations), "times": list(times)})
+
+    def _dispatch_claimed(self, nw: GeoLoc, se: GeoLoc, when: datetime,
+                          optimal: bool, billing_weight: float) -> int:
+        """Dispatch drivers as described in dispatch, claiming the drivers
+        and requests first, and return how many were dispatched.
+
+        The shifts of the drivers who can be dispatched are claimed by
+        locking their ClockedIn rows, and then as many of the requests with
+        the highest billings as there are claimed drivers, by locking their
+        Request rows. Rows locked by another dispatch are skipped (SKIP
+        LOCKED), so dispatches over overlapping areas never wait for each
+        other; each serves the drivers and requests it claimed. Claims last
+        until the dispatch commits or rolls back.
+
+        A dispatch that committed after the claimed rows were read, but
+        before they were locked, may already have dispatched them, so they
+        are checked again once they are locked. After that, no other
+        dispatch made this way can dispatch them, so no driver or request is
+        ever dispatched twice. (Dispatches made without
+        concurrent_dispatch do not claim rows, so they are not kept out.)
+
+        The rows are locked FOR NO KEY UPDATE, which does not conflict with
+        the locks foreign key checks take, so clock-ins, locations and
+        pick-ups are not held up by claims.
+        """
+        box = self._box(nw, se)
+        if box is None:
+            return 0
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(self._CLAIM_DRIVERS_IN_BOX, box)
+                claimed = [row[0] for row in cursor.fetchall()]
+                driver_list = []
+                if claimed:
+                    cursor.execute(self._CLAIMED_DRIVERS, box + [claimed])
+                    driver_list = cursor.fetchall()
+                client_list = []
+                if driver_list:
+                    cursor.execute(self._CLAIM_REQUESTS_IN_BOX,
+                                   box + [len(driver_list)])
+                    claimed = [row[0] for row in cursor.fetchall()]
+                    cursor.execute(self._CLAIMED_REQUESTS, [claimed])
+                    rows = cursor.fetchall()
+                    client_list = self._order_by_billed(
+                        [row[:-1] for row in rows],
+                        {row[1]: row[-1] for row in rows
+                         if row[-1] is not None})
+                dispatches = []
+                if client_list:
+                    dispatches = self._dispatch_rows(
+                        client_list, driver_list, when, optimal,
+                        billing_weight)
+                self._insert_dispatches(cursor, dispatches)
+                xid = self._transaction_id(cursor)
+            self.connection.commit()
+        except pg.Error as ex:
+            self.connection.rollback()
+            raise ex
+        if self.driver_cache is not None:
+            self.driver_cache.dispatched(
+                xid, [row[1] for row in dispatches])
+        return len(dispatches)
+
+    def _dispatch_in_database(self, nw: GeoLoc, se: GeoLoc,
+                              when: datetime) -> int:
+        """Dispatch drivers as described in dispatch, with greedy matching,
+        by calling dispatch_area (see support.ddl), and return how many were
+        dispatched.
+
+        The drivers are chosen from the database, even if there is a driver
+        cache; the cache is only told which drivers were dispatched.
+        """
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT dispatch_area(%s, %s, %s), txid_current();",
+                    [nw, se, when])
+                rows = cursor.fetchall()
+            self.connection.commit()
+        except pg.Error as ex:
+            self.connection.rollback()
+            raise ex
+        if self.driver_cache is not None and rows:
+            self.driver_cache.dispatched(rows[0][1],
+                                         [row[0] for row in rows])
+        return len(rows)
+
+    def _choose_dispatches(self, nw: GeoLoc, se: GeoLoc, when: datetime,
+                           driver_list: list, optimal: bool,
+                           billing_weight: float,
+                           owns: Optional[Callable[[GeoLoc], bool]] = None) \
+            -> list:
+        """Return the Dispatch rows that dispatch drivers from <driver_list>
+        to the clients in the area bounded by <nw> and <se>, as described in
+        dispatch. If <owns> is given, only the drivers and clients whose
+        locations it returns True for are considered.
+
+        Only as many clients as there are drivers are kept in memory, and if
+        itersize is set, the clients are streamed from the database.
+        """
+        if owns is not None:
+            driver_list = [driver for driver in driver_list
+                           if owns(driver[2])]
+        if not driver_list:
+            return []
+        if self.itersize is None:
+            clients = self.clients_within_bounds(nw, se)
+        else:
+            clients = self.iter_clients_within_bounds(nw, se, self.itersize)
+        if owns is not None:
+            clients = (client for client in clients if owns(client[3]))
+        client_list = self._top_billed_clients(clients, len(driver_list))
+        return self._dispatch_rows(client_list, driver_list, when, optimal,
+                                   billing_weight)
+
+    @staticmethod
+    def _dispatch_rows(client_list: list, driver_list: list, when: datetime,
+                       optimal: bool = False,
+                       billing_weight: float = 0.0) -> list:
+        """Return the Dispatch rows that dispatch drivers from <driver_list>
+        (as returned by valid_drivers) to the clients in <client_list> (as
+        returned by client_billed_totals) at date time <when>, matched as
+        described in dispatch.
+        """
+        dispatch_time = when.replace(second = 0, microsecond = 0)
+        if optimal:
+            pairs = optimal_match(client_list, driver_list, billing_weight)
+        else:
+            pairs = greedy_match(client_list, driver_list)
+        return [(client[0], driver[1], driver[2], dispatch_time)
+                for client, driver in pairs]
 
     # =======================     Helper methods     ======================= #
 
@@ -561,6 +1445,18 @@ class Assignment2:
             pg_ext.register_type(geo_loc_type)
             pg_ext.register_adapter(GeoLoc, adapt_geo_loc)
 
+    def _register_geo_loc_cast(self) -> None:
+        """Read geo_loc values from PostgreSQL with _cast_geo_loc, in place
+        of the cast registered by _register_geo_loc, since geo_loc values are
+        read for every driver and request a dispatch looks at.
+        """
+        with self.connection, self.connection.cursor() as cursor:
+            cursor.execute("SELECT NULL::geo_loc")
+            geo_loc_oid = cursor.description[0][1]
+
+        pg_ext.register_type(
+            pg_ext.new_type((geo_loc_oid,), "GeoLoc", _cast_geo_loc))
+
 
 def clockin_test_function() -> None:
     """A sample test function."""
@@ -659,7 +1555,7 @@ def client_within_bounds_test_function() -> None:
         # provided into your database.
         nw = GeoLoc(-5, 60)
         se = GeoLoc(10, 20)
-        a2.clients_within_bounds(nw, se)
+        print(a2.clients_within_bounds(nw, se))
        
     finally:
         a2.disconnect()
@@ -682,7 +1578,7 @@ def client_billed_test_function() -> None:
         nw = GeoLoc(-5, 60)
         se = GeoLoc(10, 20)
         client_list = a2.clients_within_bounds(nw, se)
-        a2.client_billed_totals(client_list)
+        print(a2.client_billed_totals(client_list))
        
     finally:
         a2.disconnect()
@@ -704,7 +1600,7 @@ def valid_drivers_test_function() -> None:
         # provided into your database.
         nw = GeoLoc(-5, 60)
         se = GeoLoc(10, 20)
-        a2.valid_drivers(nw, se)
+        print(a2.valid_drivers(nw, se))
        
     finally:
         a2.disconnect()
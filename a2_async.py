@@ -0,0 +1,512 @@
+"""
+Part2 of csc343 A2: An asyncio counterpart of Assignment2.
+csc343, Fall 2022
+University of Toronto
+
+AsyncAssignment2 offers clock_in, pick_up and dispatch as coroutines, so that
+one event loop can have many of them in flight at once, each on its own
+connection from an asyncio connection pool. They behave exactly like the
+methods of Assignment2 with the same names, and run the same SQL.
+
+The database driver is swappable: AsyncAssignment2 only needs the small
+AsyncConnection interface below. Psycopg2Connection implements it with
+psycopg2's asynchronous connections.
+
+Run on its own, this file tests AsyncAssignment2 with many calls in flight
+at once. WARNING: this replaces all the data in the database it is given.
+
+Usage:
+    python a2_async.py dbname username [password]
+"""
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import (Any, AsyncIterator, Awaitable, Callable, List, Optional,
+                    Tuple)
+import argparse
+import asyncio
+
+import psycopg2 as pg
+import psycopg2.extensions as pg_ext
+import psycopg2.extras as pg_extras
+
+from a2 import Assignment2, GeoLoc
+from connection_pool import PoolTimeout
+from synthetic import clear
+
+
+class AsyncConnection:
+    """A connection to a PostgreSQL database that can be used from asyncio.
+
+    This is the interface AsyncAssignment2 needs from a database driver.
+    Statements run in autocommit mode unless a transaction is started with
+    BEGIN. Parameters use psycopg2's %s placeholders, and geo_loc values are
+    read and written as GeoLoc objects.
+    """
+
+    @property
+    def closed(self) -> bool:
+        """Return whether this connection is closed."""
+        raise NotImplementedError
+
+    async def execute(self, sql: str, params: Any = None) -> List[tuple]:
+        """Run the statement <sql> with the parameters <params> and return
+        the rows it produced, or [] if it does not produce any.
+
+        Raise a pg.Error if the statement fails.
+        """
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        """Close this connection."""
+        raise NotImplementedError
+
+
+async def _wait(conn: pg_ext.connection) -> None:
+    """Wait, without blocking the event loop, until the asynchronous psycopg2
+    connection <conn> has finished what it is doing.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == pg_ext.POLL_OK:
+            return
+        if state == pg_ext.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == pg_ext.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise pg.OperationalError(f"bad poll state: {state}")
+        ready = loop.create_future()
+        add(conn.fileno(), ready.set_result, None)
+        try:
+            await ready
+        finally:
+            remove(conn.fileno())
+
+
+class Psycopg2Connection(AsyncConnection):
+    """An AsyncConnection made with psycopg2's asynchronous support.
+
+    === Private Attributes ===
+    _conn: the asynchronous psycopg2 connection.
+    """
+    _conn: pg_ext.connection
+
+    def __init__(self, conn: pg_ext.connection) -> None:
+        """Initialize this connection to wrap the asynchronous psycopg2
+        connection <conn>, which has finished connecting.
+        """
+        self._conn = conn
+
+    @classmethod
+    async def connect(cls, **kwargs: Any) -> 'Psycopg2Connection':
+        """Return a new connection, made with psycopg2.connect(**kwargs)."""
+        conn = pg.connect(async_=True, **kwargs)
+        await _wait(conn)
+        return cls(conn)
+
+    @property
+    def closed(self) -> bool:
+        """Return whether this connection is closed."""
+        return bool(self._conn.closed)
+
+    async def execute(self, sql: str, params: Any = None) -> List[tuple]:
+        """Run the statement <sql> with the parameters <params> and return
+        the rows it produced, or [] if it does not produce any.
+        """
+        cursor = self._conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            await _wait(self._conn)
+            return cursor.fetchall() if cursor.description is not None else []
+        finally:
+            cursor.close()
+
+    async def close(self) -> None:
+        """Close this connection."""
+        self._conn.close()
+
+
+class AsyncConnectionPool:
+    """A bounded pool of AsyncConnections, for use from one event loop.
+
+    Connections are made as they are needed. A connection that was in use
+    when an error happened is closed rather than reused.
+
+    === Instance Attributes ===
+    timeout: how long, in seconds, to wait for a connection when all of them
+        are in use, or None to wait for as long as it takes.
+
+    === Private Attributes ===
+    _connect: makes a new connection.
+    _idle: the connections that are not in use.
+    _slots: one slot per connection that may be in use at once.
+    """
+    timeout: Optional[float]
+    _connect: Callable[[], Awaitable[AsyncConnection]]
+    _idle: List[AsyncConnection]
+    _slots: asyncio.Semaphore
+
+    def __init__(self, connect: Callable[[], Awaitable[AsyncConnection]],
+                 maxconn: int, timeout: Optional[float] = None) -> None:
+        """Initialize this pool to make connections by awaiting <connect>(),
+        and to allow at most <maxconn> of them to be in use at once.
+        """
+        self.timeout = timeout
+        self._connect = connect
+        self._idle = []
+        self._slots = asyncio.Semaphore(maxconn)
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[AsyncConnection]:
+        """Use a connection from this pool for the duration of an async with
+        block.
+
+        Raise a PoolTimeout if none became available within the timeout.
+        """
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(
+                f"no connection available after {self.timeout} seconds")
+        try:
+            conn = None
+            while self._idle and conn is None:
+                conn = self._idle.pop()
+                if conn.closed:
+                    conn = None
+            if conn is None:
+                conn = await self._connect()
+            try:
+                yield conn
+            except BaseException:
+                await conn.close()
+                raise
+            if not conn.closed:
+                self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    async def close(self) -> None:
+        """Close every connection in this pool that is not in use."""
+        while self._idle:
+            await self._idle.pop().close()
+
+
+@asynccontextmanager
+async def _transaction(conn: AsyncConnection) -> AsyncIterator[None]:
+    """Run the body of an async with block in a transaction on <conn>, which
+    is committed if the block finishes and rolled back if it raises.
+    """
+    await conn.execute("BEGIN;")
+    try:
+        yield
+    except BaseException:
+        await conn.execute("ROLLBACK;")
+        raise
+    await conn.execute("COMMIT;")
+
+
+class AsyncAssignment2:
+    """An asyncio counterpart of Assignment2.
+
+    clock_in, pick_up and dispatch have the same arguments, return values and
+    rollback behaviour as the methods of Assignment2 with the same names.
+    Each call runs in its own transaction, on a connection from pool.
+
+    === Instance Attributes ===
+    pool: the pool of connections to the database, or None if not connected.
+
+    === Private Attributes ===
+    _connector: makes a new AsyncConnection from the keyword arguments of
+        psycopg2.connect.
+    """
+    pool: Optional[AsyncConnectionPool]
+    _connector: Callable[..., Awaitable[AsyncConnection]]
+
+    def __init__(self, connector: Callable[..., Awaitable[AsyncConnection]]
+                 = Psycopg2Connection.connect) -> None:
+        """Initialize this AsyncAssignment2 instance, with no database
+        connection yet. Connections will be made by <connector>.
+        """
+        self.pool = None
+        self._connector = connector
+
+    async def connect(self, dbname: str, username: str, password: str,
+                      maxconn: int = 20,
+                      timeout: Optional[float] = 30.0) -> bool:
+        """Set up a pool of connections to the database <dbname>, using the
+        username <username> and password <password>, that allows at most
+        <maxconn> connections in use at once. A call that finds them all in
+        use waits up to <timeout> seconds for one (or forever, if <timeout>
+        is None), and then raises a PoolTimeout.
+
+        Return True if the database could be reached, False otherwise.
+        """
+        # A (blocking) Assignment2 connection installs support.ddl and tells
+        # psycopg2 about geo_loc, for every connection made after it.
+        setup = Assignment2()
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(
+                None, setup.connect, dbname, username, password):
+            return False
+        setup.disconnect()
+
+        params = {"dbname": dbname, "user": username, "password": password,
+                  "options": "-c search_path=uber,public"}
+        self.pool = AsyncConnectionPool(lambda: self._connector(**params),
+                                        maxconn, timeout)
+        try:
+            async with self.pool.connection():
+                return True
+        except (pg.Error, OSError):
+            self.pool = None
+            return False
+
+    async def disconnect(self) -> bool:
+        """Close the connections to the database.
+
+        Return True if closing the connections was successful, False
+        otherwise.
+        """
+        try:
+            if self.pool is not None:
+                await self.pool.close()
+                self.pool = None
+            return True
+        except pg.Error:
+            return False
+
+    async def clock_in(self, driver_id: int, when: datetime,
+                       geo_loc: GeoLoc) -> bool:
+        """Record the fact that the driver with id <driver_id> has declared
+        that they are available to start their shift at date time <when> and
+        with starting location <geo_loc>. See Assignment2.clock_in.
+        """
+        async with self.pool.connection() as conn, _transaction(conn):
+            (exists, ongoing), = await conn.execute(
+                f"""SELECT {Assignment2._DRIVER_EXISTS},
+                    {Assignment2._DRIVER_ON_SHIFT};""",
+                {"driver_id": driver_id})
+            if ongoing or not exists:
+                return False
+            when = when.replace(second=0, microsecond=0)
+            (shift_id,), = await conn.execute(
+                "SELECT insert_shift(%s, %s);", [driver_id, when])
+            await conn.execute("INSERT INTO Location VALUES (%s, %s, %s);",
+                               [shift_id, when, geo_loc])
+            return True
+
+    async def pick_up(self, driver_id: int, client_id: int,
+                      when: datetime) -> bool:
+        """Record the fact that the driver with driver id <driver_id> has
+        picked up the client with client id <client_id> at date time <when>.
+        See Assignment2.pick_up.
+        """
+        async with self.pool.connection() as conn, _transaction(conn):
+            (d_exists, c_exists, ongoing, request_id), = await conn.execute(
+                f"""SELECT {Assignment2._DRIVER_EXISTS},
+                    {Assignment2._CLIENT_EXISTS},
+                    {Assignment2._DRIVER_ON_SHIFT},
+                    {Assignment2._DISPATCHED_REQUEST};""",
+                {"driver_id": driver_id, "client_id": client_id})
+            if not (ongoing and d_exists and c_exists) or request_id is None:
+                return False
+            when = when.replace(second=0, microsecond=0)
+            await conn.execute("INSERT INTO Pickup VALUES (%s, %s);",
+                               [request_id, when])
+            return True
+
+    async def dispatch(self, nw: GeoLoc, se: GeoLoc, when: datetime,
+                       optimal: bool = False,
+                       billing_weight: float = 0.0) -> None:
+        """Dispatch drivers to the clients who have requested rides in the
+        area bounded by <nw> and <se>, and record the dispatch time as
+        <when>. See Assignment2.dispatch, also for <optimal> and
+        <billing_weight>.
+
+        If an exception occurs during dispatch, rollback ALL changes.
+        """
+        async with self.pool.connection() as conn, _transaction(conn):
+            box = Assignment2._box(nw, se)
+            if box is None:
+                return
+            clients = await conn.execute(
+                Assignment2._OPEN_REQUESTS_IN_BOX, box)
+            bills = dict(await conn.execute(
+                Assignment2._CLIENT_BILLS,
+                [list({client[1] for client in clients})]))
+            client_list = Assignment2._order_by_billed(clients, bills)
+            driver_list = await conn.execute(
+                Assignment2._AVAILABLE_DRIVERS_IN_BOX, box)
+            dispatches = Assignment2._dispatch_rows(
+                client_list, driver_list, when, optimal, billing_weight)
+            if dispatches:
+                # All the dispatches go out as a single multi-row INSERT.
+                values = ", ".join(["(%s, %s, %s, %s)"] * len(dispatches))
+                await conn.execute(
+                    f"INSERT INTO Dispatch VALUES {values};",
+                    [value for row in dispatches for value in row])
+
+
+# The tests below use drivers and clients 1 to _TEST_DRIVERS. Driver k and
+# client k are in area k of their own, where the client has an open request.
+_TEST_DRIVERS = 20
+# A driver who is not in the test data.
+_MISSING_DRIVER = 989898
+# When the test data starts, and when the calls of the tests are made.
+_LOADED = datetime(2022, 1, 1)
+_NOW = datetime(2022, 1, 2, 9, 30)
+
+
+def _area(k: int) -> Tuple[GeoLoc, GeoLoc]:
+    """Return the north-west and south-east corners of test area <k>."""
+    return GeoLoc(-100 + 5 * k - 1, 41), GeoLoc(-100 + 5 * k + 1, 39)
+
+
+def _load_test_data(conn: pg_ext.connection) -> None:
+    """Replace the data in the database <conn> is connected to with the data
+    the tests below use, and commit.
+
+    Every test driver has a shift that has ended, so they exist but are not
+    on a shift, and driver _TEST_DRIVERS + 1 is like them but has no area.
+    """
+    drivers = range(1, _TEST_DRIVERS + 2)
+    with conn.cursor() as cursor:
+        clear(cursor)
+        pg_extras.execute_values(
+            cursor, "INSERT INTO Driver VALUES %s",
+            [(k, "Driver", str(k), _LOADED.date(), "Street", "Car", False)
+             for k in drivers])
+        pg_extras.execute_values(
+            cursor, "INSERT INTO ClockedIn VALUES %s",
+            [(k, k, _LOADED) for k in drivers])
+        pg_extras.execute_values(
+            cursor, "INSERT INTO ClockedOut VALUES %s",
+            [(k, _LOADED + timedelta(hours=8)) for k in drivers])
+        pg_extras.execute_values(
+            cursor, "INSERT INTO Client VALUES %s",
+            [(k, "Client", str(k), None)
+             for k in range(1, _TEST_DRIVERS + 1)])
+        pg_extras.execute_values(
+            cursor, "INSERT INTO Request VALUES %s",
+            [(k, k, _NOW - timedelta(hours=1),
+              f"({-100 + 5 * k + 0.1},40.1)", f"({-100 + 5 * k},45)")
+             for k in range(1, _TEST_DRIVERS + 1)])
+        cursor.execute("SELECT sync_shift_id_seq();")
+    conn.commit()
+
+
+async def _rows(a2: AsyncAssignment2, sql: str) -> List[tuple]:
+    """Return the rows of the query <sql>, run on a connection of <a2>."""
+    async with a2.pool.connection() as conn:
+        return await conn.execute(sql)
+
+
+async def _test_clock_ins(a2: AsyncAssignment2) -> None:
+    """Clock every test driver in at once, along with clock-ins that fail,
+    and check the results and the rows recorded.
+    """
+    # Made without the checks in GeoLoc.__init__, so that the database
+    # rejects it after the shift has been inserted.
+    nowhere = GeoLoc.__new__(GeoLoc)
+    nowhere.longitude, nowhere.latitude = 500.0, 40.0
+    calls = [a2.clock_in(k, _NOW, GeoLoc(-100 + 5 * k, 40))
+             for k in range(1, _TEST_DRIVERS + 1)]
+    calls += [a2.clock_in(_MISSING_DRIVER, _NOW, GeoLoc(0, 40))
+              for _ in range(10)]
+    calls.append(a2.clock_in(_TEST_DRIVERS + 1, _NOW, nowhere))
+    results = await asyncio.gather(*calls, return_exceptions=True)
+
+    assert results[:_TEST_DRIVERS] == [True] * _TEST_DRIVERS, results
+    assert results[_TEST_DRIVERS:-1] == [False] * 10, results
+    assert isinstance(results[-1], pg.Error), results[-1]
+    shifts = await _rows(a2, f"""
+        SELECT driver_id, ClockedIn.datetime, location[0], location[1]
+        FROM ClockedIn JOIN Location USING(shift_id)
+        WHERE ClockedIn.datetime > '{_LOADED}'
+        ORDER BY driver_id;""")
+    assert shifts == [(k, _NOW, -100.0 + 5 * k, 40.0)
+                      for k in range(1, _TEST_DRIVERS + 1)], shifts
+    # The failed clock-in inserted its shift before it failed; only that
+    # was rolled back.
+    failed = await _rows(a2, f"""
+        SELECT count(*) FROM ClockedIn
+        WHERE driver_id = {_TEST_DRIVERS + 1};""")
+    assert failed == [(1,)], failed
+    print(f"[ClockIn x{len(calls)}] ok")
+
+
+async def _test_dispatches(a2: AsyncAssignment2) -> None:
+    """Dispatch every test area at once, and check that each request was
+    given to the driver in its area.
+    """
+    await asyncio.gather(*[
+        a2.dispatch(*_area(k), _NOW + timedelta(minutes=5))
+        for k in range(1, _TEST_DRIVERS + 1)])
+    dispatches = await _rows(a2, f"""
+        SELECT request_id, driver_id, Dispatch.datetime
+        FROM Dispatch JOIN ClockedIn USING(shift_id)
+        ORDER BY request_id;""")
+    assert dispatches == [(k, k, _NOW + timedelta(minutes=5))
+                          for k in range(1, _TEST_DRIVERS + 1)], dispatches
+    print(f"[Dispatch x{_TEST_DRIVERS}] ok")
+
+
+async def _test_pick_ups(a2: AsyncAssignment2) -> None:
+    """Have every test driver pick up their client at once, along with pick
+    ups that fail, and check the results and the rows recorded.
+    """
+    when = _NOW + timedelta(minutes=10)
+    calls = [a2.pick_up(k, k, when) for k in range(1, _TEST_DRIVERS + 1)]
+    calls += [a2.pick_up(_MISSING_DRIVER, 1, when) for _ in range(10)]
+    # Driver 1 was not dispatched to client 2.
+    calls.append(a2.pick_up(1, 2, when))
+    results = await asyncio.gather(*calls)
+
+    assert results == [True] * _TEST_DRIVERS + [False] * 11, results
+    pick_ups = await _rows(a2, "SELECT * FROM Pickup ORDER BY request_id;")
+    assert pick_ups == [(k, when) for k in range(1, _TEST_DRIVERS + 1)], \
+        pick_ups
+    print(f"[PickUp x{len(calls)}] ok")
+
+
+def async_test_function(dbname: str, username: str, password: str) -> None:
+    """Test clock_in, dispatch and pick_up with many calls in flight at once,
+    on the database <dbname>, whose data is replaced with the test data.
+
+    Raise an AssertionError if a test fails.
+    """
+    # Connecting an Assignment2 installs support.ddl, which the test data
+    # relies on (e.g., sync_shift_id_seq), on a new database.
+    setup = Assignment2()
+    assert setup.connect(dbname, username, password), \
+        f"Could not connect to {dbname}"
+    try:
+        _load_test_data(setup.connection)
+    finally:
+        setup.disconnect()
+
+    async def run() -> None:
+        a2 = AsyncAssignment2()
+        assert await a2.connect(dbname, username, password, maxconn=10), \
+            f"Could not connect to {dbname}"
+        try:
+            await _test_clock_ins(a2)
+            await _test_dispatches(a2)
+            await _test_pick_ups(a2)
+        finally:
+            await a2.disconnect()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Test AsyncAssignment2 with concurrent calls. "
+                    "WARNING: this replaces all the data in the database.")
+    parser.add_argument("dbname")
+    parser.add_argument("username")
+    parser.add_argument("password", nargs="?", default="")
+    args = parser.parse_args()
+    async_test_function(args.dbname, args.username, args.password)
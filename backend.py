@@ -0,0 +1,55 @@
+"""
+Part2 of csc343 A2: The interface of a storage backend for Assignment2.
+csc343, Fall 2022
+University of Toronto
+
+Backend is what code that records and dispatches rides needs from where the
+data is kept. Assignment2 implements it on a PostgreSQL database, and
+MemoryBackend (see memory_backend.py) implements it with Python data
+structures, for unit tests and fast simulations of dispatch policies. Both
+must behave the same way; conformance.py checks that they do.
+
+Locations are GeoLoc objects (see a2.py), and rows are tuples with the
+columns of the tables of schema.ddl, in order.
+"""
+from datetime import datetime
+
+
+class Backend:
+    """Where the data of the ride-sharing application is kept, and the
+    operations on it. See Assignment2 for what each operation does.
+    """
+
+    def clock_in(self, driver_id: int, when: datetime,
+                 geo_loc: 'GeoLoc') -> bool:
+        """Record that the driver with id <driver_id> started a shift at
+        <when> at <geo_loc>, and return True, or return False if they cannot.
+        """
+        raise NotImplementedError
+
+    def pick_up(self, driver_id: int, client_id: int, when: datetime) -> bool:
+        """Record that the driver with id <driver_id> picked up the client
+        with id <client_id> at <when>, and return True, or return False if
+        they cannot.
+        """
+        raise NotImplementedError
+
+    def dispatch(self, nw: 'GeoLoc', se: 'GeoLoc', when: datetime,
+                 optimal: bool = False, billing_weight: float = 0.0) -> None:
+        """Dispatch drivers to the clients who have requested rides in the
+        area bounded by <nw> and <se>, at <when>.
+        """
+        raise NotImplementedError
+
+    def clients_within_bounds(self, nw: 'GeoLoc', se: 'GeoLoc') -> list:
+        """Return the Request rows of the requests in the area bounded by
+        <nw> and <se> that no driver has been dispatched to, by request_id.
+        """
+        raise NotImplementedError
+
+    def valid_drivers(self, nw: 'GeoLoc', se: 'GeoLoc') -> list:
+        """Return the (driver_id, shift_id, location) of the drivers who can
+        be dispatched and are in the area bounded by <nw> and <se>, by
+        shift_id.
+        """
+        raise NotImplementedError
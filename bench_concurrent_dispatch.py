@@ -0,0 +1,249 @@
+"""
+Part2 of csc343 A2: Stress test of concurrent dispatches.
+csc343, Fall 2022
+University of Toronto
+
+Fills the database with drivers on shifts and open requests at random places
+in REGION (see synthetic.py), and then runs N dispatchers at once, each in a
+process of its own with its own connection and concurrent_dispatch set (see
+Assignment2._dispatch_claimed). Each dispatcher calls dispatch a number of
+times, each time over a random area a tenth of the region across, so the
+areas of the dispatchers often overlap. This is done for each N
+given, with the data loaded again for each.
+
+After each run, it checks that no driver was dispatched twice (i.e., no
+shift has more than one of the dispatches made in the run) and that no
+dispatch failed (e.g., by dispatching a request that another dispatcher had
+dispatched, which violates the primary key of Dispatch). It reports the
+throughput of the dispatchers, in dispatch calls and in dispatched drivers
+per second, and the speedup in calls per second over the first N given.
+Every driver is dispatched at most once, so later calls find fewer drivers
+left, and runs with more dispatchers use up more of them; this is why the
+speedup is in calls rather than in drivers.
+
+With --unclaimed, the dispatchers run without concurrent_dispatch, to show
+what the claims prevent.
+
+It exits with status 1 if a run with concurrent_dispatch dispatched a driver
+twice or had a dispatch fail.
+
+WARNING: this replaces all the data in the database it is given.
+
+Usage:
+    python bench_concurrent_dispatch.py dbname username [password]
+        [--dispatchers N ...] [--drivers N] [--requests N] [--calls N]
+        [--seed S] [--unclaimed]
+"""
+from datetime import datetime, timedelta
+from typing import Dict, List
+import argparse
+import multiprocessing
+import random
+import sys
+import time
+
+import psycopg2 as pg
+import psycopg2.extras as pg_extras
+
+from a2 import Assignment2, GeoLoc
+from synthetic import REGION, clear
+
+# The time the shifts start and the requests are made.
+START = datetime(2022, 1, 1)
+
+# The fraction of the width and height of REGION the area of each dispatch
+# call covers.
+AREA = 0.1
+
+
+def load(conn: pg.extensions.connection, drivers: int, requests: int,
+         seed: int) -> None:
+    """Replace the data in the database <conn> is connected to with
+    <drivers> drivers on shifts and <requests> open requests by <requests>
+    // 2 clients, at random places in REGION, using the random seed <seed>,
+    and commit.
+    """
+    rnd = random.Random(seed)
+    min_x, min_y, max_x, max_y = REGION
+
+    def place() -> str:
+        return f"({rnd.uniform(min_x, max_x)},{rnd.uniform(min_y, max_y)})"
+
+    clients = max(1, requests // 2)
+    try:
+        with conn.cursor() as cursor:
+            clear(cursor)
+            pg_extras.execute_values(
+                cursor, "INSERT INTO Client VALUES %s",
+                [(i, "Client", str(i), None) for i in range(1, clients + 1)])
+            pg_extras.execute_values(
+                cursor, "INSERT INTO Driver VALUES %s",
+                [(i, "Driver", str(i), START.date(), "Street", "Car", False)
+                 for i in range(1, drivers + 1)])
+            pg_extras.execute_values(
+                cursor, "INSERT INTO ClockedIn VALUES %s",
+                [(i, i, START) for i in range(1, drivers + 1)])
+            pg_extras.execute_values(
+                cursor, "INSERT INTO Location VALUES %s",
+                [(i, START, place()) for i in range(1, drivers + 1)])
+            pg_extras.execute_values(
+                cursor, "INSERT INTO Request VALUES %s",
+                [(i, rnd.randint(1, clients), START, place(), place())
+                 for i in range(1, requests + 1)])
+            cursor.execute("SELECT sync_shift_id_seq();")
+        conn.commit()
+    except pg.Error:
+        conn.rollback()
+        raise
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("ANALYZE;")
+    finally:
+        conn.autocommit = autocommit
+
+
+def _dispatcher(args: argparse.Namespace, index: int, claimed: bool,
+                ready: multiprocessing.Barrier,
+                results: multiprocessing.Queue) -> None:
+    """Run dispatcher number <index> of a run, as given by the command line
+    arguments <args>, with concurrent_dispatch set to <claimed>, and put
+    (drivers dispatched, failed calls, error) on <results>.
+
+    Every dispatcher connects, and then waits at <ready> for the others, so
+    they all start dispatching at once.
+    """
+    a2 = Assignment2()
+    connected = a2.connect(args.dbname, args.username, args.password)
+    ready.wait()
+    if not connected:
+        results.put((0, 0, f"dispatcher {index} could not connect"))
+        return
+    a2.concurrent_dispatch = claimed
+    rnd = random.Random(args.seed * 1000 + index)
+    min_x, min_y, max_x, max_y = REGION
+    width, height = (max_x - min_x) * AREA, (max_y - min_y) * AREA
+    when = START + timedelta(hours=1)
+    dispatched = failed = 0
+    try:
+        for _ in range(args.calls):
+            x = rnd.uniform(min_x, max_x - width)
+            y = rnd.uniform(min_y, max_y - height)
+            try:
+                dispatched += a2._dispatch(GeoLoc(x, y + height),
+                                           GeoLoc(x + width, y), when)
+            except pg.Error:
+                failed += 1
+    finally:
+        a2.disconnect()
+    results.put((dispatched, failed, None))
+
+
+def run(args: argparse.Namespace, conn: pg.extensions.connection,
+        dispatchers: int, claimed: bool) -> Dict[str, object]:
+    """Load the data, run <dispatchers> dispatchers at once with
+    concurrent_dispatch set to <claimed>, as given by the command line
+    arguments <args>, and return the results of the run. <conn> is another
+    connection to the database.
+    """
+    load(conn, args.drivers, args.requests, args.seed)
+    ready = multiprocessing.Barrier(dispatchers + 1)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(
+        target=_dispatcher, args=(args, i, claimed, ready, results))
+        for i in range(dispatchers)]
+    for process in processes:
+        process.start()
+    ready.wait()
+    start = time.perf_counter()
+    outcomes = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - start
+    for process in processes:
+        process.join()
+    for _, _, error in outcomes:
+        if error is not None:
+            raise SystemExit(error)
+
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT count(*), count(DISTINCT shift_id) FROM Dispatch;""")
+        rows, shifts = cursor.fetchone()
+    conn.commit()
+    calls = dispatchers * args.calls
+    dispatched = sum(outcome[0] for outcome in outcomes)
+    return {"dispatchers": dispatchers, "claimed": claimed, "calls": calls,
+            "dispatched": dispatched, "seconds": elapsed,
+            "calls_per_second": calls / elapsed if elapsed else 0.0,
+            "dispatched_per_second":
+                dispatched / elapsed if elapsed else 0.0,
+            "doubled_drivers": rows - shifts,
+            "failed": sum(outcome[1] for outcome in outcomes),
+            "lost": dispatched - rows}
+
+
+def report(results: List[Dict[str, object]]) -> None:
+    """Print <results>, with the speedup of each run over the first run in
+    the same mode.
+    """
+    print(f"{'dispatchers':>11} {'mode':>9} {'calls':>6} {'dispatched':>10} "
+          f"{'seconds':>8} {'calls/s':>8} {'drivers/s':>9} {'speedup':>7} "
+          f"{'doubled':>7} {'failed':>6}")
+    first = {}
+    for result in results:
+        base = first.setdefault(result["claimed"], result)
+        speedup = result["calls_per_second"] / base["calls_per_second"] \
+            if base["calls_per_second"] else 0.0
+        mode = "claimed" if result["claimed"] else "unclaimed"
+        print(f"{result['dispatchers']:>11} {mode:>9} {result['calls']:>6} "
+              f"{result['dispatched']:>10} {result['seconds']:>8.3f} "
+              f"{result['calls_per_second']:>8.1f} "
+              f"{result['dispatched_per_second']:>9.1f} {speedup:>6.2f}x "
+              f"{result['doubled_drivers']:>7} {result['failed']:>6}")
+
+
+def main() -> None:
+    """Run the stress test as described at the top of this file."""
+    parser = argparse.ArgumentParser(
+        description="Run concurrent dispatchers over overlapping areas. "
+                    "WARNING: this replaces all the data in the database.")
+    parser.add_argument("dbname")
+    parser.add_argument("username")
+    parser.add_argument("password", nargs="?", default="")
+    parser.add_argument("--dispatchers", type=int, nargs="+",
+                        default=[1, 2, 4, 8])
+    parser.add_argument("--drivers", type=int, default=20000)
+    parser.add_argument("--requests", type=int, default=40000)
+    parser.add_argument("--calls", type=int, default=50,
+                        help="the number of calls each dispatcher makes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--unclaimed", action="store_true",
+                        help="also run without concurrent_dispatch")
+    args = parser.parse_args()
+
+    conn = pg.connect(dbname=args.dbname, user=args.username,
+                      password=args.password,
+                      options="-c search_path=uber,public")
+    results = []
+    try:
+        # Install support.ddl before any dispatcher connects, so they do not
+        # all wait to install it.
+        a2 = Assignment2()
+        if not a2.connect(args.dbname, args.username, args.password):
+            raise SystemExit(f"Could not connect to {args.dbname}")
+        a2.disconnect()
+        for claimed in [True, False] if args.unclaimed else [True]:
+            for dispatchers in args.dispatchers:
+                results.append(run(args, conn, dispatchers, claimed))
+                report(results[-1:])
+    finally:
+        conn.close()
+    print()
+    report(results)
+    broken = [result for result in results if result["claimed"] and (
+        result["doubled_drivers"] or result["failed"] or result["lost"])]
+    sys.exit(1 if broken else 0)
+
+
+if __name__ == '__main__':
+    main()
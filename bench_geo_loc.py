@@ -0,0 +1,86 @@
+"""
+Part2 of csc343 A2: Micro-benchmark of geo_loc decoding.
+csc343, Fall 2022
+University of Toronto
+
+Every geo_loc read from the database is turned into a GeoLoc by
+a2._cast_geo_loc. This decodes a million geo_loc values, as PostgreSQL writes
+them, with it and with the decoding a2 used before (a regular expression,
+and a dict-backed GeoLoc checked by __init__), and reports the time taken
+and the memory kept per decoded value. No database is needed.
+
+Usage:
+    python bench_geo_loc.py [number of values]
+"""
+from typing import Any, Callable, List, Optional
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+from a2 import _cast_geo_loc
+
+# The number of values decoded when none is given.
+DEFAULT_COUNT = 1000000
+
+
+class _LegacyGeoLoc:
+    """GeoLoc as it was before it had __slots__."""
+
+    def __init__(self, longitude: float, latitude: float) -> None:
+        self.longitude = longitude
+        self.latitude = latitude
+
+        assert -180.0 <= longitude <= 180.0, \
+            f"Invalid value for longitude: {longitude}"
+        assert -90.0 <= latitude <= 90.0, \
+            f"Invalid value for latitude: {latitude}"
+
+
+def _legacy_cast_geo_loc(value: Optional[str], *args: Any) \
+        -> Optional[_LegacyGeoLoc]:
+    """Decode <value> the way a2 did before _cast_geo_loc."""
+    if value is None:
+        return None
+    m = re.match(r"\(([^)]+),([^)]+)\)", value)
+
+    if m:
+        return _LegacyGeoLoc(float(m.group(1)), float(m.group(2)))
+    else:
+        raise ValueError(f"bad geo_loc representation: {value}")
+
+
+def make_values(count: int, seed: int = 0) -> List[str]:
+    """Return <count> random geo_loc values, as PostgreSQL writes them."""
+    rnd = random.Random(seed)
+    return [f"({round(rnd.uniform(-180, 180), 6)!r},"
+            f"{round(rnd.uniform(-90, 90), 6)!r})" for _ in range(count)]
+
+
+def measure(cast: Callable, values: List[str]) -> None:
+    """Print the time <cast> takes to decode <values>, and the memory kept
+    per decoded value.
+    """
+    start = time.perf_counter()
+    decoded = [cast(value, None) for value in values]
+    elapsed = time.perf_counter() - start
+    del decoded
+
+    sample = values[:100000]
+    tracemalloc.start()
+    decoded = [cast(value, None) for value in sample]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del decoded
+    print(f"{cast.__name__:>22}: {elapsed:6.2f} s, "
+          f"{elapsed / len(values) * 1e9:6.0f} ns/value, "
+          f"{size / len(sample):4.0f} bytes/value")
+
+
+if __name__ == '__main__':
+    values = make_values(int(sys.argv[1]) if len(sys.argv) > 1
+                         else DEFAULT_COUNT)
+    print(f"Decoding {len(values)} geo_loc values")
+    measure(_legacy_cast_geo_loc, values)
+    measure(_cast_geo_loc, values)
@@ -0,0 +1,92 @@
+"""
+Part2 of csc343 A2: Benchmark of the matching strategies used by dispatch.
+csc343, Fall 2022
+University of Toronto
+
+Compares greedy_match (each client in turn gets the closest driver left) with
+optimal_match (the least total distance) on synthetic regions, reporting the
+runtime of each and the total distance drivers have to cover to reach their
+clients. No database is needed.
+
+Each region has as many drivers as requests. Most requests come from a few
+dense hot spots (e.g., downtown and the airport), while drivers are spread
+more evenly, as that is where greedy matching tends to strand far-away
+drivers.
+
+Usage:
+    python bench_matching.py [number of requests ...]
+"""
+from typing import List, Tuple
+import random
+import sys
+import time
+
+from a2 import GeoLoc
+from matching import distance, greedy_match, optimal_match
+
+# The sizes of the regions benchmarked when none are given.
+DEFAULT_SIZES = [100, 500, 1000, 2000, 5000]
+
+
+def make_region(n: int, seed: int) -> Tuple[list, list]:
+    """Return a client list and a driver list for a synthetic region with <n>
+    requests and <n> drivers, shaped like the arguments of greedy_match.
+    """
+    rnd = random.Random(seed)
+    hot_spots = [(rnd.uniform(-79.6, -79.2), rnd.uniform(43.6, 43.8))
+                 for _ in range(3)]
+
+    def near_hot_spot() -> GeoLoc:
+        x, y = rnd.choice(hot_spots)
+        return GeoLoc(rnd.gauss(x, 0.02), rnd.gauss(y, 0.02))
+
+    def anywhere() -> GeoLoc:
+        return GeoLoc(rnd.uniform(-79.6, -79.2), rnd.uniform(43.6, 43.8))
+
+    client_list = []
+    for request_id in range(n):
+        source = near_hot_spot() if rnd.random() < 0.8 else anywhere()
+        request = (request_id, request_id, None, source, anywhere())
+        client_list.append((request, round(rnd.expovariate(1 / 50), 2)))
+    client_list.sort(key=lambda x: x[1])
+    driver_list = [(driver_id, driver_id,
+                    near_hot_spot() if rnd.random() < 0.3 else anywhere())
+                   for driver_id in range(n)]
+    return client_list, driver_list
+
+
+def total_distance(pairs: List[tuple]) -> float:
+    """Return the total distance from the drivers to the clients in the
+    (client, driver) pairs <pairs>.
+    """
+    return sum(distance(client[3].longitude, client[3].latitude,
+                        driver[2].longitude, driver[2].latitude)
+               for client, driver in pairs)
+
+
+def run(sizes: List[int]) -> None:
+    """Print the runtime and total distance of each matching strategy on a
+    region of each size in <sizes>.
+    """
+    print(f"{'requests':>8} {'greedy s':>9} {'greedy dist':>12} "
+          f"{'optimal s':>10} {'optimal dist':>13} {'saved':>6}")
+    for n in sizes:
+        client_list, driver_list = make_region(n, seed=n)
+
+        start = time.perf_counter()
+        greedy = greedy_match(client_list, driver_list)
+        greedy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        optimal = optimal_match(client_list, driver_list)
+        optimal_time = time.perf_counter() - start
+
+        greedy_dist = total_distance(greedy)
+        optimal_dist = total_distance(optimal)
+        saved = 1 - optimal_dist / greedy_dist if greedy_dist else 0.0
+        print(f"{n:>8} {greedy_time:>9.3f} {greedy_dist:>12.3f} "
+              f"{optimal_time:>10.3f} {optimal_dist:>13.3f} {saved:>6.1%}")
+
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,236 @@
+"""
+Part2 of csc343 A2: Benchmark of Assignment2 at scale.
+csc343, Fall 2022
+University of Toronto
+
+For each size, fills the database with that many rows of synthetic data
+(see synthetic.py), and then measures, one call at a time on one
+connection:
+    - clock_in, for drivers who are not on a shift,
+    - dispatch, over each cell of a grid laid over the region of the data,
+    - pick_up, for the clients the dispatches sent drivers to.
+For each operation, it reports how many calls it made, their throughput
+(calls per second), and their median and 99th percentile latency.
+
+WARNING: this replaces all the data in the database it is given.
+
+The results can be saved to a JSON file with --save, and compared with the
+results saved by an earlier run with --compare.
+
+Usage:
+    python bench_scale.py dbname username [password] [--rows N ...]
+        [--seed S] [--calls N] [--save FILE] [--compare FILE]
+"""
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+import argparse
+import json
+import math
+import subprocess
+import time
+
+import psycopg2 as pg
+
+from a2 import Assignment2, GeoLoc
+from synthetic import REGION, ROWS_PER_REQUEST, generate
+
+# The numbers of rows benchmarked when none are given.
+DEFAULT_ROWS = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+
+# The number of cells along each side of the grid dispatch is called on.
+GRID = 8
+
+
+def percentile(latencies: List[float], p: float) -> float:
+    """Return the <p> percentile (0 <= p <= 100) of <latencies>, by the
+    nearest-rank method.
+
+    >>> percentile([4.0, 1.0, 3.0, 2.0], 50)
+    2.0
+    """
+    ranked = sorted(latencies)
+    if not ranked:
+        return 0.0
+    return ranked[max(0, math.ceil(len(ranked) * p / 100) - 1)]
+
+
+def measure(name: str, rows: int, calls: List[Callable[[], object]]) \
+        -> Dict[str, object]:
+    """Run each of <calls> in turn, and return the result of benchmarking the
+    operation <name> with them on <rows> rows of data.
+    """
+    latencies = []
+    start = time.perf_counter()
+    for call in calls:
+        before = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - before)
+    elapsed = time.perf_counter() - start
+    return {"rows": rows, "operation": name, "calls": len(calls),
+            "throughput": len(calls) / elapsed if elapsed else 0.0,
+            "p50": percentile(latencies, 50), "p99": percentile(latencies, 99)}
+
+
+def run_size(args: argparse.Namespace, conn: pg.extensions.connection,
+             rows: int) -> List[Dict[str, object]]:
+    """Fill the database <conn> is connected to with about <rows> rows, and
+    return the results of benchmarking each operation of Assignment2 on them,
+    connected as given by the command line arguments <args>.
+    """
+    counts, now = generate(conn, max(1, rows // ROWS_PER_REQUEST), args.seed)
+    rows = sum(counts.values())
+    calls = args.calls
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT driver_id
+            FROM Driver
+            WHERE NOT EXISTS (SELECT 1
+                              FROM ClockedIn
+                              WHERE ClockedIn.driver_id = Driver.driver_id AND
+                                  NOT EXISTS (SELECT 1 FROM ClockedOut
+                                              WHERE ClockedOut.shift_id =
+                                                  ClockedIn.shift_id))
+            ORDER BY driver_id
+            LIMIT %s;""", [calls])
+        free = [driver_id for driver_id, in cursor]
+    conn.commit()
+
+    a2 = Assignment2()
+    if not a2.connect(args.dbname, args.username, args.password):
+        raise SystemExit(f"Could not connect to {args.dbname}")
+    try:
+        return _run_operations(a2, conn, rows, now, free, calls)
+    finally:
+        a2.disconnect()
+
+
+def _run_operations(a2: Assignment2, conn: pg.extensions.connection,
+                    rows: int, now: datetime, free: List[int],
+                    calls: int) -> List[Dict[str, object]]:
+    """Return the results of benchmarking each operation of <a2> on <rows>
+    rows of data that end at <now>, with up to <calls> calls each. <free> are
+    the ids of drivers who are not on a shift, and <conn> is another
+    connection to the database.
+    """
+    min_x, min_y, max_x, max_y = REGION
+    width, height = (max_x - min_x) / GRID, (max_y - min_y) / GRID
+    step = max(1, len(free))
+    results = [measure("clock_in", rows, [
+        lambda driver_id=driver_id, i=i: a2.clock_in(
+            driver_id, now, GeoLoc(min_x + width * (i % GRID + 0.5),
+                                   min_y + height * (i * GRID // step + 0.5)))
+        for i, driver_id in enumerate(free)])]
+
+    when = now + timedelta(minutes=1)
+    cells = [(GeoLoc(min_x + width * i, min_y + height * (j + 1)),
+              GeoLoc(min_x + width * (i + 1), min_y + height * j))
+             for i in range(GRID) for j in range(GRID)][:calls]
+    results.append(measure("dispatch", rows, [
+        lambda nw=nw, se=se: a2.dispatch(nw, se, when) for nw, se in cells]))
+
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT driver_id, client_id
+            FROM Dispatch JOIN Request USING(request_id)
+                JOIN ClockedIn USING(shift_id)
+            WHERE Dispatch.datetime >= %s
+            ORDER BY request_id
+            LIMIT %s;""", [now, calls])
+        pairs = cursor.fetchall()
+    conn.commit()
+    picked_up = now + timedelta(minutes=2)
+    results.append(measure("pick_up", rows, [
+        lambda driver_id=driver_id, client_id=client_id: a2.pick_up(
+            driver_id, client_id, picked_up)
+        for driver_id, client_id in pairs]))
+    return results
+
+
+def report(results: List[Dict[str, object]],
+           baseline: Optional[List[Dict[str, object]]] = None) -> None:
+    """Print <results>, compared with the results <baseline> of an earlier
+    run if it is given.
+    """
+    before = {(old["rows"], old["operation"]): old for old in baseline or []}
+    header = f"{'rows':>9} {'operation':>9} {'calls':>6} {'calls/s':>9} " \
+             f"{'p50 ms':>9} {'p99 ms':>9}"
+    if baseline is not None:
+        header += f" {'p50 was':>9} {'p99 was':>9} {'calls/s':>8}"
+    print(header)
+    for result in results:
+        line = f"{result['rows']:>9} {result['operation']:>9} " \
+               f"{result['calls']:>6} {result['throughput']:>9.1f} " \
+               f"{result['p50'] * 1000:>9.2f} {result['p99'] * 1000:>9.2f}"
+        old = _closest(before, result)
+        if old is not None:
+            change = result['throughput'] / old['throughput'] - 1 \
+                if old['throughput'] else 0.0
+            line += f" {old['p50'] * 1000:>9.2f} {old['p99'] * 1000:>9.2f} " \
+                    f"{change:>+8.0%}"
+        print(line)
+
+
+def _closest(before: Dict[tuple, Dict[str, object]],
+             result: Dict[str, object]) -> Optional[Dict[str, object]]:
+    """Return the result in <before> for the same operation as <result> with
+    the closest number of rows, if it is within 10% of it.
+    """
+    candidates = [old for (rows, operation), old in before.items()
+                  if operation == result["operation"] and
+                  abs(rows - result["rows"]) <= 0.1 * result["rows"]]
+    return min(candidates, key=lambda old: abs(old["rows"] - result["rows"]),
+               default=None)
+
+
+def _revision() -> Optional[str]:
+    """Return the git commit the code is at, or None if it is unknown."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    """Run the benchmark as described at the top of this file."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark Assignment2 on synthetic data. WARNING: this "
+                    "replaces all the data in the database.")
+    parser.add_argument("dbname")
+    parser.add_argument("username")
+    parser.add_argument("password", nargs="?", default="")
+    parser.add_argument("--rows", type=int, nargs="+", default=DEFAULT_ROWS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--calls", type=int, default=200,
+                        help="the most calls made to each operation")
+    parser.add_argument("--save", help="a JSON file to save the results to")
+    parser.add_argument("--compare",
+                        help="a JSON file saved by an earlier run")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+    conn = pg.connect(dbname=args.dbname, user=args.username,
+                      password=args.password,
+                      options="-c search_path=uber,public")
+    results = []
+    try:
+        for rows in args.rows:
+            results.extend(run_size(args, conn, rows))
+            report(results[-3:], baseline)
+    finally:
+        conn.close()
+    print()
+    report(results, baseline)
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"revision": _revision(),
+                       "when": datetime.now().isoformat(timespec="seconds"),
+                       "seed": args.seed, "results": results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
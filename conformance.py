@@ -0,0 +1,408 @@
+"""
+Part2 of csc343 A2: Conformance suite for the storage backends.
+csc343, Fall 2022
+University of Toronto
+
+Runs the same cases against MemoryBackend (see memory_backend.py) and, if a
+database is given, against Assignment2 on that database. Each case loads the
+same rows into the backend, calls operations on it, and checks what each
+call returns and which rows the backend has at the end.
+
+With a database, it also runs random operations on random data against both
+backends side by side, and checks that they always agree. All of this is
+done three times on the database: with dispatch run from Python, run in the
+database (see Assignment2.server_dispatch), and claiming rows (see
+Assignment2.concurrent_dispatch).
+
+WARNING: with a database, this replaces all the data in it.
+
+Usage:
+    python conformance.py [dbname username [password]] [--seeds N]
+"""
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, Tuple
+import argparse
+import random
+import sys
+
+import psycopg2.extras as pg_extras
+
+from a2 import Assignment2, GeoLoc
+from backend import Backend
+from memory_backend import TABLES, MemoryBackend
+from synthetic import clear
+
+# Loads the given rows into a new or emptied backend, and returns the backend
+# and a function that returns the rows of a table of it, by primary key.
+Make = Callable[[Dict[str, List[tuple]]],
+                Tuple[Backend, Callable[[str], List[tuple]]]]
+
+# The tables the operations change, whose rows are compared.
+CHANGED = ("ClockedIn", "Location", "Dispatch", "Pickup")
+
+# The ways Assignment2 can dispatch, which are each checked on their own.
+MODES = ({}, {"server_dispatch": True}, {"concurrent_dispatch": True})
+
+# The start of the shifts in the world the cases start from, the day before,
+# and two times after all of its data.
+T0 = datetime(2022, 6, 1, 9, 0)
+Y = T0 - timedelta(days=1)
+T1 = datetime(2022, 6, 1, 10, 0, 42)
+T2 = datetime(2022, 6, 1, 10, 7, 5)
+
+
+def _minute(when: datetime) -> datetime:
+    """Return <when> without its seconds."""
+    return when.replace(second=0, microsecond=0)
+
+
+def world() -> Dict[str, List[tuple]]:
+    """Return the rows of the world the cases start from.
+
+    Driver 3 worked a shift (shift 1) yesterday, which has ended, and gave
+    rides to client 2 (billed 20.0) and client 1 (billed 5.0); they were
+    also dispatched to client 3, who was never picked up. Drivers 1 and 2
+    are on shifts 2 and 3, at (1, 1) and (5, 5). Driver 4 has never clocked
+    in. Clients 1, 2 and 3 are waiting at (1, 1.5), (4, 4) and (10, 10), and
+    client 4 has never requested a ride.
+    """
+    hour = timedelta(hours=1)
+    minutes = timedelta(minutes=1)
+    return {
+        "Client": [(i, f"Surname{i}", f"Name{i}", f"c{i}@example.com")
+                   for i in range(1, 5)],
+        "Driver": [(i, f"Surname{i}", f"Name{i}", date(1990, 1, i),
+                    f"{i} Main St", f"CAR{i}", i % 2 == 0)
+                   for i in range(1, 5)],
+        "Request": [
+            (10, 2, Y + hour, GeoLoc(2, 2), GeoLoc(3, 3)),
+            (11, 1, Y + 2 * hour, GeoLoc(3, 3), GeoLoc(2, 2)),
+            (12, 3, Y + 3 * hour, GeoLoc(3, 3), GeoLoc(4, 4)),
+            (1, 1, T0 + 10 * minutes, GeoLoc(1, 1.5), GeoLoc(3, 3)),
+            (2, 2, T0 + 11 * minutes, GeoLoc(4, 4), GeoLoc(0, 0)),
+            (3, 3, T0 + 12 * minutes, GeoLoc(10, 10), GeoLoc(0, 0))],
+        "ClockedIn": [(1, 3, Y), (2, 1, T0), (3, 2, T0)],
+        "ClockedOut": [(1, Y + 8 * hour)],
+        "Location": [(1, Y, GeoLoc(2, 2)), (1, Y + 4 * hour, GeoLoc(3, 3)),
+                     (2, T0, GeoLoc(0, 0)), (2, T0 + 5 * minutes, GeoLoc(1, 1)),
+                     (3, T0, GeoLoc(5, 5))],
+        "Dispatch": [(10, 1, GeoLoc(2, 2), Y + hour),
+                     (11, 1, GeoLoc(3, 3), Y + 2 * hour),
+                     (12, 1, GeoLoc(3, 3), Y + 3 * hour)],
+        "Pickup": [(10, Y + hour + 5 * minutes),
+                   (11, Y + 2 * hour + 5 * minutes)],
+        "Dropoff": [(10, Y + hour + 20 * minutes),
+                    (11, Y + 2 * hour + 20 * minutes)],
+        "Billed": [(10, 20.0), (11, 5.0)],
+    }
+
+
+def _with(table: str, *rows: tuple) -> List[tuple]:
+    """Return the rows of <table> in world(), with <rows> added, by primary
+    key.
+    """
+    return sorted(world()[table] + list(rows),
+                  key=lambda row: (row[0], row[1]))
+
+
+_REQUEST_1, _REQUEST_2, _REQUEST_3 = world()["Request"][3:]
+_EVERYWHERE = (GeoLoc(0, 10), GeoLoc(10, 0))
+
+# The cases: for each, a description, the operations to call with their
+# arguments and what they should return, and the rows some of the tables in
+# CHANGED should have at the end. Every case starts from world().
+CASES = [
+    ("clock_in: a driver who has never clocked in cannot",
+     [("clock_in", (4, T1, GeoLoc(0, 0)), False)],
+     {"ClockedIn": _with("ClockedIn"), "Location": _with("Location")}),
+    ("clock_in: a driver on a shift cannot",
+     [("clock_in", (1, T1, GeoLoc(0, 0)), False)],
+     {"ClockedIn": _with("ClockedIn")}),
+    ("clock_in: a new shift gets the next id, at the minute",
+     [("clock_in", (3, T1, GeoLoc(2, 2)), True),
+      ("clock_in", (3, T2, GeoLoc(2, 2)), False)],
+     {"ClockedIn": _with("ClockedIn", (4, 3, _minute(T1))),
+      "Location": _with("Location", (4, _minute(T1), GeoLoc(2, 2)))}),
+    ("clients_within_bounds: open requests only, bounds inclusive",
+     [("clients_within_bounds", (GeoLoc(0, 5), GeoLoc(5, 0)),
+       [_REQUEST_1, _REQUEST_2]),
+      ("clients_within_bounds", (GeoLoc(1, 1.5), GeoLoc(1, 1.5)),
+       [_REQUEST_1]),
+      ("clients_within_bounds", (GeoLoc(5, 0), GeoLoc(0, 5)), [])],
+     {}),
+    ("valid_drivers: free drivers on a shift, at their latest location",
+     [("valid_drivers", _EVERYWHERE,
+       [(1, 2, GeoLoc(1, 1)), (2, 3, GeoLoc(5, 5))]),
+      ("valid_drivers", (GeoLoc(0, 0.5), GeoLoc(0.5, 0)), []),
+      ("valid_drivers", (GeoLoc(1, 1), GeoLoc(1, 1)),
+       [(1, 2, GeoLoc(1, 1))])],
+     {}),
+    ("dispatch: the client with the highest billings is served first",
+     [("dispatch", (GeoLoc(0, 4.5), GeoLoc(4.5, 0), T1), None),
+      ("clients_within_bounds", _EVERYWHERE, [_REQUEST_1, _REQUEST_3]),
+      ("valid_drivers", _EVERYWHERE, [(2, 3, GeoLoc(5, 5))])],
+     {"Dispatch": _with("Dispatch", (2, 2, GeoLoc(1, 1), _minute(T1)))}),
+    ("dispatch: each client gets the closest driver left",
+     [("dispatch", _EVERYWHERE + (T1,), None)],
+     {"Dispatch": _with("Dispatch", (1, 2, GeoLoc(1, 1), _minute(T1)),
+                        (2, 3, GeoLoc(5, 5), _minute(T1)))}),
+    ("dispatch: a driver is busy until the ride is dropped off",
+     [("dispatch", (GeoLoc(0, 4.5), GeoLoc(4.5, 0), T1), None),
+      ("pick_up", (1, 2, T2), True),
+      ("valid_drivers", _EVERYWHERE, [(2, 3, GeoLoc(5, 5))]),
+      ("dispatch", _EVERYWHERE + (T2,), None)],
+     {"Dispatch": _with("Dispatch", (1, 3, GeoLoc(5, 5), _minute(T2)),
+                        (2, 2, GeoLoc(1, 1), _minute(T1))),
+      "Pickup": _with("Pickup", (2, _minute(T2)))}),
+    ("pick_up: only a dispatched client, and only once",
+     [("dispatch", (GeoLoc(0, 4.5), GeoLoc(4.5, 0), T1), None),
+      ("pick_up", (1, 1, T2), False),
+      ("pick_up", (4, 2, T2), False),
+      ("pick_up", (1, 4, T2), False),
+      ("pick_up", (1, 2, T2), True),
+      ("pick_up", (1, 2, T2), False)],
+     {"Pickup": _with("Pickup", (2, _minute(T2)))}),
+    ("pick_up: not by a driver whose shift has ended, until they clock in",
+     [("pick_up", (3, 3, T1), False),
+      ("clock_in", (3, T1, GeoLoc(3, 3)), True),
+      ("pick_up", (3, 3, T2), True)],
+     {"Pickup": _with("Pickup", (12, _minute(T2)))}),
+]
+
+
+def plain(value: Any) -> Any:
+    """Return <value> with every GeoLoc in it replaced by its (longitude,
+    latitude), and every list or tuple by a tuple, so it can be compared.
+
+    >>> plain([(1, GeoLoc(2.0, 3.0))])
+    ((1, (2.0, 3.0)),)
+    """
+    if isinstance(value, GeoLoc):
+        return value.longitude, value.latitude
+    if isinstance(value, (list, tuple)):
+        return tuple(plain(item) for item in value)
+    return value
+
+
+def run_cases(make: Make) -> List[str]:
+    """Return a description of each way the backends made by <make> fail
+    the cases in CASES.
+    """
+    failures = []
+    for name, steps, expected in CASES:
+        backend, rows = make(world())
+        for method, args, result in steps:
+            got = getattr(backend, method)(*args)
+            if plain(got) != plain(result):
+                failures.append(f"{name}: {method}{plain(args)} returned "
+                                f"{plain(got)}, not {plain(result)}")
+                break
+        else:
+            for table, table_rows in expected.items():
+                if plain(rows(table)) != plain(table_rows):
+                    failures.append(f"{name}: {table} is {plain(rows(table))},"
+                                    f" not {plain(table_rows)}")
+    return failures
+
+
+def random_world(rnd: random.Random) -> Tuple[Dict[str, List[tuple]],
+                                               datetime]:
+    """Return the rows of a random world, and a time after all of them,
+    using <rnd>.
+
+    Locations are on a small grid, so that drivers are often equally close
+    to a client.
+    """
+    def spot() -> GeoLoc:
+        return GeoLoc(rnd.randint(0, 6) / 2, rnd.randint(0, 6) / 2)
+
+    tables = {table: [] for table in TABLES}
+    tables["Client"] = [(i, f"S{i}", f"N{i}", None) for i in range(1, 9)]
+    tables["Driver"] = [(i, f"S{i}", f"N{i}", date(1990, 1, 1), "A", "V",
+                         False) for i in range(1, 9)]
+    now = datetime(2022, 1, 1)
+    shift_id = request_id = 0
+    for driver_id in range(1, 8):
+        for _ in range(rnd.randint(0, 2)):
+            shift_id += 1
+            now += timedelta(minutes=rnd.randint(1, 30))
+            tables["ClockedIn"].append((shift_id, driver_id, now))
+            tables["Location"].append((shift_id, now, spot()))
+            for _ in range(rnd.randint(0, 2)):
+                request_id += 1
+                now += timedelta(minutes=rnd.randint(1, 30))
+                client_id = rnd.randint(1, 7)
+                tables["Request"].append((request_id, client_id, now, spot(),
+                                          spot()))
+                tables["Dispatch"].append((request_id, shift_id, spot(), now))
+                stage = rnd.random()
+                if stage < 0.8:
+                    tables["Pickup"].append((request_id, now))
+                if stage < 0.6:
+                    tables["Dropoff"].append((request_id, now))
+                    tables["Billed"].append((request_id,
+                                             rnd.randint(10, 200) / 4))
+                now += timedelta(minutes=1)
+                tables["Location"].append((shift_id, now, spot()))
+            if rnd.random() < 0.5:
+                now += timedelta(minutes=1)
+                tables["ClockedOut"].append((shift_id, now))
+    for _ in range(12):
+        request_id += 1
+        now += timedelta(minutes=1)
+        tables["Request"].append((request_id, rnd.randint(1, 8), now, spot(),
+                                  spot()))
+    return tables, now + timedelta(minutes=1)
+
+
+def random_steps(rnd: random.Random, start: datetime,
+                 count: int) -> List[Tuple[str, tuple]]:
+    """Return <count> random operations to call, with their arguments, on a
+    world made by random_world that ends before <start>, using <rnd>.
+    """
+    steps = []
+    when = start
+    for _ in range(count):
+        when += timedelta(minutes=1, seconds=rnd.randint(0, 59))
+        driver_id, client_id = rnd.randint(1, 9), rnd.randint(1, 9)
+        west, east = sorted(rnd.randint(0, 6) / 2 for _ in range(2))
+        south, north = sorted(rnd.randint(0, 6) / 2 for _ in range(2))
+        nw, se = GeoLoc(west, north), GeoLoc(east, south)
+        steps.append(rnd.choice([
+            ("clock_in", (driver_id, when, GeoLoc(west, south))),
+            ("pick_up", (driver_id, client_id, when)),
+            ("dispatch", (nw, se, when)),
+            ("clients_within_bounds", (nw, se)),
+            ("valid_drivers", (nw, se))]))
+    return steps
+
+
+def run_random(make: Make, seed: int, count: int = 80) -> List[str]:
+    """Return a description of each way the backend made by <make> differs
+    from a MemoryBackend, on the random world and operations of <seed>.
+    """
+    rnd = random.Random(seed)
+    tables, start = random_world(rnd)
+    backend, rows = make(tables)
+    memory, memory_rows = memory_backend(tables)
+    for method, args in random_steps(rnd, start, count):
+        got = getattr(backend, method)(*args)
+        wanted = getattr(memory, method)(*args)
+        if plain(got) != plain(wanted):
+            return [f"seed {seed}: {method}{plain(args)} returned "
+                    f"{plain(got)}, not {plain(wanted)}"]
+    return [f"seed {seed}: {table} differs" for table in CHANGED
+            if plain(rows(table)) != plain(memory_rows(table))]
+
+
+def memory_backend(tables: Dict[str, List[tuple]]) \
+        -> Tuple[Backend, Callable[[str], List[tuple]]]:
+    """Return a new MemoryBackend with the rows in <tables>, and its rows
+    method.
+    """
+    backend = MemoryBackend()
+    backend.load(tables)
+    return backend, backend.rows
+
+
+class DatabaseBackends:
+    """Makes Assignment2 backends for the conformance suite, on a database
+    whose data is replaced for each one.
+
+    === Instance Attributes ===
+    name: what the backends are called in reports.
+
+    === Private Attributes ===
+    _a2: the Assignment2 connected to the database.
+    """
+    name: str
+    _a2: Assignment2
+
+    def __init__(self, dbname: str, username: str, password: str,
+                 **modes: bool) -> None:
+        """Initialize this maker, connected to the database <dbname> using
+        the username <username> and password <password>. The backends have
+        the attributes given by <modes> (e.g., server_dispatch=True).
+
+        Raise a ConnectionError if the connection cannot be made.
+        """
+        self._a2 = Assignment2()
+        if not self._a2.connect(dbname, username, password):
+            raise ConnectionError(f"could not connect to {dbname}")
+        for mode, value in modes.items():
+            setattr(self._a2, mode, value)
+        self.name = "Assignment2" + \
+            "".join(f" ({mode})" for mode, value in modes.items() if value)
+
+    def close(self) -> None:
+        """Close the connection to the database."""
+        self._a2.disconnect()
+
+    def __call__(self, tables: Dict[str, List[tuple]]) \
+            -> Tuple[Backend, Callable[[str], List[tuple]]]:
+        """Replace the data in the database with the rows in <tables>, and
+        return the Assignment2 connected to it, and a function that returns
+        the rows of a table.
+        """
+        conn = self._a2.connection
+        with conn.cursor() as cursor:
+            clear(cursor)
+            for table in TABLES:
+                if tables.get(table):
+                    pg_extras.execute_values(
+                        cursor, f"INSERT INTO {table} VALUES %s",
+                        tables[table])
+            cursor.execute("SELECT sync_shift_id_seq();")
+        conn.commit()
+        return self._a2, self._rows
+
+    def _rows(self, table: str) -> List[tuple]:
+        """Return the rows of <table>, by primary key."""
+        conn = self._a2.connection
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT * FROM {table} ORDER BY 1, 2;")
+            rows = cursor.fetchall()
+        conn.commit()
+        return rows
+
+
+def _report(name: str, failures: List[str]) -> None:
+    """Print whether the run <name> passed, and its <failures>."""
+    print(f"{name}: {'FAIL' if failures else 'ok'}")
+    for failure in failures:
+        print(f"    {failure}")
+
+
+def main() -> None:
+    """Run the suite as described at the top of this file."""
+    parser = argparse.ArgumentParser(
+        description="Check that the storage backends behave the same. "
+                    "WARNING: this replaces all the data in the database.")
+    parser.add_argument("dbname", nargs="?")
+    parser.add_argument("username", nargs="?")
+    parser.add_argument("password", nargs="?", default="")
+    parser.add_argument("--seeds", type=int, default=20,
+                        help="the number of random runs")
+    args = parser.parse_args()
+
+    failures = run_cases(memory_backend)
+    _report("MemoryBackend cases", failures)
+    for modes in (MODES if args.dbname else []):
+        database = DatabaseBackends(args.dbname, args.username or "",
+                                    args.password, **modes)
+        try:
+            found = run_cases(database)
+            _report(f"{database.name} cases", found)
+            failures.extend(found)
+            found = [failure for seed in range(args.seeds)
+                     for failure in run_random(database, seed)]
+            _report(f"{database.name} and MemoryBackend on {args.seeds} "
+                    f"random runs", found)
+            failures.extend(found)
+        finally:
+            database.close()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
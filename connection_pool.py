@@ -0,0 +1,120 @@
+"""
+Part2 of csc343 A2: A bounded connection pool for Assignment2.
+csc343, Fall 2022
+University of Toronto
+
+psycopg2's ThreadedConnectionPool is thread-safe, but it fails right away
+when all of its connections are checked out, and it hands out connections
+without checking that they still work. ConnectionPool adds both: callers
+wait (up to a timeout) for a connection to be returned, and connections that
+are closed or broken are replaced before they are handed out.
+"""
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+import threading
+
+import psycopg2 as pg
+import psycopg2.extensions as pg_ext
+import psycopg2.pool as pg_pool
+
+
+class PoolTimeout(pg_pool.PoolError):
+    """Raised when no connection became available within the pool timeout.
+    """
+
+
+class ConnectionPool:
+    """A bounded, thread-safe pool of connections to a PostgreSQL database.
+
+    === Instance Attributes ===
+    timeout: how long, in seconds, to wait for a connection when all of them
+        are checked out, or None to wait for as long as it takes.
+    health_check: whether to check that a connection still works before
+        handing it out.
+
+    === Private Attributes ===
+    _pool: the underlying psycopg2 pool.
+    _slots: one slot per connection that may be checked out at once.
+
+    Representation Invariants:
+    - at most maxconn connections are checked out at any time.
+    """
+    timeout: Optional[float]
+    health_check: bool
+    _pool: pg_pool.ThreadedConnectionPool
+    _slots: threading.BoundedSemaphore
+
+    def __init__(self, minconn: int, maxconn: int,
+                 timeout: Optional[float] = None, health_check: bool = True,
+                 **connect_kwargs: Any) -> None:
+        """Initialize this pool with <minconn> connections opened right away
+        and at most <maxconn> connections checked out at once. The
+        connections are made by calling psycopg2.connect(**connect_kwargs).
+
+        Raise a pg.Error if the initial connections can't be made.
+        """
+        self.timeout = timeout
+        self.health_check = health_check
+        self._pool = pg_pool.ThreadedConnectionPool(
+            minconn, maxconn, **connect_kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self) -> pg_ext.connection:
+        """Check out a working connection, waiting for one to be returned if
+        all of them are checked out.
+
+        Raise a PoolTimeout if none became available within the timeout, and
+        a pg.Error if a new connection had to be made and that failed.
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(
+                f"no connection available after {self.timeout} seconds")
+        try:
+            conn = self._pool.getconn()
+            while not self._works(conn):
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn: pg_ext.connection, close: bool = False) -> None:
+        """Return the connection <conn> to this pool, closing it if <close>
+        is True. Any transaction left open on <conn> is rolled back.
+        """
+        try:
+            self._pool.putconn(conn, close=close)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator[pg_ext.connection]:
+        """Check out a connection for the duration of a with block, and
+        return it to this pool afterwards.
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self) -> None:
+        """Close every connection in this pool."""
+        self._pool.closeall()
+
+    def _works(self, conn: pg_ext.connection) -> bool:
+        """Return whether <conn> is open and, if health checks are on,
+        answers a trivial query.
+        """
+        if conn.closed:
+            return False
+        if not self.health_check:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except pg.Error:
+            return False
@@ -0,0 +1,394 @@
+"""
+Part2 of csc343 A2: An in-memory cache of live driver state for Assignment2.
+csc343, Fall 2022
+University of Toronto
+
+Every dispatch needs to know which shifts are ongoing, which of them are free
+(not dispatched or on a ride), and where each one was last seen. Working this
+out in SQL means joining ClockedIn, ClockedOut, Dispatch, Pickup, Dropoff and
+the whole Location history. DriverCache keeps the answer in memory instead,
+keyed by shift_id.
+
+The cache is kept up to date in two ways:
+    - Assignment2 tells it directly about the changes it makes itself, and
+      the id of the transaction that made them.
+    - Triggers (see support.ddl) send the ids of the shifts whose state
+      changes, and the id of the transaction that changed them, as a
+      notification on the channel driver_state. The cache listens on that
+      channel, and looks the state of the changed shifts up again before it
+      is next used. Notifications from transactions the cache was told about
+      directly are ignored; any other change, even one made on the same
+      connection, is looked up.
+
+The triggers only send notifications while a cache is listening: a cache
+records its listener in the table DriverCacheListener when it starts, and
+removes it when it is closed. This matters for everyone writing to the
+database, not just the processes with a cache. PostgreSQL takes a single
+lock to commit any transaction that sent a notification, so while a cache
+is running, every clock-in, location report, dispatch and pick-up, from
+every process, commits one at a time. Only use a cache where that is cheaper
+than what it saves.
+
+Looking shifts up is done without holding the lock of the cache, so threads
+dispatching at once don't wait on each other's queries. Each lookup only
+replaces the state of shifts that were not changed directly while it ran.
+"""
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
+import threading
+
+import psycopg2 as pg
+import psycopg2.extensions as pg_ext
+
+# The channel on which the triggers in support.ddl announce changed shifts.
+CHANNEL = "driver_state"
+
+# How many of the transactions the cache was told about directly it
+# remembers, to ignore their notifications. Notifications arrive soon after
+# their transactions commit, so only the latest few are needed.
+_APPLIED_TRANSACTIONS = 10000
+
+# The state of shifts, as (shift_id, driver_id, ongoing, free, location) rows.
+# The condition on ClockedIn is filled in by the queries below; each part is a
+# keyed lookup, so looking up a few shifts only reads their rows.
+_SHIFT_STATES = """
+    SELECT shift_id, driver_id,
+        NOT EXISTS (SELECT 1 FROM ClockedOut
+                    WHERE ClockedOut.shift_id = ClockedIn.shift_id),
+        NOT EXISTS (SELECT 1
+                    FROM Dispatch
+                    WHERE Dispatch.shift_id = ClockedIn.shift_id AND
+                        NOT EXISTS (SELECT 1
+                                    FROM Pickup JOIN Dropoff USING(request_id)
+                                    WHERE request_id = Dispatch.request_id)),
+        (SELECT location
+         FROM CurrentLocation
+         WHERE CurrentLocation.shift_id = ClockedIn.shift_id)
+    FROM ClockedIn
+    WHERE {condition};
+    """
+# The state of every ongoing shift with a recorded location (the others can't
+# be dispatched).
+_ONGOING_SHIFTS = _SHIFT_STATES.format(
+    condition="shift_id IN (SELECT shift_id FROM CurrentLocation)")
+# The state of the shifts with the ids in an array.
+_SOME_SHIFTS = _SHIFT_STATES.format(condition="shift_id = ANY(%s)")
+
+
+class DriverCache:
+    """The live state of every ongoing shift.
+
+    The methods of a DriverCache may be called from several threads at once.
+
+    === Private Attributes ===
+    _connect_kwargs: the arguments to psycopg2.connect for the listener.
+    _listener: the connection listening for changed shifts, or None if it
+        has not been made yet.
+    _lock: held while the attributes below are read or changed, but not
+        while the database is queried.
+    _shifts: maps the id of each ongoing shift to its driver_id, whether
+        the driver is free, and its most recent location (or None).
+    _loaded: whether _shifts has been loaded since the listener started.
+    _generation: counts the times the whole cache was found to need loading
+        again, so a load that ran meanwhile is not taken as complete.
+    _fence: the first transaction id that started after the listener was
+        recorded in DriverCacheListener, or None once no transaction that
+        started before it is running. Those transactions may not send
+        notifications, so a load is not taken as complete until then.
+    _stale: the ids of shifts that changed since _shifts was last updated.
+    _applied: the ids of the transactions whose changes the cache was told
+        about directly, oldest first.
+    _applied_set: the same ids, for lookups.
+    _clock: counts the lookups started and the direct changes made.
+    _changed: maps the id of each shift changed directly to the value of
+        _clock when it was.
+    _lookups: the values of _clock when the lookups still running started.
+
+    Representation Invariants:
+    - if _loaded, _shifts holds the state of every ongoing shift, except
+      possibly for the shifts in _stale and for changes whose notifications
+      have not been read from _listener yet.
+    - _applied and _applied_set hold the same ids, and at most
+      _APPLIED_TRANSACTIONS of them.
+    """
+    _connect_kwargs: Dict[str, Any]
+    _listener: Optional[pg_ext.connection]
+    _lock: threading.Lock
+    _shifts: Dict[int, list]
+    _loaded: bool
+    _generation: int
+    _fence: Optional[int]
+    _stale: Set[int]
+    _applied: Deque[int]
+    _applied_set: Set[int]
+    _clock: int
+    _changed: Dict[int, int]
+    _lookups: Set[int]
+
+    def __init__(self, **connect_kwargs: Any) -> None:
+        """Initialize this cache, empty. Notifications will be listened for
+        on a connection made with psycopg2.connect(**connect_kwargs).
+        """
+        self._connect_kwargs = connect_kwargs
+        self._listener = None
+        self._lock = threading.Lock()
+        self._shifts = {}
+        self._loaded = False
+        self._generation = 0
+        self._fence = None
+        self._stale = set()
+        self._applied = deque()
+        self._applied_set = set()
+        self._clock = 0
+        self._changed = {}
+        self._lookups = set()
+
+    def close(self) -> None:
+        """Stop listening for notifications, and empty this cache."""
+        with self._lock:
+            if self._listener is not None:
+                try:
+                    with self._listener.cursor() as cursor:
+                        cursor.execute("""DELETE FROM DriverCacheListener
+                            WHERE pid = pg_backend_pid();""")
+                except pg.Error:
+                    # The next cache to start removes it.
+                    pass
+                self._listener.close()
+                self._listener = None
+            self._loaded = False
+            self._generation += 1
+
+    def available(self, conn: pg_ext.connection,
+                  box: Optional[list]) -> List[Tuple[int, int, Any]]:
+        """Return the drivers who can be dispatched and whose most recent
+        location is in the area <box> (as returned by Assignment2._box), as
+        (driver_id, shift_id, location) rows ordered by shift_id, like
+        Assignment2.valid_drivers.
+
+        Any state that is missing or out of date is looked up using the
+        connection <conn>.
+        """
+        if box is None:
+            return []
+        min_x, min_y, max_x, max_y = box
+        self._update(conn)
+        with self._lock:
+            return [(driver_id, shift_id, location)
+                    for shift_id, (driver_id, free, location)
+                    in sorted(self._shifts.items())
+                    if free and location is not None and
+                    min_x <= location.longitude <= max_x and
+                    min_y <= location.latitude <= max_y]
+
+    def confirm(self, conn: pg_ext.connection,
+                drivers: Iterable[Tuple[int, Any]]) -> bool:
+        """Return whether every driver in <drivers>, given as (shift_id,
+        location) pairs, can still be dispatched from that location,
+        according to the database as seen by the connection <conn>.
+
+        The state of those shifts in this cache is brought up to date.
+        """
+        drivers = list(drivers)
+        states = self._refresh(conn, {shift_id for shift_id, _ in drivers})
+        for shift_id, location in drivers:
+            state = states.get(shift_id)
+            if state is None or not state[1] or state[2] is None or \
+                    (state[2].longitude, state[2].latitude) != \
+                    (location.longitude, location.latitude):
+                return False
+        return True
+
+    def clocked_in(self, xid: int, shift_id: int, driver_id: int,
+                   location: Any) -> None:
+        """Record that the driver with id <driver_id> started the shift with
+        id <shift_id> at <location>, in the committed transaction with id
+        <xid>.
+        """
+        with self._lock:
+            self._applied_transaction(xid)
+            self._changed[shift_id] = self._tick()
+            self._shifts[shift_id] = [driver_id, True, location]
+
+    def dispatched(self, xid: int, shift_ids: Iterable[int]) -> None:
+        """Record that the drivers on the shifts with ids in <shift_ids> were
+        dispatched, in the committed transaction with id <xid>.
+        """
+        with self._lock:
+            self._applied_transaction(xid)
+            for shift_id in shift_ids:
+                self._changed[shift_id] = self._tick()
+                if shift_id in self._shifts:
+                    self._shifts[shift_id][1] = False
+
+    def relocated(self, xid: int, shift_ids: Iterable[int]) -> None:
+        """Record that new locations of the shifts with ids in <shift_ids>
+        were recorded, in the committed transaction with id <xid>. Their
+        most recent locations are looked up before this cache is next used.
+        """
+        with self._lock:
+            self._applied_transaction(xid)
+            self._stale.update(shift_ids)
+
+    def _tick(self) -> int:
+        """Advance _clock, and return its new value."""
+        self._clock += 1
+        return self._clock
+
+    def _applied_transaction(self, xid: int) -> None:
+        """Remember that the changes of the transaction with id <xid> were
+        applied to this cache directly, forgetting the oldest one if there
+        are too many.
+        """
+        if xid in self._applied_set:
+            return
+        self._applied.append(xid)
+        self._applied_set.add(xid)
+        if len(self._applied) > _APPLIED_TRANSACTIONS:
+            self._applied_set.discard(self._applied.popleft())
+
+    def _update(self, conn: pg_ext.connection) -> None:
+        """Bring this cache up to date, using the connection <conn> to look up
+        the state of shifts.
+        """
+        with self._lock:
+            self._read_notifications()
+            loaded = self._loaded
+            generation = self._generation
+            fence = self._fence
+            stale, self._stale = self._stale, set()
+            if loaded and not stale:
+                return
+        if loaded:
+            self._refresh(conn, stale)
+            return
+
+        with self._lock:
+            started = self._start_lookup()
+        try:
+            with conn.cursor() as cursor:
+                if fence is not None:
+                    cursor.execute("""SELECT txid_snapshot_xmin(
+                        txid_current_snapshot()) >= %s;""", [fence])
+                    if cursor.fetchone()[0]:
+                        fence = None
+                cursor.execute(_ONGOING_SHIFTS)
+                shifts = {shift_id: [driver_id, free, location]
+                          for shift_id, driver_id, _, free, location
+                          in cursor}
+        except pg.Error:
+            with self._lock:
+                self._lookups.discard(started)
+            raise
+        with self._lock:
+            # Shifts changed directly while the load ran keep their state,
+            # and are looked up again, since the load may have missed them.
+            for shift_id, changed in self._changed.items():
+                if changed > started:
+                    shifts.pop(shift_id, None)
+                    if shift_id in self._shifts:
+                        shifts[shift_id] = self._shifts[shift_id]
+                    self._stale.add(shift_id)
+            self._end_lookup(started)
+            self._shifts = shifts
+            if self._generation == generation and fence is None:
+                self._fence = None
+                self._loaded = True
+
+    def _refresh(self, conn: pg_ext.connection,
+                 shift_ids: Set[int]) -> Dict[int, list]:
+        """Look up the state of the shifts with ids in <shift_ids> using the
+        connection <conn>, record it in this cache, and return it, keyed by
+        shift_id, for those of them that are ongoing.
+
+        If the lookup fails, the shifts are left marked as stale.
+        """
+        if not shift_ids:
+            return {}
+        with self._lock:
+            started = self._start_lookup()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(_SOME_SHIFTS, [list(shift_ids)])
+                states = {shift_id: [driver_id, free, location]
+                          for shift_id, driver_id, ongoing, free, location
+                          in cursor if ongoing}
+        except pg.Error:
+            with self._lock:
+                self._lookups.discard(started)
+                self._stale.update(shift_ids)
+            raise
+        with self._lock:
+            for shift_id in shift_ids:
+                # A direct change made while the lookup ran is newer than
+                # what the lookup saw.
+                if self._changed.get(shift_id, 0) > started:
+                    continue
+                if shift_id in states:
+                    self._shifts[shift_id] = list(states[shift_id])
+                else:
+                    self._shifts.pop(shift_id, None)
+            self._end_lookup(started)
+        return states
+
+    def _start_lookup(self) -> int:
+        """Record that a lookup is starting, and return its start."""
+        started = self._tick()
+        self._lookups.add(started)
+        return started
+
+    def _end_lookup(self, started: int) -> None:
+        """Record that the lookup that started at <started> is over, and
+        forget the direct changes no running lookup can have missed.
+        """
+        self._lookups.discard(started)
+        if not self._lookups:
+            self._changed.clear()
+        elif len(self._changed) > _APPLIED_TRANSACTIONS:
+            oldest = min(self._lookups)
+            self._changed = {shift_id: changed for shift_id, changed
+                             in self._changed.items() if changed > oldest}
+
+    def _read_notifications(self) -> None:
+        """Read the notifications that arrived since the last call, and mark
+        the shifts they name as stale, unless their changes were applied to
+        this cache directly.
+
+        If the listener is not running, start it, record it in
+        DriverCacheListener, and mark the whole cache as needing to be
+        loaded again. The same is done for a notification
+        that names too many shifts to list (see notify_driver_state in
+        support.ddl).
+        """
+        if self._listener is not None:
+            try:
+                self._listener.poll()
+            except pg.Error:
+                self._listener.close()
+                self._listener = None
+        if self._listener is None:
+            self._listener = pg.connect(**self._connect_kwargs)
+            self._listener.set_session(autocommit=True)
+            with self._listener.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL};")
+                cursor.execute("""DELETE FROM DriverCacheListener
+                    WHERE pid NOT IN (SELECT pid FROM pg_stat_activity);""")
+                cursor.execute("""INSERT INTO DriverCacheListener
+                    VALUES (pg_backend_pid()) ON CONFLICT DO NOTHING;""")
+                cursor.execute(
+                    "SELECT txid_snapshot_xmax(txid_current_snapshot());")
+                self._fence = cursor.fetchone()[0]
+            self._loaded = False
+            self._generation += 1
+            return
+        for notify in self._listener.notifies:
+            xid, shift_ids = notify.payload.split(" ", 1)
+            if int(xid) in self._applied_set:
+                continue
+            if shift_ids == "*":
+                self._loaded = False
+                self._generation += 1
+            else:
+                self._stale.update(int(shift_id)
+                                   for shift_id in shift_ids.split(","))
+        self._listener.notifies.clear()
@@ -0,0 +1,340 @@
+"""
+Part2 of csc343 A2: Latency and SQL roundtrip instrumentation for Assignment2.
+csc343, Fall 2022
+University of Toronto
+
+A Stats object records, for each public Assignment2 method (an operation):
+    - a histogram of how long its calls took,
+    - how many roundtrips to the database they made (statements, fetches from
+      server-side cursors, commits and rollbacks) and a histogram of how long
+      each one took,
+    - how many rows they fetched.
+
+Roundtrips are recorded by the connection and cursor classes a Stats object
+provides, which psycopg2 is told to use with the connection_factory argument
+of psycopg2.connect. Roundtrips made outside of any operation are recorded
+under the operation "none".
+
+The numbers can be read as a snapshot, or exported in the Prometheus text
+format.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+import copy
+import threading
+import time
+
+import psycopg2.extensions as pg_ext
+
+# The upper bounds, in seconds, of the buckets of every latency histogram.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+# The operation roundtrips made outside of any operation are recorded under.
+NO_OPERATION = "none"
+
+
+class Histogram:
+    """A histogram of durations, with the buckets in BUCKETS.
+
+    === Instance Attributes ===
+    counts: the number of durations in each bucket, i.e., counts[i] is the
+        number of durations d with BUCKETS[i - 1] < d <= BUCKETS[i], and the
+        last entry is the number of durations greater than all of BUCKETS.
+    total: the sum of all the durations.
+    """
+    counts: List[int]
+    total: float
+
+    def __init__(self) -> None:
+        """Initialize this histogram with no durations."""
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+
+    def __len__(self) -> int:
+        """Return the number of durations in this histogram."""
+        return sum(self.counts)
+
+    def observe(self, seconds: float) -> None:
+        """Add the duration <seconds> to this histogram."""
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+
+    def quantile(self, q: float) -> float:
+        """Return an estimate of the <q> quantile of the durations, i.e., the
+        upper bound of the bucket it falls in (or infinity).
+
+        Precondition: 0 <= q <= 1 and this histogram is not empty.
+        """
+        rank = q * len(self)
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class OperationStats:
+    """What has been recorded about one operation.
+
+    === Instance Attributes ===
+    latency: the durations of the calls to the operation.
+    roundtrips: the durations of the roundtrips the calls made.
+    rows: the number of rows the calls fetched.
+    """
+    latency: Histogram
+    roundtrips: Histogram
+    rows: int
+
+    def __init__(self) -> None:
+        """Initialize these stats with nothing recorded."""
+        self.latency = Histogram()
+        self.roundtrips = Histogram()
+        self.rows = 0
+
+    @property
+    def calls(self) -> int:
+        """Return the number of calls to the operation."""
+        return len(self.latency)
+
+    @property
+    def roundtrips_per_call(self) -> float:
+        """Return the average number of roundtrips made by each call."""
+        return len(self.roundtrips) / self.calls if self.calls else 0.0
+
+
+class Stats:
+    """The instrumentation of one Assignment2 instance.
+
+    The methods of a Stats object may be called from several threads at once.
+
+    === Instance Attributes ===
+    connection_factory: the connection class to pass to psycopg2.connect so
+        that the roundtrips made on a connection are recorded.
+
+    === Private Attributes ===
+    _lock: held while the stats are read or changed.
+    _operations: the stats of each operation, by name.
+    _local: the operation each thread is running, if any.
+    """
+    connection_factory: type
+    _lock: threading.Lock
+    _operations: Dict[str, OperationStats]
+    _local: threading.local
+
+    def __init__(self) -> None:
+        """Initialize these stats with nothing recorded."""
+        self._lock = threading.Lock()
+        self._operations = {}
+        self._local = threading.local()
+        cursor_class = type("InstrumentedCursor", (_InstrumentedCursor,),
+                            {"stats": self})
+        self.connection_factory = type(
+            "InstrumentedConnection", (_InstrumentedConnection,),
+            {"stats": self, "cursor_class": cursor_class})
+
+    @contextmanager
+    def operation(self, name: str) -> Iterator[None]:
+        """Record the body of a with block as a call to the operation <name>.
+
+        Calls made while the thread is already in an operation are part of
+        that operation, and are not recorded separately.
+        """
+        if getattr(self._local, "operation", None) is not None:
+            yield
+            return
+        self._local.operation = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._local.operation = None
+            with self._lock:
+                self._stats(name).latency.observe(seconds)
+
+    def record_roundtrip(self, seconds: float, rows: int = 0) -> None:
+        """Record a roundtrip that took <seconds> and fetched <rows> rows, as
+        part of the operation the thread is running.
+        """
+        name = getattr(self._local, "operation", None) or NO_OPERATION
+        with self._lock:
+            stats = self._stats(name)
+            stats.roundtrips.observe(seconds)
+            stats.rows += rows
+
+    def snapshot(self) -> Dict[str, OperationStats]:
+        """Return a copy of the stats of every operation, by name."""
+        with self._lock:
+            return copy.deepcopy(self._operations)
+
+    def reset(self) -> None:
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._operations = {}
+
+    def to_prometheus(self, prefix: str = "a2") -> str:
+        """Return the stats in the Prometheus text exposition format, with
+        metric names starting with <prefix>.
+        """
+        operations = sorted(self.snapshot().items())
+        lines = []
+        for metric, description, field in (
+                ("operation_duration_seconds",
+                 "Latency of Assignment2 operations.", "latency"),
+                ("roundtrip_duration_seconds",
+                 "Latency of database roundtrips, by operation.",
+                 "roundtrips")):
+            name = f"{prefix}_{metric}"
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} histogram")
+            for operation, stats in operations:
+                histogram = getattr(stats, field)
+                if not len(histogram):
+                    continue
+                label = f'operation="{operation}"'
+                seen = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    seen += count
+                    lines.append(f'{name}_bucket{{{label},le="{bound}"}} '
+                                 f'{seen}')
+                lines.append(f'{name}_bucket{{{label},le="+Inf"}} '
+                             f'{len(histogram)}')
+                lines.append(f"{name}_sum{{{label}}} {histogram.total}")
+                lines.append(f"{name}_count{{{label}}} {len(histogram)}")
+        name = f"{prefix}_rows_fetched_total"
+        lines.append(f"# HELP {name} Rows fetched from the database, by "
+                     f"operation.")
+        lines.append(f"# TYPE {name} counter")
+        for operation, stats in operations:
+            lines.append(f'{name}{{operation="{operation}"}} {stats.rows}')
+        return "\n".join(lines) + "\n"
+
+    def _stats(self, name: str) -> OperationStats:
+        """Return the stats of the operation <name>, creating them if there
+        are none yet.
+
+        Precondition: _lock is held.
+        """
+        if name not in self._operations:
+            self._operations[name] = OperationStats()
+        return self._operations[name]
+
+
+class _InstrumentedCursor(pg_ext.cursor):
+    """A cursor that records its roundtrips in the class attribute stats.
+
+    A client-side cursor gets every row of a result with the statement, so
+    its rows are counted when the statement is run. A server-side (named)
+    cursor gets them with each fetch, which is a roundtrip of its own.
+    """
+    stats: Stats
+
+    def execute(self, query: Any, vars: Any = None) -> None:
+        """Run <query> with <vars>, and record the roundtrip."""
+        return self._timed(super().execute, query, vars)
+
+    def executemany(self, query: Any, vars_list: Any) -> None:
+        """Run <query> with each of <vars_list>, and record the roundtrip."""
+        return self._timed(super().executemany, query, vars_list)
+
+    def callproc(self, procname: str, parameters: Any = None) -> Any:
+        """Call <procname> with <parameters>, and record the roundtrip."""
+        return self._timed(super().callproc, procname, parameters)
+
+    def copy_expert(self, sql: Any, file: Any, size: int = 8192) -> None:
+        """Run the COPY statement <sql>, and record the roundtrip."""
+        return self._timed(super().copy_expert, sql, file, size)
+
+    def fetchone(self) -> Optional[tuple]:
+        """Return the next row, recording the fetch for a named cursor."""
+        if self.name is None:
+            return super().fetchone()
+        return self._fetched(super().fetchone)
+
+    def fetchmany(self, size: Optional[int] = None) -> List[tuple]:
+        """Return the next <size> rows, recording the fetch for a named
+        cursor.
+        """
+        size = self.arraysize if size is None else size
+        if self.name is None:
+            return super().fetchmany(size)
+        return self._fetched(super().fetchmany, size)
+
+    def fetchall(self) -> List[tuple]:
+        """Return the remaining rows, recording the fetch for a named cursor.
+        """
+        if self.name is None:
+            return super().fetchall()
+        return self._fetched(super().fetchall)
+
+    def __iter__(self) -> Iterator[tuple]:
+        """Return an iterator over the remaining rows. A named cursor fetches
+        them itersize at a time, recording each fetch.
+        """
+        if self.name is None:
+            return super().__iter__()
+        return self._iter_named()
+
+    def _iter_named(self) -> Iterator[tuple]:
+        """Yield the remaining rows of this named cursor."""
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+    def _timed(self, run: Callable, *args: Any) -> Any:
+        """Return run(*args), recording it as a roundtrip that fetched the
+        rows of its result (if this cursor is client-side).
+        """
+        start = time.perf_counter()
+        try:
+            return run(*args)
+        finally:
+            rows = 0
+            if self.name is None and self.description is not None:
+                rows = max(self.rowcount, 0)
+            self.stats.record_roundtrip(time.perf_counter() - start, rows)
+
+    def _fetched(self, fetch: Callable, *args: Any) -> Any:
+        """Return fetch(*args), recording it as a roundtrip that fetched the
+        rows it returns.
+        """
+        start = time.perf_counter()
+        result = fetch(*args)
+        rows = len(result) if isinstance(result, list) else int(
+            result is not None)
+        self.stats.record_roundtrip(time.perf_counter() - start, rows)
+        return result
+
+
+class _InstrumentedConnection(pg_ext.connection):
+    """A connection whose cursors, commits and rollbacks record their
+    roundtrips in the class attribute stats.
+    """
+    stats: Stats
+    cursor_class: type
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        """Initialize this connection, as for psycopg2.connect."""
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = self.cursor_class
+
+    def commit(self) -> None:
+        """Commit the current transaction, and record the roundtrip."""
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            self.stats.record_roundtrip(time.perf_counter() - start)
+
+    def rollback(self) -> None:
+        """Roll back the current transaction, and record the roundtrip."""
+        start = time.perf_counter()
+        try:
+            super().rollback()
+        finally:
+            self.stats.record_roundtrip(time.perf_counter() - start)
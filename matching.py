@@ -0,0 +1,342 @@
+"""
+Part2 of csc343 A2: Matching engine used by Assignment2.dispatch.
+csc343, Fall 2022
+University of Toronto
+
+The dispatcher assigns drivers to clients one client at a time, from the
+client with the highest total billings down to the client with the lowest,
+giving each client the closest remaining driver. Done naively this costs
+O(clients x drivers); here the remaining drivers are kept in a k-d tree so
+that each nearest-driver lookup only looks at drivers near the client.
+
+optimal_match is an alternative to this greedy matching: it serves the same
+clients, but assigns drivers to them so that the total distance driven to
+the clients is as small as possible.
+"""
+from typing import Any, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed by optimal_match.
+    np = None
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:  # optimal_match uses _assign instead.
+    linear_sum_assignment = None
+
+
+def distance(x1: float, y1: float, x2: float, y2: float) -> float:
+    """Return the straight-line distance between (x1, y1) and (x2, y2).
+
+    This is the distance used by dispatch to decide which driver is closest
+    to a client, with x the longitude and y the latitude.
+
+    >>> distance(0.0, 0.0, 3.0, 4.0)
+    5.0
+    """
+    return ((y1 - y2) ** 2 + (x1 - x2) ** 2) ** (1 / 2)
+
+
+class DriverTree:
+    """A k-d tree over a fixed list of driver locations.
+
+    Drivers are identified by their position in the list the tree was built
+    from. Drivers can be removed (e.g., once they have been dispatched), but
+    never added.
+
+    Nodes are numbered from 0 (the root) and stored in parallel lists. Each
+    node covers a contiguous range of _order and is either a leaf, or is
+    split in two along the longer side of its bounding box.
+
+    === Private Attributes ===
+    _points: the (x, y) location of every driver, by index.
+    _live: whether each driver, by index, has not been removed.
+    _size: the number of live drivers.
+    _order: the driver indices, ordered so that every node covers a range.
+    _lo, _hi: the range of _order covered by each node.
+    _left, _right: the children of each node, or -1 for a leaf.
+    _parent: the parent of each node, or -1 for the root.
+    _leaf: the leaf that covers each driver, by index.
+    _count: the number of live drivers covered by each node.
+    _min_x, _max_x, _min_y, _max_y: the bounding box of the drivers covered
+        by each node (whether or not they are live).
+
+    Representation Invariants:
+    - _count[n] is the number of live drivers in _order[_lo[n]:_hi[n]]
+
+    >>> tree = DriverTree([(0.0, 0.0), (5.0, 5.0), (1.0, 1.0)])
+    >>> tree.nearest(0.9, 0.9)
+    2
+    >>> tree.remove(2)
+    >>> tree.nearest(0.9, 0.9)
+    0
+    >>> len(tree)
+    2
+    """
+    _points: List[Tuple[float, float]]
+    _live: List[bool]
+    _size: int
+    _order: List[int]
+    _lo: List[int]
+    _hi: List[int]
+    _left: List[int]
+    _right: List[int]
+    _parent: List[int]
+    _leaf: List[int]
+    _count: List[int]
+    _min_x: List[float]
+    _max_x: List[float]
+    _min_y: List[float]
+    _max_y: List[float]
+
+    # The largest number of drivers kept in a leaf.
+    LEAF_SIZE = 16
+
+    def __init__(self, points: List[Tuple[float, float]]) -> None:
+        """Initialize this tree with every driver in <points> live."""
+        self._points = list(points)
+        n = len(self._points)
+        self._live = [True] * n
+        self._size = n
+        self._order = list(range(n))
+        self._leaf = [0] * n
+        self._lo, self._hi, self._left, self._right = [], [], [], []
+        self._parent, self._count = [], []
+        self._min_x, self._max_x, self._min_y, self._max_y = [], [], [], []
+        if n:
+            self._build(0, n, -1)
+
+    def __len__(self) -> int:
+        """Return the number of live drivers in this tree."""
+        return self._size
+
+    def _build(self, lo: int, hi: int, parent: int) -> int:
+        """Build the subtree that covers _order[lo:hi] as a child of node
+        <parent>, and return its root.
+        """
+        points = self._points
+        members = self._order[lo:hi]
+        xs = [points[i][0] for i in members]
+        ys = [points[i][1] for i in members]
+        node = len(self._lo)
+        self._lo.append(lo)
+        self._hi.append(hi)
+        self._left.append(-1)
+        self._right.append(-1)
+        self._parent.append(parent)
+        self._count.append(hi - lo)
+        self._min_x.append(min(xs))
+        self._max_x.append(max(xs))
+        self._min_y.append(min(ys))
+        self._max_y.append(max(ys))
+        if hi - lo <= self.LEAF_SIZE:
+            for i in members:
+                self._leaf[i] = node
+            return node
+
+        axis = 0 if max(xs) - min(xs) >= max(ys) - min(ys) else 1
+        members.sort(key=lambda i: points[i][axis])
+        self._order[lo:hi] = members
+        mid = (lo + hi) // 2
+        self._left[node] = self._build(lo, mid, node)
+        self._right[node] = self._build(mid, hi, node)
+        return node
+
+    def remove(self, i: int) -> None:
+        """Remove the driver with index <i> from this tree.
+
+        Precondition: the driver with index <i> is live.
+        """
+        self._live[i] = False
+        self._size -= 1
+        node = self._leaf[i]
+        while node != -1:
+            self._count[node] -= 1
+            node = self._parent[node]
+
+    def nearest(self, x: float, y: float) -> Optional[int]:
+        """Return the index of the live driver closest to (x, y), or None if
+        there are no live drivers.
+
+        In the case of a tie, return the largest of the tied indices.
+        """
+        points, live, order = self._points, self._live, self._order
+        lo, hi = self._lo, self._hi
+        count, left, right = self._count, self._left, self._right
+        min_x, max_x = self._min_x, self._max_x
+        min_y, max_y = self._min_y, self._max_y
+        best = None
+        best_d = float('inf')
+        # Each entry is a node and a lower bound on the distance from (x, y)
+        # to its bounding box. The bounds are computed like distance itself
+        # so that drivers tied with the best distance are never pruned.
+        stack = [(0.0, 0)] if self._size else []
+        while stack:
+            bound, node = stack.pop()
+            if bound > best_d or not count[node]:
+                continue
+            l = left[node]
+            if l == -1:
+                for k in range(lo[node], hi[node]):
+                    i = order[k]
+                    if live[i]:
+                        px, py = points[i]
+                        d = ((y - py) ** 2 + (x - px) ** 2) ** (1 / 2)
+                        if d < best_d or (d == best_d and i > best):
+                            best_d = d
+                            best = i
+                continue
+            r = right[node]
+            dx = max(min_x[l] - x, x - max_x[l], 0.0)
+            dy = max(min_y[l] - y, y - max_y[l], 0.0)
+            l_bound = (dy ** 2 + dx ** 2) ** (1 / 2)
+            dx = max(min_x[r] - x, x - max_x[r], 0.0)
+            dy = max(min_y[r] - y, y - max_y[r], 0.0)
+            r_bound = (dy ** 2 + dx ** 2) ** (1 / 2)
+            # Visit the nearer child first, as it is the more likely to hold
+            # the closest driver.
+            if l_bound <= r_bound:
+                stack.append((r_bound, r))
+                stack.append((l_bound, l))
+            else:
+                stack.append((l_bound, l))
+                stack.append((r_bound, r))
+        return best
+
+
+def greedy_match(client_list: List[Tuple[Any, float]], driver_list: List[Any]) \
+        -> List[Tuple[Any, Any]]:
+    """Return the (client, driver) pairs chosen by dispatching drivers from
+    <driver_list> to the clients in <client_list>.
+
+    <client_list> is a list of (request, billed total) pairs sorted by billed
+    total, as produced by Assignment2.client_billed_totals, where
+    request[3] is the source location of the request. Clients are served
+    from the end of the list. <driver_list> is a list of rows as produced by
+    Assignment2.valid_drivers, where driver[2] is the driver's location.
+
+    Each client, in turn, gets the closest driver that has not been
+    dispatched yet, until there are no more clients or no more drivers. When
+    several drivers are equally close, the one that comes last in
+    <driver_list> is chosen.
+
+    Neither list is modified.
+    """
+    tree = DriverTree([(driver[2].longitude, driver[2].latitude)
+                       for driver in driver_list])
+    pairs = []
+    for client, _ in reversed(client_list):
+        if not tree:
+            break
+        source = client[3]
+        i = tree.nearest(source.longitude, source.latitude)
+        tree.remove(i)
+        pairs.append((client, driver_list[i]))
+    return pairs
+
+
+def _assign(cost: 'np.ndarray') -> 'np.ndarray':
+    """Return, for each row of the matrix <cost>, the column assigned to it,
+    in the assignment of distinct columns to all the rows with the least
+    total cost.
+
+    This is the shortest augmenting path form of the Hungarian algorithm, as
+    in Jonker and Volgenant's LAPJV. Each row is first given its cheapest
+    column if no other row took it already. Every other row is then added by
+    a Dijkstra search over the reduced costs for the cheapest way to free up
+    a column, with each step of the search done as one pass over the columns.
+
+    Precondition: <cost> has no more rows than columns.
+
+    >>> _assign(np.array([[1.0, 2.0], [1.0, 5.0]])).tolist()
+    [1, 0]
+    """
+    n, m = cost.shape
+    v = np.zeros(m)
+    row_of = np.full(m, -1)
+    col_of = np.full(n, -1)
+    for i, j in enumerate(cost.argmin(axis=1)):
+        if row_of[j] == -1:
+            row_of[j] = i
+            col_of[i] = j
+
+    for start in np.flatnonzero(col_of == -1):
+        # dist is the length of the shortest path found so far from row
+        # <start> to each column, and pred the row it reaches the column from.
+        dist = cost[start] - v
+        pred = np.full(m, start)
+        done = np.zeros(m, dtype=bool)
+        scanned, scanned_dist = [], []
+        while True:
+            j = int(dist.argmin())
+            mu = dist[j]
+            if row_of[j] == -1:
+                break
+            scanned.append(j)
+            scanned_dist.append(mu)
+            dist[j] = np.inf
+            done[j] = True
+            i = row_of[j]
+            through_i = (cost[i] - v) + (mu - cost[i, j] + v[j])
+            better = (through_i < dist) & ~done
+            dist[better] = through_i[better]
+            pred[better] = i
+        if scanned:
+            v[scanned] += np.array(scanned_dist) - mu
+        # Shift the rows along the path, which frees up a column for <start>.
+        while True:
+            i = pred[j]
+            row_of[j] = i
+            col_of[i], j = j, col_of[i]
+            if i == start:
+                break
+    return col_of
+
+
+def optimal_match(client_list: List[Tuple[Any, float]], driver_list: List[Any],
+                  billing_weight: float = 0.0) -> List[Tuple[Any, Any]]:
+    """Return the (client, driver) pairs chosen by dispatching drivers from
+    <driver_list> to the clients in <client_list> (both as for greedy_match)
+    so that the total distance from the drivers to their clients is as small
+    as possible.
+
+    The clients who get a driver are the same as with greedy_match: as many
+    as there are drivers, from the end of <client_list>. Only which driver
+    goes to which of them differs.
+
+    If <billing_weight> is positive, the distance to each client counts
+    (1 + billing_weight * b) times, where b is the client's billed total
+    divided by the largest billed total among the clients served, so that
+    clients with higher billings tend to get closer drivers.
+
+    The assignment is made by scipy if it is installed, and by _assign
+    otherwise. Neither list is modified. Raise an ImportError if numpy is
+    not installed.
+    """
+    if np is None:
+        raise ImportError("optimal_match needs numpy")
+    served = client_list[len(client_list) -
+                         min(len(client_list), len(driver_list)):]
+    if not served:
+        return []
+    sources = np.array([(client[3].longitude, client[3].latitude)
+                        for client, _ in served])
+    locations = np.array([(driver[2].longitude, driver[2].latitude)
+                          for driver in driver_list])
+    cost = np.hypot(np.subtract.outer(sources[:, 0], locations[:, 0]),
+                    np.subtract.outer(sources[:, 1], locations[:, 1]))
+    if billing_weight:
+        billed = np.array([total for _, total in served])
+        if billed.max() > 0:
+            cost *= (1 + billing_weight * billed / billed.max())[:, None]
+    if linear_sum_assignment is not None:
+        _, columns = linear_sum_assignment(cost)
+    else:
+        columns = _assign(cost)
+    return [(served[k][0], driver_list[j])
+            for k, j in reversed(list(enumerate(columns.tolist())))]
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
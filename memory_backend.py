@@ -0,0 +1,336 @@
+"""
+Part2 of csc343 A2: An in-memory storage backend.
+csc343, Fall 2022
+University of Toronto
+
+MemoryBackend keeps the rows of the tables of schema.ddl in Python dicts,
+indexed the way its operations look them up, and implements Backend (see
+backend.py) the way Assignment2 does on PostgreSQL, quirks included: e.g., a
+driver can only clock in once they have clocked in before, and a client
+exists once they have requested a ride. It needs no database, so it can be
+used in unit tests, and to simulate dispatch policies on large what-if
+scenarios without a roundtrip for every operation.
+
+Rows are loaded with load and read back with rows, in the column order of
+schema.ddl.
+"""
+from datetime import datetime
+from typing import Dict, Iterable, List, Set, Tuple
+import struct
+
+from a2 import Assignment2, GeoLoc
+from backend import Backend
+
+# The tables a MemoryBackend keeps, in the order load adds their rows.
+TABLES = ("Client", "Driver", "Request", "ClockedIn", "ClockedOut",
+          "Location", "Dispatch", "Pickup", "Dropoff", "Billed")
+
+# The tables of schema.ddl that no operation reads, whose rows load ignores.
+IGNORED = ("DriverRating", "ClientRating")
+
+
+class MemoryBackend(Backend):
+    """The data of the ride-sharing application, in memory.
+
+    === Private Attributes ===
+    _clients: the Client rows, by client_id.
+    _drivers: the Driver rows, by driver_id.
+    _requests: the Request rows, by request_id.
+    _client_requests: the ids of the requests of each client who has made
+        any, by client_id.
+    _open: the ids of the requests no driver has been dispatched to.
+    _shifts: the ClockedIn rows, by shift_id.
+    _driver_shifts: the ids of the shifts of each driver who has clocked in,
+        by driver_id.
+    _clocked_out: the ClockedOut rows, by shift_id.
+    _active: the ids of the shifts that have not ended.
+    _active_drivers: the number of shifts of each driver that have not ended,
+        for drivers with any, by driver_id.
+    _locations: the locations recorded during each shift, by shift_id and
+        then by datetime.
+    _current: the datetime and location of the most recent location of each
+        shift that has not ended, by shift_id.
+    _dispatches: the Dispatch rows, by request_id.
+    _busy: the ids of the requests each shift has been dispatched to that
+        have not been both picked up and dropped off, by shift_id.
+    _outstanding: the ids of the requests each driver has been dispatched to
+        for each client that have not been picked up, by (driver_id,
+        client_id).
+    _pickups: the Pickup rows, by request_id.
+    _dropoffs: the Dropoff rows, by request_id.
+    _billed: the Billed rows, by request_id.
+    _client_billed: the total billings of each client who has been billed,
+        by client_id.
+    _last_shift: the largest shift id given out so far, or 0.
+    """
+    _clients: Dict[int, tuple]
+    _drivers: Dict[int, tuple]
+    _requests: Dict[int, tuple]
+    _client_requests: Dict[int, Set[int]]
+    _open: Set[int]
+    _shifts: Dict[int, tuple]
+    _driver_shifts: Dict[int, List[int]]
+    _clocked_out: Dict[int, tuple]
+    _active: Set[int]
+    _active_drivers: Dict[int, int]
+    _locations: Dict[int, Dict[datetime, GeoLoc]]
+    _current: Dict[int, Tuple[datetime, GeoLoc]]
+    _dispatches: Dict[int, tuple]
+    _busy: Dict[int, Set[int]]
+    _outstanding: Dict[Tuple[int, int], Set[int]]
+    _pickups: Dict[int, tuple]
+    _dropoffs: Dict[int, tuple]
+    _billed: Dict[int, tuple]
+    _client_billed: Dict[int, float]
+    _last_shift: int
+
+    def __init__(self) -> None:
+        """Initialize this backend with no data."""
+        self._clients = {}
+        self._drivers = {}
+        self._requests = {}
+        self._client_requests = {}
+        self._open = set()
+        self._shifts = {}
+        self._driver_shifts = {}
+        self._clocked_out = {}
+        self._active = set()
+        self._active_drivers = {}
+        self._locations = {}
+        self._current = {}
+        self._dispatches = {}
+        self._busy = {}
+        self._outstanding = {}
+        self._pickups = {}
+        self._dropoffs = {}
+        self._billed = {}
+        self._client_billed = {}
+        self._last_shift = 0
+
+    def load(self, tables: Dict[str, Iterable[tuple]]) -> None:
+        """Add the rows in <tables>, which maps the names of tables of
+        schema.ddl to their rows.
+
+        The rows of the tables in TABLES are added in that order, whatever
+        the order of <tables>; the rows of the tables in IGNORED are ignored.
+        Raise a KeyError if another table is named.
+
+        Precondition: the rows, with the ones already in this backend, conform
+        to schema.ddl.
+        """
+        for name in tables:
+            if name not in TABLES and name not in IGNORED:
+                raise KeyError(name)
+        for name in TABLES:
+            add = getattr(self, f"_add_{name.lower()}")
+            for row in tables.get(name, ()):
+                add(tuple(row))
+
+    def rows(self, table: str) -> List[tuple]:
+        """Return the rows of the table <table> of schema.ddl, ordered by its
+        primary key.
+
+        Raise a KeyError if <table> is not in TABLES.
+        """
+        if table == "Location":
+            return [(shift_id, when, location)
+                    for shift_id, history in sorted(self._locations.items())
+                    for when, location in sorted(history.items())]
+        by_key = {"Client": self._clients, "Driver": self._drivers,
+                  "Request": self._requests, "ClockedIn": self._shifts,
+                  "ClockedOut": self._clocked_out,
+                  "Dispatch": self._dispatches, "Pickup": self._pickups,
+                  "Dropoff": self._dropoffs, "Billed": self._billed}[table]
+        return [row for _, row in sorted(by_key.items())]
+
+    # ======================= Backend operations ======================= #
+
+    def clock_in(self, driver_id: int, when: datetime,
+                 geo_loc: GeoLoc) -> bool:
+        """Record that the driver with id <driver_id> started a shift at
+        <when> at <geo_loc>, as Assignment2.clock_in does.
+        """
+        if driver_id not in self._driver_shifts or \
+                driver_id in self._active_drivers:
+            return False
+        when = when.replace(second=0, microsecond=0)
+        shift_id = self._last_shift + 1
+        self._add_clockedin((shift_id, driver_id, when))
+        self._add_location((shift_id, when, geo_loc))
+        return True
+
+    def pick_up(self, driver_id: int, client_id: int, when: datetime) -> bool:
+        """Record that the driver with id <driver_id> picked up the client
+        with id <client_id> at <when>, as Assignment2.pick_up does.
+        """
+        outstanding = self._outstanding.get((driver_id, client_id))
+        if driver_id not in self._driver_shifts or \
+                client_id not in self._client_requests or \
+                driver_id not in self._active_drivers or not outstanding:
+            return False
+        self._add_pickup((min(outstanding),
+                          when.replace(second=0, microsecond=0)))
+        return True
+
+    def dispatch(self, nw: GeoLoc, se: GeoLoc, when: datetime,
+                 optimal: bool = False, billing_weight: float = 0.0) -> None:
+        """Dispatch drivers to the clients who have requested rides in the
+        area bounded by <nw> and <se>, at <when>, as Assignment2.dispatch
+        does.
+        """
+        driver_list = self.valid_drivers(nw, se)
+        if not driver_list:
+            return
+        client_list = Assignment2._order_by_billed(
+            self.clients_within_bounds(nw, se), self._client_billed)
+        # Only the clients with the highest billings, as many as there are
+        # drivers, can be served.
+        client_list = client_list[max(0, len(client_list) - len(driver_list)):]
+        for row in Assignment2._dispatch_rows(client_list, driver_list, when,
+                                              optimal, billing_weight):
+            self._add_dispatch(row)
+
+    def clients_within_bounds(self, nw: GeoLoc, se: GeoLoc) -> list:
+        """Return the Request rows of the requests in the area bounded by
+        <nw> and <se> that no driver has been dispatched to, by request_id.
+        """
+        box = Assignment2._box(nw, se)
+        if box is None:
+            return []
+        return [self._requests[request_id]
+                for request_id in sorted(self._open)
+                if _in_box(self._requests[request_id][3], box)]
+
+    def valid_drivers(self, nw: GeoLoc, se: GeoLoc) -> list:
+        """Return the (driver_id, shift_id, location) of the drivers who are
+        on a shift, are not dispatched or on a ride, and whose most recent
+        location is in the area bounded by <nw> and <se>, by shift_id.
+        """
+        box = Assignment2._box(nw, se)
+        if box is None:
+            return []
+        return [(self._shifts[shift_id][1], shift_id, location)
+                for shift_id, (_, location) in sorted(self._current.items())
+                if not self._busy.get(shift_id) and _in_box(location, box)]
+
+    # ======================= Adding rows ======================= #
+
+    def _add_client(self, row: tuple) -> None:
+        """Add the Client row <row>."""
+        self._clients[row[0]] = row
+
+    def _add_driver(self, row: tuple) -> None:
+        """Add the Driver row <row>."""
+        self._drivers[row[0]] = row
+
+    def _add_request(self, row: tuple) -> None:
+        """Add the Request row <row>."""
+        request_id, client_id = row[0], row[1]
+        self._requests[request_id] = row
+        self._client_requests.setdefault(client_id, set()).add(request_id)
+        if request_id not in self._dispatches:
+            self._open.add(request_id)
+
+    def _add_clockedin(self, row: tuple) -> None:
+        """Add the ClockedIn row <row>."""
+        shift_id, driver_id = row[0], row[1]
+        self._shifts[shift_id] = row
+        self._driver_shifts.setdefault(driver_id, []).append(shift_id)
+        self._last_shift = max(self._last_shift, shift_id)
+        if shift_id not in self._clocked_out:
+            self._active.add(shift_id)
+            self._active_drivers[driver_id] = \
+                self._active_drivers.get(driver_id, 0) + 1
+
+    def _add_clockedout(self, row: tuple) -> None:
+        """Add the ClockedOut row <row>."""
+        shift_id = row[0]
+        self._clocked_out[shift_id] = row
+        self._current.pop(shift_id, None)
+        if shift_id in self._active:
+            self._active.remove(shift_id)
+            driver_id = self._shifts[shift_id][1]
+            self._active_drivers[driver_id] -= 1
+            if not self._active_drivers[driver_id]:
+                del self._active_drivers[driver_id]
+
+    def _add_location(self, row: tuple) -> None:
+        """Add the Location row <row>."""
+        shift_id, when, location = row
+        self._locations.setdefault(shift_id, {})[when] = location
+        if shift_id in self._active and (
+                shift_id not in self._current or
+                when > self._current[shift_id][0]):
+            self._current[shift_id] = (when, location)
+
+    def _add_dispatch(self, row: tuple) -> None:
+        """Add the Dispatch row <row>."""
+        request_id, shift_id = row[0], row[1]
+        self._dispatches[request_id] = row
+        self._open.discard(request_id)
+        if not self._finished(request_id):
+            self._busy.setdefault(shift_id, set()).add(request_id)
+        if request_id not in self._pickups:
+            self._outstanding.setdefault(
+                (self._shifts[shift_id][1], self._requests[request_id][1]),
+                set()).add(request_id)
+
+    def _add_pickup(self, row: tuple) -> None:
+        """Add the Pickup row <row>."""
+        request_id = row[0]
+        self._pickups[request_id] = row
+        key = (self._shifts[self._dispatches[request_id][1]][1],
+               self._requests[request_id][1])
+        self._outstanding[key].discard(request_id)
+        if not self._outstanding[key]:
+            del self._outstanding[key]
+        self._ride_changed(request_id)
+
+    def _add_dropoff(self, row: tuple) -> None:
+        """Add the Dropoff row <row>."""
+        self._dropoffs[row[0]] = row
+        self._ride_changed(row[0])
+
+    def _add_billed(self, row: tuple) -> None:
+        """Add the Billed row <row>."""
+        request_id, amount = row
+        self._billed[request_id] = row
+        client_id = self._requests[request_id][1]
+        self._client_billed[client_id] = _real(
+            self._client_billed.get(client_id, 0.0) + _real(amount))
+
+    def _finished(self, request_id: int) -> bool:
+        """Return whether the request <request_id> has been picked up and
+        dropped off.
+        """
+        return request_id in self._pickups and request_id in self._dropoffs
+
+    def _ride_changed(self, request_id: int) -> None:
+        """Free the shift dispatched to the request <request_id> if it has
+        been picked up and dropped off.
+        """
+        if self._finished(request_id):
+            shift_id = self._dispatches[request_id][1]
+            busy = self._busy.get(shift_id, set())
+            busy.discard(request_id)
+            if not busy:
+                self._busy.pop(shift_id, None)
+
+
+def _in_box(location: GeoLoc, box: List[float]) -> bool:
+    """Return whether <location> is in <box>, as returned by
+    Assignment2._box.
+    """
+    min_x, min_y, max_x, max_y = box
+    return min_x <= location.longitude <= max_x and \
+        min_y <= location.latitude <= max_y
+
+
+def _real(value: float) -> float:
+    """Return <value> rounded to single precision, like the REAL columns of
+    Billed and ClientBilled, so that billed totals compare the same way.
+
+    >>> _real(0.1)
+    0.10000000149011612
+    """
+    return struct.unpack("f", struct.pack("f", value))[0]
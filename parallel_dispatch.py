@@ -0,0 +1,255 @@
+"""
+Part2 of csc343 A2: Dispatch over a large area in several processes at once.
+csc343, Fall 2022
+University of Toronto
+
+A ParallelDispatcher splits the area it is asked to dispatch in into a grid of
+tiles, and dispatches the tiles at the same time in a pool of worker
+processes, each with an Assignment2 of its own on its own connection. A
+city-wide dispatch can then use every core, instead of one Python process.
+
+Every driver and every client belongs to exactly one tile: the one their
+location (for clients, the source of their request) is in. A tile includes
+its west and south boundaries but not its east and north ones, except where
+those are the boundaries of the whole area, which stay inclusive as in
+Assignment2.dispatch. A tile only dispatches the drivers and clients it owns,
+so no two tiles ever choose the same driver, and each tile commits on its
+own.
+
+A tile cannot see across its boundaries, so a client near one may be left
+waiting while a driver just across it stays free. Once every tile has
+committed, a reconciliation pass dispatches over the whole area as
+Assignment2.dispatch does. It only finds the drivers and clients the tiles
+left, since their dispatches are committed by then, so no driver is
+dispatched twice.
+
+The result is not always the one Assignment2.dispatch would give: clients
+are ordered by billings, and matched with drivers, within each tile first.
+
+Usage:
+    python parallel_dispatch.py dbname username [password] nw_longitude
+        nw_latitude se_longitude se_latitude [--tiles N] [--processes N]
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import List, Optional
+import argparse
+import math
+import os
+import time
+
+from a2 import Assignment2, GeoLoc
+
+# The Assignment2 of this worker process, or None if it could not connect.
+_worker = None
+
+
+class Tile:
+    """One tile of the area a ParallelDispatcher dispatches in.
+
+    === Instance Attributes ===
+    nw: the northwest corner of this tile.
+    se: the southeast corner of this tile.
+    east_edge: whether the east boundary of this tile is the east boundary
+        of the whole area, so that it belongs to this tile.
+    north_edge: whether the north boundary of this tile is the north
+        boundary of the whole area, so that it belongs to this tile.
+    """
+    nw: GeoLoc
+    se: GeoLoc
+    east_edge: bool
+    north_edge: bool
+
+    def __init__(self, nw: GeoLoc, se: GeoLoc, east_edge: bool,
+                 north_edge: bool) -> None:
+        """Initialize this tile, with corners <nw> and <se>."""
+        self.nw = nw
+        self.se = se
+        self.east_edge = east_edge
+        self.north_edge = north_edge
+
+    def owns(self, loc: GeoLoc) -> bool:
+        """Return whether <loc> belongs to this tile.
+
+        >>> tile = Tile(GeoLoc(0.0, 1.0), GeoLoc(1.0, 0.0), False, True)
+        >>> tile.owns(GeoLoc(0.0, 0.0)), tile.owns(GeoLoc(0.5, 1.0))
+        (True, True)
+        >>> tile.owns(GeoLoc(1.0, 0.5))
+        False
+        """
+        if not self.nw.longitude <= loc.longitude <= self.se.longitude or \
+                not self.se.latitude <= loc.latitude <= self.nw.latitude:
+            return False
+        return (self.east_edge or loc.longitude < self.se.longitude) and \
+            (self.north_edge or loc.latitude < self.nw.latitude)
+
+
+def split(nw: GeoLoc, se: GeoLoc, columns: int, rows: int) -> List[Tile]:
+    """Return the tiles of a grid of <columns> by <rows> tiles over the area
+    bounded by <nw> and <se>, or no tiles if no point is in the area.
+
+    Every point in the area belongs to exactly one of the tiles.
+
+    >>> tiles = split(GeoLoc(0.0, 2.0), GeoLoc(2.0, 0.0), 2, 2)
+    >>> [sum(tile.owns(GeoLoc(x, y)) for tile in tiles)
+    ...  for x, y in [(0.0, 0.0), (1.0, 1.0), (2.0, 2.0), (1.0, 2.0)]]
+    [1, 1, 1, 1]
+    """
+    if nw.longitude > se.longitude or se.latitude > nw.latitude:
+        return []
+    width = se.longitude - nw.longitude
+    height = nw.latitude - se.latitude
+    # The boundaries are computed once, so neighbouring tiles share exactly
+    # the same ones, and the last are exactly those of the area.
+    xs = [nw.longitude + width * i / columns for i in range(columns)] + \
+        [se.longitude]
+    ys = [se.latitude + height * j / rows for j in range(rows)] + \
+        [nw.latitude]
+    return [Tile(GeoLoc(xs[i], ys[j + 1]), GeoLoc(xs[i + 1], ys[j]),
+                 i == columns - 1, j == rows - 1)
+            for j in range(rows) for i in range(columns)]
+
+
+class ParallelDispatcher:
+    """Dispatches drivers over an area, a tile at a time in each of several
+    worker processes, as described at the top of this file.
+
+    === Instance Attributes ===
+    processes: the number of worker processes.
+
+    === Private Attributes ===
+    _executor: the pool of worker processes.
+    """
+    processes: int
+    _executor: ProcessPoolExecutor
+
+    def __init__(self, dbname: str, username: str, password: str,
+                 processes: Optional[int] = None) -> None:
+        """Initialize this dispatcher with <processes> worker processes (or
+        one for each core), each connected to the database <dbname> using the
+        username <username> and password <password>.
+        """
+        self.processes = processes or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(
+            self.processes, initializer=_start_worker,
+            initargs=(dbname, username, password))
+
+    def __enter__(self) -> 'ParallelDispatcher':
+        """Return this dispatcher."""
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        """Shut this dispatcher down."""
+        self.close()
+
+    def close(self) -> None:
+        """Shut down the worker processes, closing their connections."""
+        self._executor.shutdown()
+
+    def dispatch(self, nw: GeoLoc, se: GeoLoc, when: datetime,
+                 tiles: Optional[int] = None, optimal: bool = False,
+                 billing_weight: float = 0.0) -> int:
+        """Dispatch drivers to the clients who have requested rides in the
+        area bounded by <nw> and <se>, at date time <when>, and return how
+        many were dispatched.
+
+        The area is split into <tiles> by <tiles> tiles (by default, enough
+        for about two for each worker process), which are dispatched in the
+        worker processes, and then reconciled, as described at the top of
+        this file. <optimal> and <billing_weight> are as for
+        Assignment2.dispatch.
+
+        Each tile, and the reconciliation pass, is dispatched in a
+        transaction of its own. If one fails, its changes are rolled back,
+        and its error is raised once the other tiles are done, without
+        reconciling; the dispatches of the other tiles stay.
+
+        Raise a ConnectionError if a worker process could not connect to the
+        database.
+
+        Precondition:
+            - <when> is after all dates currently recorded in the database.
+        """
+        if tiles is None:
+            tiles = math.ceil(math.sqrt(2 * self.processes))
+        futures = [self._executor.submit(_dispatch_tile, tile, when, optimal,
+                                         billing_weight)
+                   for tile in split(nw, se, tiles, tiles)]
+        # Wait for every tile, so that none is still running when an error
+        # is raised or the reconciliation pass starts.
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+        dispatched = sum(future.result() for future in futures)
+        return dispatched + self._executor.submit(
+            _dispatch_area, nw, se, when, optimal, billing_weight).result()
+
+
+def _start_worker(dbname: str, username: str, password: str) -> None:
+    """Connect this worker process to the database <dbname> using the
+    username <username> and password <password>.
+    """
+    global _worker
+    a2 = Assignment2()
+    _worker = a2 if a2.connect(dbname, username, password) else None
+
+
+def _connected() -> Assignment2:
+    """Return the Assignment2 of this worker process.
+
+    Raise a ConnectionError if it could not connect to the database.
+    """
+    if _worker is None:
+        raise ConnectionError("a dispatch worker could not connect to the "
+                              "database")
+    return _worker
+
+
+def _dispatch_tile(tile: Tile, when: datetime, optimal: bool,
+                   billing_weight: float) -> int:
+    """Dispatch the drivers <tile> owns to the clients it owns, at date time
+    <when>, in this worker process, and return how many were dispatched.
+    """
+    return _connected()._dispatch(tile.nw, tile.se, when, optimal,
+                                  billing_weight, tile.owns)
+
+
+def _dispatch_area(nw: GeoLoc, se: GeoLoc, when: datetime, optimal: bool,
+                   billing_weight: float) -> int:
+    """Dispatch over the whole area bounded by <nw> and <se>, at date time
+    <when>, in this worker process, and return how many were dispatched.
+    """
+    return _connected()._dispatch(nw, se, when, optimal, billing_weight)
+
+
+def main() -> None:
+    """Dispatch as described at the top of this file, at the current time."""
+    parser = argparse.ArgumentParser(
+        description="Dispatch over an area in several processes at once.")
+    parser.add_argument("dbname")
+    parser.add_argument("username")
+    parser.add_argument("password", nargs="?", default="")
+    for corner in ("nw_longitude", "nw_latitude", "se_longitude",
+                   "se_latitude"):
+        parser.add_argument(corner, type=float)
+    parser.add_argument("--tiles", type=int,
+                        help="the number of tiles along each side")
+    parser.add_argument("--processes", type=int,
+                        help="the number of worker processes")
+    args = parser.parse_args()
+
+    with ParallelDispatcher(args.dbname, args.username, args.password,
+                            args.processes) as dispatcher:
+        start = time.perf_counter()
+        dispatched = dispatcher.dispatch(
+            GeoLoc(args.nw_longitude, args.nw_latitude),
+            GeoLoc(args.se_longitude, args.se_latitude), datetime.now(),
+            args.tiles)
+        elapsed = time.perf_counter() - start
+    print(f"Dispatched {dispatched} drivers with {dispatcher.processes} "
+          f"processes in {elapsed:.3f} s")
+
+
+if __name__ == '__main__':
+    main()
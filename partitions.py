@@ -0,0 +1,410 @@
+"""
+Part2 of csc343 A2: Time partitioning of Location and Request.
+csc343, Fall 2022
+University of Toronto
+
+Location and Request only ever grow. migrate turns each of them into a table
+partitioned by month on its datetime column, with a partition for every
+month from its first row to a few months ahead, and a default partition for
+rows outside of those. After that:
+    - new rows go to the partition of their month,
+    - queries that bound datetime, like the reports in q2.sql, only read the
+      partitions of the months they are about (partition pruning),
+    - old months can be taken out in one cheap step each, by detaching their
+      partitions or archiving them to compressed files, instead of deleting
+      their rows.
+
+create_partitions makes the partitions of the months ahead, so that new rows
+do not end up in the default partition; it is meant to be run regularly,
+e.g., monthly. detach_partitions and archive_partitions take old months out,
+and restore_archive puts an archived month back.
+
+Once Request is partitioned, its primary key is (request_id, datetime), so
+Dispatch references it with triggers instead of a foreign key (see
+support.ddl). The primary key also no longer makes request_id unique on its
+own, so triggers keep it unique instead: the request_id of every row of
+Request is kept in the table RequestKey, under a primary key, and a request
+whose id is already in Request, in any month, is rejected. A month taken
+out of Request takes its ids out of RequestKey, so a request that is put
+back with restore_archive is only rejected if its id was taken meanwhile.
+
+As far as Assignment2 and the reports are concerned, the rows of a month
+that has been taken out are gone, except for what the totals in ClientBilled
+and the daily rollups in DriverDay and ClientDay keep about them. Only months
+in which nothing is still going on (open requests, rides or shifts) should be
+taken out.
+
+Migrating, and adding or taking out partitions, lock Location and Request
+for as long as they take.
+
+Usage:
+    python partitions.py migrate dbname username [password] [--ahead N]
+    python partitions.py create dbname username [password] THROUGH
+    python partitions.py detach dbname username [password] BEFORE
+    python partitions.py archive dbname username [password] BEFORE DIRECTORY
+    python partitions.py restore dbname username [password] FILE
+"""
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator, List, Tuple
+import argparse
+import gzip
+import os
+import re
+
+import psycopg2 as pg
+import psycopg2.extensions as pg_ext
+
+from a2 import SUPPORT_DDL
+
+# The tables that are partitioned, with the columns that, with datetime, make
+# up the primary key of each, and the foreign keys of each.
+TABLES = {
+    "Request": ("request_id", "FOREIGN KEY (client_id) REFERENCES Client"),
+    "Location": ("shift_id", "FOREIGN KEY (shift_id) REFERENCES ClockedIn"),
+}
+
+# How many months ahead of the data migrate makes partitions for.
+AHEAD = 3
+
+# The bounds of a partition, as shown by pg_get_expr.
+_BOUND = re.compile(r"FOR VALUES FROM \('([^']*)'\) TO \('([^']*)'\)")
+
+# The names of the files archive_partitions writes.
+_ARCHIVE = re.compile(r"(request|location)_(\d{4})_(\d{2})\.csv\.gz")
+
+
+def migrate(conn: pg_ext.connection, ahead: int = AHEAD) -> List[str]:
+    """Partition those of the tables in TABLES that are not partitioned yet,
+    in the database <conn> is connected to, and return their names.
+
+    Each gets a partition for every month from the month of its first row to
+    <ahead> months after the later of the month of its last row and the
+    current month, and a default partition. The views, indexes and triggers
+    of support.ddl are installed again on the new tables. Views of the
+    reports that read the old tables are dropped; the reports make them
+    again when they are next run.
+    """
+    migrated = []
+    with _transaction(conn) as cursor:
+        # Serialize with Assignment2.install_support, since the objects of
+        # support.ddl are dropped and installed again below.
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));",
+                       [SUPPORT_DDL])
+        for table, (key, reference) in TABLES.items():
+            if _partitioned(cursor, table):
+                continue
+            old = f"{table.lower()}_unpartitioned"
+            cursor.execute(f"ALTER TABLE {table} RENAME TO {old};")
+            cursor.execute(
+                f"""CREATE TABLE {table}
+                (LIKE {old} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+                PARTITION BY RANGE (datetime);""")
+            cursor.execute(f"CREATE TABLE {table.lower()}_default "
+                           f"PARTITION OF {table} DEFAULT;")
+            cursor.execute(f"""SELECT min(datetime),
+                greatest(max(datetime), localtimestamp) FROM {old};""")
+            first, last = cursor.fetchone()
+            for start, end in _months(_month(first or last),
+                                      _add_months(_month(last), ahead)):
+                _add_partition(cursor, table, start, end)
+            # The rows are copied before the keys are made, which is faster
+            # than checking them one at a time.
+            cursor.execute(f"INSERT INTO {table} SELECT * FROM {old};")
+            cursor.execute(f"DROP TABLE {old} CASCADE;")
+            cursor.execute(f"""ALTER TABLE {table}
+                ADD PRIMARY KEY ({key}, datetime), ADD {reference};""")
+            migrated.append(table)
+        if migrated:
+            with open(SUPPORT_DDL) as ddl_file:
+                cursor.execute(ddl_file.read())
+    return migrated
+
+
+def create_partitions(conn: pg_ext.connection,
+                      through: datetime) -> List[str]:
+    """Make the partitions of the tables in TABLES for every month from the
+    current month through the month of <through> that they do not have yet,
+    in the database <conn> is connected to, and return their names.
+
+    Rows of those months that are in the default partitions are moved to
+    the new partitions.
+
+    Raise a ValueError if the tables have not been migrated.
+    """
+    created = []
+    with _transaction(conn) as cursor:
+        cursor.execute("SELECT localtimestamp;")
+        now = cursor.fetchone()[0]
+        for table in TABLES:
+            _check_partitioned(cursor, table)
+            have = {start for _, start, _ in _partitions(cursor, table)}
+            for start, end in _months(_month(now), _month(through)):
+                if start not in have:
+                    created.append(_add_partition(cursor, table, start, end))
+    return created
+
+
+def detach_partitions(conn: pg_ext.connection,
+                      before: datetime) -> List[str]:
+    """Detach the partitions of the tables in TABLES for the months that end
+    by <before>, in the database <conn> is connected to, and return their
+    names.
+
+    The partitions stay in the database as tables of their own. The daily
+    rollups are brought up to date first, so they keep those months.
+
+    Raise a ValueError if the tables have not been migrated.
+    """
+    detached = []
+    with _transaction(conn) as cursor:
+        cursor.execute("SELECT refresh_daily_rollups();")
+        for table in TABLES:
+            _check_partitioned(cursor, table)
+            for name, _, end in _partitions(cursor, table):
+                if end <= before:
+                    _forget_keys(cursor, table, name)
+                    cursor.execute(
+                        f"ALTER TABLE {table} DETACH PARTITION {name};")
+                    detached.append(name)
+    return detached
+
+
+def archive_partitions(conn: pg_ext.connection, before: datetime,
+                       directory: str) -> List[str]:
+    """Archive the partitions of the tables in TABLES for the months that end
+    by <before>, in the database <conn> is connected to, and return the paths
+    of the files they were archived to.
+
+    Each partition is written to a gzip-compressed CSV file in <directory>,
+    named after the partition, and then dropped, in a transaction of its
+    own. If archiving one fails, it is left in place, along with the ones
+    after it. The daily rollups are brought up to date first, so they keep
+    those months.
+
+    Raise a ValueError if the tables have not been migrated.
+    """
+    with _transaction(conn) as cursor:
+        cursor.execute("SELECT refresh_daily_rollups();")
+        old = []
+        for table in TABLES:
+            _check_partitioned(cursor, table)
+            old.extend((table, name)
+                       for name, _, end in _partitions(cursor, table)
+                       if end <= before)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for table, name in old:
+        path = os.path.join(directory, f"{name}.csv.gz")
+        # The file only gets its name once the partition is dropped, so a
+        # file with that name always holds a whole month.
+        partial = f"{path}.part"
+        try:
+            with _transaction(conn) as cursor:
+                _forget_keys(cursor, table, name)
+                cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {name};")
+                with gzip.open(partial, "wb") as file:
+                    cursor.copy_expert(
+                        f"COPY {name} TO STDOUT WITH (FORMAT csv, HEADER);",
+                        file)
+                cursor.execute(f"DROP TABLE {name};")
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        os.replace(partial, path)
+        paths.append(path)
+    return paths
+
+
+def restore_archive(conn: pg_ext.connection, path: str) -> int:
+    """Put the rows in the file <path>, written by archive_partitions, back
+    into the database <conn> is connected to, and return how many there
+    were. The partition of their month is made again if it is missing.
+
+    Raise a ValueError if <path> is not named like an archived partition.
+    """
+    match = _ARCHIVE.fullmatch(os.path.basename(path))
+    if match is None:
+        raise ValueError(f"{path} is not an archived partition")
+    table = {name.lower(): name for name in TABLES}[match[1]]
+    start = datetime(int(match[2]), int(match[3]), 1)
+    with _transaction(conn) as cursor:
+        _check_partitioned(cursor, table)
+        if start not in {begin for _, begin, _ in
+                         _partitions(cursor, table)}:
+            _add_partition(cursor, table, start, _add_months(start, 1))
+        with gzip.open(path, "rb") as file:
+            cursor.copy_expert(
+                f"COPY {table} FROM STDIN WITH (FORMAT csv, HEADER);", file)
+        return cursor.rowcount
+
+
+@contextmanager
+def _transaction(conn: pg_ext.connection) -> Iterator[pg_ext.cursor]:
+    """Return a cursor of <conn> for the body of a with block, and commit
+    when the block is done, or roll back if it raises an exception.
+    """
+    try:
+        with conn.cursor() as cursor:
+            yield cursor
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def _partitioned(cursor: pg_ext.cursor, table: str) -> bool:
+    """Return whether <table> is partitioned, using <cursor>."""
+    cursor.execute("SELECT relkind = 'p' FROM pg_class "
+                   "WHERE oid = to_regclass(%s);", [table])
+    row = cursor.fetchone()
+    return row is not None and row[0]
+
+
+def _check_partitioned(cursor: pg_ext.cursor, table: str) -> None:
+    """Raise a ValueError if <table> is not partitioned, using <cursor>."""
+    if not _partitioned(cursor, table):
+        raise ValueError(f"{table} is not partitioned; run migrate first")
+
+
+def _forget_keys(cursor: pg_ext.cursor, table: str, name: str) -> None:
+    """Take the ids of the rows of the partition <name> of <table> out of
+    RequestKey (see support.ddl), if <table> is Request, using <cursor>.
+    """
+    if table == "Request":
+        cursor.execute(f"""DELETE FROM RequestKey
+            WHERE request_id IN (SELECT request_id FROM {name});""")
+
+
+def _partitions(cursor: pg_ext.cursor,
+                table: str) -> List[Tuple[str, datetime, datetime]]:
+    """Return the name, start and end of every partition of <table> other
+    than the default one, by start, using <cursor>. A partition holds the
+    rows with start <= datetime < end.
+    """
+    cursor.execute("""
+        SELECT relname, pg_get_expr(relpartbound, oid)
+        FROM pg_inherits JOIN pg_class ON pg_class.oid = inhrelid
+        WHERE inhparent = to_regclass(%s);""", [table])
+    found = []
+    for name, bound in cursor.fetchall():
+        match = _BOUND.fullmatch(bound)
+        if match is not None:
+            found.append((name, datetime.fromisoformat(match[1]),
+                          datetime.fromisoformat(match[2])))
+    return sorted(found, key=lambda partition: partition[1])
+
+
+def _add_partition(cursor: pg_ext.cursor, table: str, start: datetime,
+                   end: datetime) -> str:
+    """Make the partition of <table> for the rows with
+    start <= datetime < end, using <cursor>, and return its name.
+
+    Rows in that range that are in the default partition are moved to it.
+    """
+    name = f"{table.lower()}_{start:%Y_%m}"
+    default = f"{table.lower()}_default"
+    cursor.execute(f"""SELECT EXISTS (SELECT 1 FROM {default}
+        WHERE datetime >= %s AND datetime < %s);""", [start, end])
+    if not cursor.fetchone()[0]:
+        cursor.execute(f"""CREATE TABLE {name} PARTITION OF {table}
+            FOR VALUES FROM (%s) TO (%s);""", [start, end])
+        return name
+    # The rows are moved while the default partition is detached, so that
+    # the triggers on the table do not take the move for a change.
+    cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {default};")
+    cursor.execute(f"""CREATE TABLE {name}
+        (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);""")
+    cursor.execute(f"""
+        WITH Moved AS (DELETE FROM {default}
+                       WHERE datetime >= %s AND datetime < %s
+                       RETURNING *)
+        INSERT INTO {name} SELECT * FROM Moved;""", [start, end])
+    cursor.execute(f"""ALTER TABLE {table} ATTACH PARTITION {name}
+        FOR VALUES FROM (%s) TO (%s);""", [start, end])
+    cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT;")
+    return name
+
+
+def _month(when: datetime) -> datetime:
+    """Return the start of the month of <when>.
+
+    >>> _month(datetime(2022, 3, 14, 15, 9))
+    datetime.datetime(2022, 3, 1, 0, 0)
+    """
+    return when.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _add_months(month: datetime, count: int) -> datetime:
+    """Return the start of the month <count> months after the start of the
+    month <month>.
+
+    >>> _add_months(datetime(2022, 11, 1), 3)
+    datetime.datetime(2023, 2, 1, 0, 0)
+    """
+    years, months = divmod(month.month - 1 + count, 12)
+    return month.replace(year=month.year + years, month=months + 1)
+
+
+def _months(first: datetime, last: datetime) -> List[Tuple[datetime,
+                                                           datetime]]:
+    """Return the start and end of every month from the month starting at
+    <first> through the month starting at <last>.
+    """
+    months = []
+    while first <= last:
+        months.append((first, _add_months(first, 1)))
+        first = months[-1][1]
+    return months
+
+
+def main() -> None:
+    """Run the command given as described at the top of this file."""
+    parser = argparse.ArgumentParser(
+        description="Partition Location and Request by month, and archive "
+                    "old months.")
+    database = argparse.ArgumentParser(add_help=False)
+    database.add_argument("dbname")
+    database.add_argument("username")
+    database.add_argument("password", nargs="?", default="")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("migrate", parents=[database])
+    command.add_argument("--ahead", type=int, default=AHEAD)
+    command = commands.add_parser("create", parents=[database])
+    command.add_argument("through", type=datetime.fromisoformat)
+    command = commands.add_parser("detach", parents=[database])
+    command.add_argument("before", type=datetime.fromisoformat)
+    command = commands.add_parser("archive", parents=[database])
+    command.add_argument("before", type=datetime.fromisoformat)
+    command.add_argument("directory")
+    command = commands.add_parser("restore", parents=[database])
+    command.add_argument("file")
+    args = parser.parse_args()
+
+    conn = pg.connect(dbname=args.dbname, user=args.username,
+                      password=args.password,
+                      options="-c search_path=uber,public")
+    try:
+        if args.command == "migrate":
+            for table in migrate(conn, args.ahead):
+                print(f"Partitioned {table}")
+        elif args.command == "create":
+            for name in create_partitions(conn, args.through):
+                print(f"Created {name}")
+        elif args.command == "detach":
+            for name in detach_partitions(conn, args.before):
+                print(f"Detached {name}")
+        elif args.command == "archive":
+            for path in archive_partitions(conn, args.before,
+                                           args.directory):
+                print(f"Archived {path}")
+        else:
+            print(f"Restored {restore_archive(conn, args.file)} rows from "
+                  f"{args.file}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -26,61 +26,37 @@ DROP VIEW IF EXISTS total_early_avg CASCADE;
 DROP VIEW IF EXISTS total_late_avg CASCADE;
 DROP VIEW IF EXISTS total_avg CASCADE;
 
+-- The daily rollups in DriverDay (see support.ddl) are read as they are.
+-- reports.py brings them up to date before it runs this file; when running
+-- it on its own, run SELECT refresh_daily_rollups(); first.
+
 
 -- Define views for your intermediate steps here:
-CREATE VIEW new_driver AS -- consider drivers who have given a ride (one or more)
-select Driver.driver_id, trained, DATE(Request.datetime)
-from Driver, ClockedIn, Dispatch, Request
-where Driver.driver_id = ClockedIn.driver_id
-    and ClockedIn.shift_id = Dispatch.shift_id
-    and Dispatch.request_id = Request.request_id;
-
-
-CREATE VIEW driver_first_days AS -- consider drivers who have given a ride (one or more)
-select a.driver_id, date
-from (select driver_id, count(distinct(date))   --   on at least 10 different days
-        from new_driver
-        group by driver_id
-        having count(distinct(date)) > 10) as a, new_driver
-where a.driver_id = new_driver.driver_id;
-
-
-CREATE VIEW early AS -- find first 5 days of job
-select *
-from (select ROW_NUMBER() over (PARTITION BY driver_id order by date) AS r, 
-        driver_id, date
-        from driver_first_days) x
-where x.r <= 5;
-
-
-CREATE VIEW early_avg AS  -- find average rating of first 5 days
-select early.driver_id, avg(rating)
-from early, ClockedIn, Dispatch, DriverRating, Request
-where early.driver_id = ClockedIn.driver_id
-    and ClockedIn.shift_id = Dispatch.shift_id
-    and Dispatch.request_id = DriverRating.request_id
-    and DriverRating.request_id = Request.request_id
-    and early.date = Request.datetime::date
-group by early.driver_id;
-
-
-CREATE VIEW late AS -- find days after first 5 days of job
-select driver_id, date
-from driver_first_days as b
-where not exists (select driver_id, date from early as a
-                    where a.driver_id = b.driver_id
-                    and a.date = b.date);
-
-
-CREATE VIEW late_avg AS  -- find average rating of last days
-select late.driver_id, avg(rating)
-from late, ClockedIn, Dispatch, DriverRating, Request
-where late.driver_id = ClockedIn.driver_id
-    and ClockedIn.shift_id = Dispatch.shift_id
-    and Dispatch.request_id = DriverRating.request_id
-    and DriverRating.request_id = Request.request_id
-    and late.date = Request.datetime::date
-group by late.driver_id;
+CREATE VIEW driver_first_days AS -- consider drivers who have given rides on more than 10 different days
+select driver_id, day, rides, rated, rating_sum,
+    -- how many of their first 5 rides were on this day
+    least(rides, greatest(0, 5 - coalesce(sum(rides) over (
+        partition by driver_id order by day
+        rows between unbounded preceding and 1 preceding), 0))) as early_rides
+from DriverDay
+where driver_id in (select driver_id
+                    from DriverDay
+                    group by driver_id
+                    having count(*) > 10);
+
+
+CREATE VIEW early_avg AS  -- find average rating of the days of the first 5 rides
+select driver_id, sum(early_rides * rating_sum)::numeric / sum(early_rides * rated) as avg
+from driver_first_days
+where early_rides > 0 and rated > 0  -- each rating counts once per early ride that day
+group by driver_id;
+
+
+CREATE VIEW late_avg AS  -- find average rating of the later days
+select driver_id, sum(rides * rating_sum)::numeric / sum(rides * rated) as avg
+from driver_first_days
+where early_rides = 0 and rated > 0  -- each rating counts once per ride that day
+group by driver_id;
 
 
 CREATE VIEW total_early_avg AS -- calculate average of early averages
@@ -110,4 +86,3 @@ from (select trained, count(distinct(Driver.driver_id))
         where Driver.driver_id = driver_first_days.driver_id
         group by trained) as n, total_avg
 where n.trained = total_avg.trained;
-
@@ -0,0 +1,259 @@
+"""
+Part2 of csc343 A2: A parallel runner for the report scripts q2.sql to q10.sql.
+csc343, Fall 2022
+University of Toronto
+
+Each report script drops and re-creates its result table (q2, q4, ...) and
+the views it is computed from, so running them one after another through
+psql redoes every report from scratch. ReportRunner runs them at the same
+time instead, each on its own connection from the pool of an Assignment2 in
+pooled mode, and times each one.
+
+A report is only run when its result could have changed. Along with its
+result table, the runner records a watermark of the report: the digest of
+its script, and the number of rows and the largest key of each table it
+reads. If the watermark is unchanged when the report is next asked for, the
+result table is read as it is. The watermark is taken before the report
+runs, so the result reflects at least the data it describes, and is only
+reused if nothing has been added since. (The tables of schema.ddl are only
+ever added to by Assignment2; a change that updates rows in place without
+adding or removing any is not noticed.)
+
+q4, q6 and q10 read the daily rollups in support.ddl. The runner brings
+them up to date once, in a short transaction of its own, before it starts
+the reports, so the reports don't wait for each other's refreshes.
+
+Usage:
+    python reports.py dbname username [password] [report ...]
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+import hashlib
+import os
+import sys
+import time
+
+import psycopg2 as pg
+import psycopg2.extensions as pg_ext
+
+from a2 import Assignment2
+
+# The directory the report scripts are in.
+REPORT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The tables each report reads.
+REPORTS = {
+    "q2": ("Client", "Request", "Billed"),
+    "q4": ("Driver", "ClockedIn", "Dispatch", "Request", "DriverRating"),
+    "q6": ("Client", "Request"),
+    "q8": ("Client", "Request", "Driver", "ClockedIn", "Dispatch",
+           "DriverRating", "ClientRating"),
+    "q10": ("Driver", "ClockedIn", "Dispatch", "Request", "Dropoff",
+            "Billed"),
+}
+
+# The key of each table read by a report.
+_KEYS = {
+    "Client": "client_id",
+    "Driver": "driver_id",
+    "Request": "request_id",
+    "ClockedIn": "shift_id",
+    "Dispatch": "request_id",
+    "Dropoff": "request_id",
+    "Billed": "request_id",
+    "DriverRating": "request_id",
+    "ClientRating": "request_id",
+}
+
+
+class ReportResult:
+    """The result of one report.
+
+    === Instance Attributes ===
+    name: the name of the report, e.g., "q2".
+    columns: the names of the columns of its result table.
+    rows: the rows of its result table.
+    seconds: how long it took to get the result, not counting the wait for
+        a connection.
+    cached: whether the result table was up to date already, so the report
+        was not run.
+    """
+    name: str
+    columns: List[str]
+    rows: List[tuple]
+    seconds: float
+    cached: bool
+
+    def __init__(self, name: str, columns: List[str], rows: List[tuple],
+                 seconds: float, cached: bool) -> None:
+        """Initialize this result."""
+        self.name = name
+        self.columns = columns
+        self.rows = rows
+        self.seconds = seconds
+        self.cached = cached
+
+
+class ReportRunner:
+    """Runs the report scripts in parallel, on the pooled connections of an
+    Assignment2.
+
+    The methods of a ReportRunner may be called from several threads (or
+    processes) at once; runs of the same report are serialized.
+
+    === Private Attributes ===
+    _a2: the Assignment2, in pooled mode, whose connections are used.
+    _directory: the directory the report scripts are in.
+    """
+    _a2: Assignment2
+    _directory: str
+
+    def __init__(self, a2: Assignment2, directory: str = REPORT_DIR) -> None:
+        """Initialize this runner to run the scripts in <directory> on
+        connections from the pool of <a2>.
+
+        Raise a ValueError if <a2> is not in pooled mode.
+        """
+        if a2.pool is None:
+            raise ValueError("the reports need an Assignment2 in pooled mode")
+        self._a2 = a2
+        self._directory = directory
+
+    def run(self, names: Optional[Iterable[str]] = None) \
+            -> Dict[str, ReportResult]:
+        """Return the results of the reports named in <names> (or all of
+        REPORTS), running the ones that are out of date at the same time.
+
+        Raise a KeyError if a name is not in REPORTS, and a pg.Error if a
+        report fails.
+        """
+        names = list(REPORTS if names is None else names)
+        for name in names:
+            if name not in REPORTS:
+                raise KeyError(name)
+        if not names:
+            return {}
+        self._refresh_rollups()
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            results = list(executor.map(self._run_one, names))
+        return {result.name: result for result in results}
+
+    def run_one(self, name: str) -> ReportResult:
+        """Return the result of the report <name>, running it on a pooled
+        connection if it is out of date.
+
+        Raise a KeyError if <name> is not in REPORTS, and a pg.Error if the
+        report fails.
+        """
+        if name not in REPORTS:
+            raise KeyError(name)
+        self._refresh_rollups()
+        return self._run_one(name)
+
+    def _refresh_rollups(self) -> None:
+        """Bring the daily rollups up to date, in a transaction of their own
+        on a pooled connection.
+
+        Raise a pg.Error if refreshing fails.
+        """
+        with self._a2.pool.connection() as conn:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT refresh_daily_rollups();")
+                conn.commit()
+            except pg.Error:
+                conn.rollback()
+                raise
+
+    def _run_one(self, name: str) -> ReportResult:
+        """Return the result of the report <name>, as for run_one, without
+        refreshing the daily rollups first.
+        """
+        tables = REPORTS[name]
+        with open(os.path.join(self._directory, f"{name}.sql")) as file:
+            script = file.read()
+        with self._a2.pool.connection() as conn:
+            start = time.perf_counter()
+            lock = f"report {name}"
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_lock(hashtext(%s));",
+                               [lock])
+            conn.commit()
+            try:
+                columns, rows, cached = self._run_on(conn, name, tables,
+                                                     script)
+            finally:
+                conn.rollback()
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_unlock(hashtext(%s));",
+                                   [lock])
+                conn.commit()
+            return ReportResult(name, columns, rows,
+                                time.perf_counter() - start, cached)
+
+    @staticmethod
+    def _run_on(conn: pg_ext.connection, name: str, tables: Tuple[str, ...],
+                script: str) -> Tuple[List[str], List[tuple], bool]:
+        """Return the columns and rows of the result table of the report
+        <name>, which reads <tables> and is computed by <script>, and whether
+        it was up to date already. Run the report using the connection
+        <conn> if it is not, and commit.
+        """
+        with conn.cursor() as cursor:
+            watermark = _watermark(cursor, tables, script)
+            cursor.execute(
+                """SELECT watermark
+                FROM ReportWatermark
+                WHERE report = %s AND to_regclass(report) IS NOT NULL;""",
+                [name])
+            row = cursor.fetchone()
+            cached = row is not None and row[0] == watermark
+            if not cached:
+                cursor.execute(script)
+                cursor.execute(
+                    """INSERT INTO ReportWatermark VALUES (%s, %s)
+                    ON CONFLICT (report) DO UPDATE
+                    SET watermark = EXCLUDED.watermark;""",
+                    [name, watermark])
+            cursor.execute(f"SELECT * FROM {name};")
+            columns = [column.name for column in cursor.description]
+            rows = cursor.fetchall()
+        conn.commit()
+        return columns, rows, cached
+
+
+def _watermark(cursor: pg_ext.cursor, tables: Tuple[str, ...],
+               script: str) -> str:
+    """Return the watermark of a report that reads <tables> and is computed
+    by <script>, using <cursor>.
+    """
+    parts = ", ".join(f"(SELECT count(*) FROM {table}), "
+                      f"(SELECT max({_KEYS[table]}) FROM {table})"
+                      for table in tables)
+    cursor.execute(f"SELECT {parts};")
+    values = cursor.fetchone()
+    marks = [f"{table}={values[2 * i]}/{values[2 * i + 1]}"
+             for i, table in enumerate(tables)]
+    digest = hashlib.sha1(script.encode()).hexdigest()
+    return " ".join([digest] + marks)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.exit(__doc__.split("Usage:")[1])
+    a2 = Assignment2()
+    if not a2.connect_pool(sys.argv[1], sys.argv[2],
+                           sys.argv[3] if len(sys.argv) > 3 else "",
+                           maxconn=len(REPORTS)):
+        sys.exit(f"Could not connect to {sys.argv[1]}")
+    try:
+        start = time.perf_counter()
+        results = ReportRunner(a2).run(sys.argv[4:] or None)
+        elapsed = time.perf_counter() - start
+    finally:
+        a2.disconnect()
+    for result in results.values():
+        print(f"{result.name:>4}: {len(result.rows):>7} rows in "
+              f"{result.seconds:8.3f} s"
+              f"{' (cached)' if result.cached else ''}")
+    print(f"Total: {elapsed:.3f} s")
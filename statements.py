@@ -0,0 +1,91 @@
+"""
+Part2 of csc343 A2: Prepared statements for the hot queries of Assignment2.
+csc343, Fall 2022
+University of Toronto
+
+PostgreSQL parses and plans every statement it is sent as text. The
+statements Assignment2 runs on every clock-in, pick-up and dispatch are the
+same every time, so a StatementRegistry prepares each of them (with PREPARE)
+the first time it is run on a connection, and from then on runs it with
+EXECUTE, which only sends its name and parameters and reuses the plan.
+
+Prepared statements belong to a database session, and outlive the
+transaction that prepared them, even if it rolls back. The registry
+remembers which statements it has prepared on each connection, so a new
+connection (e.g., one a pool opened to replace a broken one) prepares them
+again.
+"""
+from typing import Any, Dict, List, Set
+import threading
+import weakref
+
+import psycopg2.extensions as pg_ext
+
+
+class StatementRegistry:
+    """Named SQL statements, each prepared once on each connection it is run
+    on.
+
+    === Private Attributes ===
+    _prepare: the PREPARE command of each statement, by name.
+    _execute: the EXECUTE command of each statement, by name, with its
+        parameters as named psycopg2 placeholders.
+    _prepared: the names of the statements prepared on each connection.
+    _lock: held while _prepared is read or changed, since in pooled mode
+        several threads run statements on their connections at once.
+
+    >>> registry = StatementRegistry()
+    >>> registry.register("a2_next", "SELECT %(n)s + 1", n="integer")
+    >>> registry.names()
+    ['a2_next']
+    """
+    _prepare: Dict[str, str]
+    _execute: Dict[str, str]
+    _prepared: 'weakref.WeakKeyDictionary[pg_ext.connection, Set[str]]'
+    _lock: threading.Lock
+
+    def __init__(self) -> None:
+        """Initialize this registry, with no statements."""
+        self._prepare = {}
+        self._execute = {}
+        self._prepared = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def register(self, name: str, query: str, **types: str) -> None:
+        """Register the statement <name> as the SQL <query>, whose parameters
+        are written %(parameter)s, as for psycopg2, and have the SQL types
+        given by <types>, in the order of <types>.
+
+        <name> must be a valid SQL identifier that no other statement
+        prepared on the same connections has.
+        """
+        text = query.strip().rstrip(";")
+        for number, parameter in enumerate(types, 1):
+            text = text.replace(f"%({parameter})s", f"${number}")
+        self._prepare[name] = \
+            f"PREPARE {name}({', '.join(types.values())}) AS {text};"
+        placeholders = ", ".join(f"%({parameter})s" for parameter in types)
+        self._execute[name] = f"EXECUTE {name}({placeholders});"
+
+    def names(self) -> List[str]:
+        """Return the names of the registered statements."""
+        return sorted(self._prepare)
+
+    def execute(self, cursor: pg_ext.cursor, name: str,
+                params: Dict[str, Any]) -> None:
+        """Run the statement <name> on <cursor> with the parameters
+        <params>, preparing it first if it has not been prepared on the
+        connection of <cursor> yet. Its rows can then be fetched from
+        <cursor>.
+
+        Raise a pg.Error if preparing or running the statement fails.
+        """
+        conn = cursor.connection
+        with self._lock:
+            prepared = self._prepared.setdefault(conn, set())
+            new = name not in prepared
+        if new:
+            cursor.execute(self._prepare[name])
+            with self._lock:
+                prepared.add(name)
+        cursor.execute(self._execute[name], params)
@@ -0,0 +1,341 @@
+"""
+Part2 of csc343 A2: A generator of synthetic ride-sharing data.
+csc343, Fall 2022
+University of Toronto
+
+generate fills the tables of schema.ddl (Client, Driver, ClockedIn,
+ClockedOut, Location, Request, Dispatch, Pickup, Dropoff, Billed,
+DriverRating and ClientRating) with random data that conforms to the
+schema, at any scale. The same seed always gives the same data.
+
+The data follows a simple model of a city (the region REGION, where most
+requests start near a few hot spots):
+    - Drivers work shifts one after another. During a shift, a driver
+      serves rides back to back: a client requests a ride, the driver is
+      dispatched from where they are, picks the client up, drops them off,
+      and is billed; the driver and the client may rate each other. The
+      driver's location is recorded at the start of the shift and at each
+      dispatch, pickup and dropoff.
+    - Every shift is clocked out, except the last shift of some drivers,
+      which is still ongoing. Some of those drivers are still on a ride,
+      which has been dispatched (and possibly picked up) but not finished.
+    - Some clients have requested rides that no driver has been dispatched
+      to yet.
+Generation is done in a single pass, with the rows written to temporary
+files and then loaded with COPY, so memory use does not grow with the
+scale.
+
+Usage:
+    python synthetic.py dbname username password requests [seed]
+"""
+from datetime import date, datetime, timedelta
+from typing import Dict, IO, List, Optional, Tuple
+import heapq
+import math
+import random
+import sys
+import tempfile
+
+import psycopg2 as pg
+import psycopg2.extensions as pg_ext
+
+# The tables filled by generate, in an order they can be loaded in. ClockedOut
+# comes before Location, so that locations of finished shifts are not added
+# to CurrentLocation (see support.ddl) just to be removed again.
+TABLES = ("Client", "Driver", "Request", "ClockedIn", "ClockedOut",
+          "Location", "Dispatch", "Pickup", "Dropoff", "Billed",
+          "DriverRating", "ClientRating")
+
+# The area all locations are in, as (min longitude, min latitude,
+# max longitude, max latitude).
+REGION = (-79.6, 43.6, -79.2, 43.8)
+
+# The time the first shift can start.
+START = datetime(2022, 1, 1)
+
+# The average number of rows generated per request, over all tables.
+ROWS_PER_REQUEST = 10
+
+_SURNAMES = ("Smith", "Li", "Patel", "Nguyen", "Brown", "Tremblay", "Wong",
+             "Singh", "Martin", "Kim", "Roy", "Garcia", "Chen", "Wilson")
+_FIRSTNAMES = ("Alex", "Sam", "Priya", "Wei", "Maria", "Jordan", "Aisha",
+               "Noah", "Emma", "Omar", "Lucas", "Mei", "Ava", "Ravi")
+_VEHICLES = ("Corolla", "Civic", "Camry", "Prius", "Model3", "Elantra")
+
+
+def generate(conn: pg_ext.connection, requests: int, seed: int = 0,
+             ongoing: float = 0.5, pending: float = 0.05) \
+        -> Tuple[Dict[str, int], datetime]:
+    """Replace the data in the database <conn> is connected to with about
+    <requests> requests and everything that goes with them, generated with
+    the random seed <seed>, and commit.
+
+    A fraction <ongoing> of the drivers are on a shift at the end, and a
+    fraction <pending> of the requests have no driver dispatched to them.
+
+    Every table in the schema is emptied first, except SupportVersion and
+    DriverCacheListener (see support.ddl), so that tables kept up to date by
+    triggers are rebuilt from the new data. Shift ids given out after this
+    continue from the largest one loaded.
+
+    Return the number of rows loaded into each table, and the time at which
+    the data ends, i.e., a time after every date in it.
+    """
+    rnd = random.Random(seed)
+    files = {table: tempfile.TemporaryFile("w+") for table in TABLES}
+    try:
+        counts, now = _Generator(rnd, files).run(requests, ongoing, pending)
+        with conn.cursor() as cursor:
+            clear(cursor)
+            for table in TABLES:
+                files[table].seek(0)
+                cursor.copy_expert(f"COPY {table} FROM STDIN;", files[table])
+            cursor.execute("SELECT sync_shift_id_seq();")
+        conn.commit()
+    except pg.Error:
+        conn.rollback()
+        raise
+    finally:
+        for file in files.values():
+            file.close()
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("ANALYZE;")
+    finally:
+        conn.autocommit = autocommit
+    return counts, now
+
+
+def clear(cursor: pg_ext.cursor) -> None:
+    """Empty every table in the first schema of the search path, except
+    SupportVersion and DriverCacheListener, and start shift ids at 1 again.
+    """
+    cursor.execute("""
+        SELECT string_agg(quote_ident(tablename), ', ')
+        FROM pg_tables
+        WHERE schemaname = current_schema() AND
+            tablename NOT IN ('supportversion', 'drivercachelistener');""")
+    tables = cursor.fetchone()[0]
+    if tables is not None:
+        cursor.execute(f"TRUNCATE {tables} CASCADE;")
+    cursor.execute("SELECT to_regproc('sync_shift_id_seq') IS NOT NULL;")
+    if cursor.fetchone()[0]:
+        cursor.execute("SELECT sync_shift_id_seq();")
+
+
+class _Generator:
+    """The state of one run of generate.
+
+    === Private Attributes ===
+    _rnd: the source of randomness.
+    _files: the file the rows of each table are written to, in the text
+        format of COPY.
+    _counts: the number of rows written to each table.
+    _hot_spots: the centres of the areas where most requests start.
+    _request_id: the id of the last request generated.
+    _shift_id: the id of the last shift generated.
+    """
+    _rnd: random.Random
+    _files: Dict[str, IO[str]]
+    _counts: Dict[str, int]
+    _hot_spots: List[Tuple[float, float]]
+    _request_id: int
+    _shift_id: int
+
+    def __init__(self, rnd: random.Random, files: Dict[str, IO[str]]) -> None:
+        """Initialize this generator to write to <files>."""
+        self._rnd = rnd
+        self._files = files
+        self._counts = dict.fromkeys(TABLES, 0)
+        min_x, min_y, max_x, max_y = REGION
+        self._hot_spots = [(rnd.uniform(min_x, max_x),
+                            rnd.uniform(min_y, max_y)) for _ in range(4)]
+        self._request_id = 0
+        self._shift_id = 0
+
+    def run(self, requests: int, ongoing: float, pending: float) \
+            -> Tuple[Dict[str, int], datetime]:
+        """Generate about <requests> requests, as described in generate, and
+        return the number of rows of each table and the time the data ends.
+        """
+        rnd = self._rnd
+        drivers = max(50, requests // 50)
+        clients = max(50, requests // 10)
+        for client_id in range(1, clients + 1):
+            surname, firstname = self._name()
+            self._write("Client", client_id, surname, firstname,
+                        f"{firstname.lower()}{client_id}@example.com")
+        for driver_id in range(1, drivers + 1):
+            surname, firstname = self._name()
+            dob = date(1960, 1, 1) + timedelta(days=rnd.randrange(15000))
+            self._write("Driver", driver_id, surname, firstname, dob,
+                        f"{rnd.randrange(1, 9999)} Main St",
+                        rnd.choice(_VEHICLES), rnd.random() < 0.5)
+
+        # Each driver works their next shift when their previous one is
+        # over, so the drivers whose clocks are furthest behind go first.
+        clocks = [(START + timedelta(minutes=rnd.randrange(24 * 60)), driver_id)
+                  for driver_id in range(1, drivers + 1)]
+        heapq.heapify(clocks)
+        last_shift = {}
+        served = 0
+        to_serve = max(1, round(requests * (1 - pending)))
+        while served < to_serve:
+            clock, driver_id = heapq.heappop(clocks)
+            if driver_id in last_shift:
+                self._clock_out(*last_shift[driver_id][:2])
+            rides = min(rnd.randint(1, 12), to_serve - served)
+            end, location = self._shift(driver_id, clock, rides, clients)
+            last_shift[driver_id] = (self._shift_id, end, location)
+            served += rides
+            heapq.heappush(clocks, (end + timedelta(
+                hours=rnd.uniform(8, 16)), driver_id))
+        now = max(end for _, end, _ in last_shift.values()) + \
+            timedelta(hours=1)
+
+        # Clock out every last shift but a fraction <ongoing> of them, some
+        # of which are in the middle of a ride.
+        for driver_id in range(1, drivers + 1):
+            if driver_id not in last_shift:
+                continue
+            shift_id, end, location = last_shift[driver_id]
+            if rnd.random() >= ongoing:
+                self._clock_out(shift_id, end)
+            elif rnd.random() < 0.3:
+                self._ride(shift_id, now - timedelta(minutes=50), location,
+                           clients, finish=False)
+
+        for _ in range(max(0, requests - self._request_id)):
+            self._request(now - timedelta(seconds=rnd.randrange(3600)),
+                          self._place(), clients)
+        return self._counts, now
+
+    def _shift(self, driver_id: int, start: datetime, rides: int,
+               clients: int) -> Tuple[datetime, Tuple[float, float]]:
+        """Generate a shift of the driver with id <driver_id> starting at
+        <start>, with <rides> rides by random clients among the first
+        <clients>. Return when the last ride ended and where.
+        """
+        self._shift_id += 1
+        start = start.replace(second=0, microsecond=0)
+        location = self._place()
+        self._write("ClockedIn", self._shift_id, driver_id, start)
+        self._write("Location", self._shift_id, start, _geo_loc(location))
+        clock = start
+        for _ in range(rides):
+            clock, location = self._ride(
+                self._shift_id, clock, location, clients)
+        return clock, location
+
+    def _clock_out(self, shift_id: int, after: datetime) -> None:
+        """Generate the end of the shift with id <shift_id>, soon after
+        <after>.
+        """
+        self._write("ClockedOut", shift_id,
+                    after + timedelta(minutes=self._rnd.randint(1, 30)))
+
+    def _ride(self, shift_id: int, after: datetime,
+              location: Tuple[float, float], clients: int,
+              finish: bool = True) -> Tuple[datetime, Tuple[float, float]]:
+        """Generate a ride served by the shift with id <shift_id>, requested
+        after <after> by a random client among the first <clients>, when the
+        driver is at <location>. If <finish> is False, the ride is left
+        dispatched or picked up, but not dropped off.
+
+        Return when the ride ended and where.
+        """
+        rnd = self._rnd
+        requested = after + timedelta(minutes=rnd.randint(1, 30),
+                                      seconds=rnd.randrange(60))
+        source, destination = self._place(), self._place()
+        request_id = self._request(requested, source, clients, destination)
+        dispatched = requested + timedelta(minutes=1)
+        self._write("Dispatch", request_id, shift_id, _geo_loc(location),
+                    dispatched)
+        self._write("Location", shift_id, dispatched, _geo_loc(location))
+        if not finish and rnd.random() < 0.5:
+            return dispatched, location
+        picked_up = dispatched + timedelta(
+            minutes=round(_km(location, source) * 2) + rnd.randint(1, 5))
+        self._write("Pickup", request_id, picked_up)
+        self._write("Location", shift_id, picked_up, _geo_loc(source))
+        if not finish:
+            return picked_up, source
+        trip = _km(source, destination)
+        dropped_off = picked_up + timedelta(
+            minutes=round(trip * 2) + rnd.randint(1, 5))
+        self._write("Dropoff", request_id, dropped_off)
+        self._write("Location", shift_id, dropped_off, _geo_loc(destination))
+        self._write("Billed", request_id, round(3.25 + 1.75 * trip, 2))
+        if rnd.random() < 0.6:
+            self._write("DriverRating", request_id, self._rating())
+        if rnd.random() < 0.5:
+            self._write("ClientRating", request_id, self._rating())
+        return dropped_off, destination
+
+    def _request(self, when: datetime, source: Tuple[float, float],
+                 clients: int,
+                 destination: Optional[Tuple[float, float]] = None) -> int:
+        """Generate a request made at <when> from <source> to <destination>
+        (or a random place) by a random client among the first <clients>,
+        and return its id.
+        """
+        self._request_id += 1
+        destination = destination or self._place()
+        self._write("Request", self._request_id,
+                    self._rnd.randint(1, clients), when, _geo_loc(source),
+                    _geo_loc(destination))
+        return self._request_id
+
+    def _place(self) -> Tuple[float, float]:
+        """Return a random place in REGION, most likely near a hot spot."""
+        rnd = self._rnd
+        min_x, min_y, max_x, max_y = REGION
+        if rnd.random() < 0.7:
+            x, y = rnd.choice(self._hot_spots)
+            return (min(max(rnd.gauss(x, 0.02), min_x), max_x),
+                    min(max(rnd.gauss(y, 0.02), min_y), max_y))
+        return rnd.uniform(min_x, max_x), rnd.uniform(min_y, max_y)
+
+    def _name(self) -> Tuple[str, str]:
+        """Return a random (surname, firstname) pair."""
+        return self._rnd.choice(_SURNAMES), self._rnd.choice(_FIRSTNAMES)
+
+    def _rating(self) -> int:
+        """Return a random rating from 1 to 5, most likely a high one."""
+        return self._rnd.choices((1, 2, 3, 4, 5), (1, 1, 3, 8, 12))[0]
+
+    def _write(self, table: str, *values: object) -> None:
+        """Write a row of <values> to the file of the table <table>."""
+        self._files[table].write("\t".join(map(str, values)) + "\n")
+        self._counts[table] += 1
+
+
+def _geo_loc(place: Tuple[float, float]) -> str:
+    """Return the text of a geo_loc for the (longitude, latitude) pair
+    <place>.
+    """
+    return f"({place[0]:.6f},{place[1]:.6f})"
+
+
+def _km(a: Tuple[float, float], b: Tuple[float, float]) -> float:
+    """Return roughly how many kilometres apart the (longitude, latitude)
+    pairs <a> and <b> are.
+    """
+    return math.hypot((a[0] - b[0]) * 80.0, (a[1] - b[1]) * 111.0)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (5, 6):
+        sys.exit(__doc__.split("Usage:")[1])
+    connection = pg.connect(dbname=sys.argv[1], user=sys.argv[2],
+                            password=sys.argv[3],
+                            options="-c search_path=uber,public")
+    loaded, end = generate(connection, int(sys.argv[4]),
+                           int(sys.argv[5]) if len(sys.argv) == 6 else 0)
+    connection.close()
+    for name in TABLES:
+        print(f"{name:>12}: {loaded[name]}")
+    print(f"Data ends at {end}")